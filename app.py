@@ -1,27 +1,139 @@
+import time
+IMPORT_STARTED = time.perf_counter()
 from flask import Flask, request
-from rd import RDClient
-from jobs import load_all, bq_service_account_auth, update_deals
-from google.cloud import bigquery
+from jobs import load_all, load_accounts, update_deals, LoadJobsError, AccountsLoadError, ACCOUNT_OPTIONS
+from runner import JobRunner
+from schemas import account_key
+from clients import get_rd_client, get_bq_client
+from checkpoint import CheckpointStore
+from lazy import LazyModule, preload
+from webhooks import deal_from_event, webhook_buffer, close_webhook_buffer
+import metrics
+import tempfile
+import atexit
+import hmac
 import os
 
+# Heavy dependencies are imported on first use (see lazy.LazyModule); the app import time is exposed in /metrics
+metrics.IMPORT_SECONDS.set(round(time.perf_counter() - IMPORT_STARTED, 4), module='app')
+
 app = Flask(__name__)
+# Background jobs (requests with "async": true)
+runner = JobRunner(max_workers=int(os.environ.get('JOB_WORKERS', 2)))
+# Directory of the checkpoints of load runs (requests with a "run_id")
+CHECKPOINT_DIR = os.environ.get('CHECKPOINT_DIR', os.path.join(tempfile.gettempdir(), 'rd_checkpoints'))
+# Shared secret of the /webhook/rd URL (?secret=...), required when set
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET')
+# Buffered webhook events are flushed when the process exits
+atexit.register(close_webhook_buffer)
+# Imports the heavy dependencies in background once the app is up (PRELOAD_IMPORTS=false leaves them to the first job)
+if os.environ.get('PRELOAD_IMPORTS', 'true') in ('True', 'true'):
+    preload(*[LazyModule(name) for name in ('pandas', 'requests', 'google.cloud.bigquery', 'pyarrow')])
+
+def get_checkpoint(data):
+    'Returns the checkpoint store of the payload run_id (resumes a failed run with the same id), or None.'
+    run_id = data.get('run_id')
+    if run_id is None:
+        return None
+    if not isinstance(run_id, str) or not run_id.replace('-', '').replace('_', '').isalnum():
+        raise ValueError('Invalid run_id! Please use only letters, numbers, "-" and "_".')
+    return CheckpointStore(directory=CHECKPOINT_DIR, run_id=run_id)
+
+# Boolean options of the load payloads
+LOAD_OPTIONS = ('sharded', 'stream', 'skip_unchanged', 'products', 'contacts')
+
+def flag(value):
+    'Parses a boolean payload value (true or "true").'
+    return value in (True, "True", "true")
+
+def load_options(data):
+    'Returns the options of a load payload (see jobs.load_all): the LOAD_OPTIONS booleans and the tables backend.'
+    options = {name: flag(data.get(name, False)) for name in LOAD_OPTIONS}
+    options['backend'] = data.get('backend', 'pandas')
+    return options
+
+def batch_accounts(data):
+    'Returns the account configs of a batch payload, with their boolean options parsed.'
+    accounts = data.get('accounts')
+    if not isinstance(accounts, list) or len(accounts) == 0:
+        raise ValueError('Please, insert a list of accounts.')
+    return [
+        {name: (flag(value) if name in ACCOUNT_OPTIONS and name not in ('max_concurrent_loads', 'backend') else value) for name, value in account.items()}
+        for account in accounts
+    ]
+
+def execute(data, kind, key, func, **kwargs):
+    '''
+    Runs a job inside the request, or in background when the payload has "async": true.
+    Async requests return the job id right away; a request for a job already queued or
+    running (same key) returns the existing job.
+    '''
+    # Runs log a structured json line with their requests, stages and tables (see metrics.run)
+    func = metrics.logged(kind, func, key=[str(part) for part in key[1:]])
+    if flag(data.get('async', False)) is True:
+        job, created = runner.submit(kind=kind, key=key, func=func, **kwargs)
+        return {'job_id': job.id, 'status': job.status, 'status_url': f'/jobs/{job.id}', 'duplicate': not created}, 202
+    result = func(**kwargs)
+    if result is not None:
+        return {'message': 'Job executed successfully', 'result': result}, 200
+    return {'message': 'Job executed successfully'}, 200
 
 # Flask route
 @app.route('/')
 def home():
     return {'message': 'Service is running'}, 200
 
+@app.route('/metrics')
+def handle_metrics():
+    return metrics.registry.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+@app.errorhandler(LoadJobsError)
+def handle_load_errors(error):
+    errors = {table_id: str(table_error) for table_id, table_error in error.errors.items()}
+    return {'message': 'Some tables failed to load', 'errors': errors}, 500
+
+@app.errorhandler(AccountsLoadError)
+def handle_accounts_errors(error):
+    errors = {account: str(account_error) for account, account_error in error.errors.items()}
+    return {'message': 'Some accounts failed to load', 'errors': errors, 'result': error.result}, 500
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def handle_job_status(job_id):
+    job = runner.get(job_id)
+    if job is None:
+        return {'message': 'Job not found'}, 404
+    return job.to_dict(), 200
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def handle_job_result(job_id):
+    job = runner.get(job_id)
+    if job is None:
+        return {'message': 'Job not found'}, 404
+    if job.finished_at is None:
+        return {'message': f'Job is {job.status}', 'status': job.status}, 409
+    return {'status': job.status, 'result': job.result, 'error': job.error, 'errors': job.errors}, 200
+
 @app.route('/load', methods=['POST'])
 def handle_load_request():
     data = request.get_json()
     RD_CRM_TOKEN = data.get('RD_CRM_TOKEN')
     BQ_PROJECT_ID = data.get('BQ_PROJECT_ID')
     BQ_DATASET = data.get('BQ_DATASET')
-    # Credentials
-    bq_client = bigquery.Client()
-    rd_client = RDClient(RD_CRM_TOKEN)
-    load_all(rd_client, bq_client=bq_client, BQ_PROJECT_ID=BQ_PROJECT_ID, BQ_DATASET=BQ_DATASET)
-    return {'message': 'Job executed successfully'}, 200
+    # Credentials (cached clients)
+    bq_client = get_bq_client()
+    rd_client = get_rd_client(RD_CRM_TOKEN)
+    return execute(
+        data,
+        kind='load',
+        key=('load', account_key(RD_CRM_TOKEN), BQ_PROJECT_ID, BQ_DATASET),
+        func=load_all,
+        rd_client=rd_client,
+        bq_client=bq_client,
+        BQ_PROJECT_ID=BQ_PROJECT_ID,
+        BQ_DATASET=BQ_DATASET,
+        checkpoint=get_checkpoint(data),
+        **load_options(data)
+    )
 
 @app.route('/load/local', methods=['POST'])
 def handle_load_request_local():
@@ -30,11 +142,70 @@ def handle_load_request_local():
     BQ_PROJECT_ID = data.get('BQ_PROJECT_ID')
     BQ_DATASET = data.get('BQ_DATASET')
     BQ_CREDENTIALS = data.get('BQ_CREDENTIALS')
-    # Credentials
-    bq_client = bq_service_account_auth(credentials=BQ_CREDENTIALS)
-    rd_client = RDClient(RD_CRM_TOKEN)
-    load_all(rd_client=rd_client, bq_client=bq_client, BQ_PROJECT_ID=BQ_PROJECT_ID, BQ_DATASET=BQ_DATASET)
-    return {'message': 'Job executed successfully'}, 200
+    # Credentials (cached clients)
+    bq_client = get_bq_client(credentials=BQ_CREDENTIALS)
+    rd_client = get_rd_client(RD_CRM_TOKEN)
+    return execute(
+        data,
+        kind='load',
+        key=('load', account_key(RD_CRM_TOKEN), BQ_PROJECT_ID, BQ_DATASET),
+        func=load_all,
+        rd_client=rd_client,
+        bq_client=bq_client,
+        BQ_PROJECT_ID=BQ_PROJECT_ID,
+        BQ_DATASET=BQ_DATASET,
+        checkpoint=get_checkpoint(data),
+        **load_options(data)
+    )
+
+@app.route('/load/batch', methods=['POST'])
+def handle_batch_load_request():
+    data = request.get_json()
+    accounts = batch_accounts(data)
+    max_workers = int(data.get('max_workers', os.environ.get('BATCH_WORKERS', 4)))
+    max_per_token = int(data.get('max_per_token', 1))
+    # Credentials (cached clients, RD clients are created by each account run)
+    bq_client = get_bq_client()
+    return execute(
+        data,
+        kind='load_batch',
+        key=('load_batch',) + tuple(sorted([
+            (account_key(account.get('RD_CRM_TOKEN', '')), account.get('BQ_PROJECT_ID'), account.get('BQ_DATASET'))
+            for account in accounts
+        ])),
+        func=load_accounts,
+        accounts=accounts,
+        bq_client=bq_client,
+        rd_client_factory=get_rd_client,
+        max_workers=max_workers,
+        max_per_token=max_per_token,
+        **load_options(data)
+    )
+
+@app.route('/load/batch/local', methods=['POST'])
+def handle_batch_load_request_local():
+    data = request.get_json()
+    accounts = batch_accounts(data)
+    max_workers = int(data.get('max_workers', os.environ.get('BATCH_WORKERS', 4)))
+    max_per_token = int(data.get('max_per_token', 1))
+    BQ_CREDENTIALS = data.get('BQ_CREDENTIALS')
+    # Credentials (cached clients, RD clients are created by each account run)
+    bq_client = get_bq_client(credentials=BQ_CREDENTIALS)
+    return execute(
+        data,
+        kind='load_batch',
+        key=('load_batch',) + tuple(sorted([
+            (account_key(account.get('RD_CRM_TOKEN', '')), account.get('BQ_PROJECT_ID'), account.get('BQ_DATASET'))
+            for account in accounts
+        ])),
+        func=load_accounts,
+        accounts=accounts,
+        bq_client=bq_client,
+        rd_client_factory=get_rd_client,
+        max_workers=max_workers,
+        max_per_token=max_per_token,
+        **load_options(data)
+    )
 
 @app.route('/update_deals', methods=['POST'])
 def handle_upd_request():
@@ -47,19 +218,26 @@ def handle_upd_request():
     products = data.get('products', False)
     deals = False if deals=="False" or deals=="false" else True
     products = True if products=="True" or products=="true" else False
-    # Credentials
-    bq_client = bigquery.Client()
-    rd_client = RDClient(RD_CRM_TOKEN)
-    update_deals(
+    incremental = flag(data.get('incremental', False))
+    stream = flag(data.get('stream', False))
+    # Credentials (cached clients)
+    bq_client = get_bq_client()
+    rd_client = get_rd_client(RD_CRM_TOKEN)
+    return execute(
+        data,
+        kind='update_deals',
+        key=('update_deals', account_key(RD_CRM_TOKEN), pipeline_id, deals_table_id, prods_table_id),
+        func=update_deals,
         rd_client=rd_client,
         bq_client=bq_client,
         pipeline_id=pipeline_id,
         deals_table_id=deals_table_id,
         prods_table_id=prods_table_id,
         deals=deals,
-        products=products
+        products=products,
+        stream=stream,
+        incremental=incremental
     )
-    return {'message': 'Job executed successfully'}, 200
 
 @app.route('/update_deals/local', methods=['POST'])
 def handle_upd_request_local():
@@ -73,20 +251,51 @@ def handle_upd_request_local():
     products = data.get('products', False)
     deals = False if deals=="False" or deals=="false" else True
     products = True if products=="True" or products=="true" else False
-    # Credentials
-    bq_client = bq_service_account_auth(credentials=BQ_CREDENTIALS)
-    rd_client = RDClient(RD_CRM_TOKEN)
-    update_deals(
+    incremental = flag(data.get('incremental', False))
+    stream = flag(data.get('stream', False))
+    # Credentials (cached clients)
+    bq_client = get_bq_client(credentials=BQ_CREDENTIALS)
+    rd_client = get_rd_client(RD_CRM_TOKEN)
+    return execute(
+        data,
+        kind='update_deals',
+        key=('update_deals', account_key(RD_CRM_TOKEN), pipeline_id, deals_table_id, prods_table_id),
+        func=update_deals,
         rd_client=rd_client,
         bq_client=bq_client,
         pipeline_id=pipeline_id,
         deals_table_id=deals_table_id,
         prods_table_id=prods_table_id,
         deals=deals,
-        products=products
+        products=products,
+        stream=stream,
+        incremental=incremental
     )
-    return {'message': 'Job executed successfully'}, 200
+
+@app.route('/webhook/rd', methods=['POST'])
+def handle_rd_webhook():
+    '''
+    Receives RD CRM deal created/updated events (one event or a list of them), buffered and upserted
+    in micro-batches in the deals tables (see webhooks.DealsWebhookBuffer). Answers 503 when the buffer
+    is full, so the sender retries later (repeated events are upserted again, with the same result).
+    '''
+    if WEBHOOK_SECRET is not None and not hmac.compare_digest(request.args.get('secret', ''), WEBHOOK_SECRET):
+        return {'message': 'Invalid webhook secret'}, 401
+    data = request.get_json(silent=True)
+    events = data if isinstance(data, list) else [data]
+    try:
+        deals = [deal_from_event(event) for event in events]
+    except ValueError as error:
+        metrics.WEBHOOK_EVENTS.inc(len(events), status='rejected')
+        return {'message': str(error)}, 400
+    buffer = webhook_buffer()
+    ignored = len([deal for deal in deals if deal is None])
+    metrics.WEBHOOK_EVENTS.inc(ignored, status='ignored')
+    for deal in [deal for deal in deals if deal is not None]:
+        if buffer.put(deal) is False:
+            return {'message': 'Webhook buffer is full, please retry later'}, 503, {'Retry-After': str(max(1, int(buffer.window)))}
+    return {'message': 'Events accepted', 'accepted': len(deals) - ignored, 'ignored': ignored}, 202
 
 # For local tests the app is executed directly by that script
 if __name__=='__main__':
-    app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 8080)))
\ No newline at end of file
+    app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 8080)))
@@ -0,0 +1,148 @@
+from rd import DEALS_COLUMNS, DEALS_PRODUCTS_DTYPES, deal_row, deals_products_rows, deals_contacts_rows, text_to_snakecase, value_to_str
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import io
+
+# Arrow types of the entity dtypes (see entities.DTYPES); any other column is a string
+ARROW_TYPES = {
+    'str': pa.string(),
+    'bool': pa.bool_(),
+    'int': pa.int64(),
+    'float': pa.float64(),
+    'datetime': pa.timestamp('us', tz='UTC')
+}
+# Dtypes of the deals columns built from the deal fields (custom fields are strings)
+DEALS_DTYPES = {
+    'win': 'bool',
+    'created_at': 'datetime',
+    'updated_at': 'datetime',
+    'closed_at': 'datetime',
+    'amount_montly': 'float',
+    'amount_unique': 'float',
+    'amount_total': 'float'
+}
+# String columns with at most this share of distinct values are dictionary encoded (e.g. stage, user, source)
+DICTIONARY_MAX_RATIO = 0.5
+MISSING = object()  # Custom field not set in a deal (a set field may be null)
+
+def is_table(table):
+    'Whether a table is an arrow table (arrow backend) instead of a dataframe.'
+    return isinstance(table, pa.Table)
+
+def column_array(values, dtype: str = 'str'):
+    '''
+    Returns the arrow array of a column of raw json values with an entity dtype. Strings are the
+    str() of the values (as astype(str) in the pandas backend), but nulls are kept null; datetimes
+    are parsed from their ISO strings and converted to UTC.
+    '''
+    arrow_type = ARROW_TYPES[dtype]
+    if dtype == 'str':
+        return pa.array([None if value is None else str(value) for value in values], type=pa.string())
+    if dtype == 'datetime':
+        return pa.array([value_to_str(value) for value in values], type=pa.string()).cast(arrow_type)
+    try:
+        return pa.array(values, type=arrow_type)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError):
+        # Numbers or booleans sent as strings
+        return pa.array([value_to_str(value) for value in values], type=pa.string()).cast(arrow_type)
+
+def flatten(item, prefix: str = ''):
+    'Flattens the nested objects of a raw json item, joining keys with "_" (as pd.json_normalize and the "." replace).'
+    flat = {}
+    for key, value in item.items():
+        if isinstance(value, dict) and len(value) > 0:
+            flat.update(flatten(value, prefix=f'{prefix}{key}_'))
+        else:
+            flat[f'{prefix}{key}'] = value
+    return flat
+
+def rows_to_table(rows, dtypes: dict):
+    'Returns the arrow table of a list of row dictionaries, with columns in order of first appearance typed by dtypes.'
+    if len(rows) == 0:
+        return pa.table({})
+    columns = {}
+    for row in rows:
+        for key in row:
+            columns.setdefault(key, None)
+    return pa.table({column: column_array([row.get(column) for row in rows], dtypes.get(column, 'str')) for column in columns})
+
+def encode_low_cardinality(table, max_ratio: float = DICTIONARY_MAX_RATIO):
+    'Dictionary encodes the string columns of a table with at most max_ratio distinct values per row.'
+    for index, field in enumerate(table.schema):
+        if not pa.types.is_string(field.type) or table.num_rows == 0:
+            continue
+        column = table.column(index)
+        if pc.count_distinct(column).as_py() <= max_ratio * table.num_rows:
+            table = table.set_column(index, field.name, pc.dictionary_encode(column.combine_chunks()))
+    return table
+
+def entity_table(spec, items):
+    'Returns the typed arrow table of a list of raw items of a reference entity spec (see entities.EntitySpec).'
+    rows = [flatten(item) for item in spec.prepare(items)]
+    return encode_low_cardinality(rows_to_table(rows, spec.dtypes))
+
+def labels(table, column: str):
+    'Returns the {id: snakecase label} dictionary of an entity table (e.g. custom fields or pipelines names).'
+    return dict(zip(table.column('id').to_pylist(), [text_to_snakecase(label) for label in table.column(column).to_pylist()]))
+
+def deals_table(list_deals, dict_custom_fields, drop_empty: bool = True):
+    '''
+    Returns the arrow deals table of a list of raw deals, with the same columns as rd.normalize_deals.
+    drop_empty: Drops the custom fields without any value.
+    '''
+    if len(list_deals) == 0:
+        return pa.table({})
+    columns = dict(zip(DEALS_COLUMNS, [list(values) for values in zip(*[deal_row(deal) for deal in list_deals])]))
+    # Custom fields: one string column per field, in order of first appearance (the last value of a field wins)
+    custom = {}
+    for row, deal in enumerate(list_deals):
+        for c_field in deal['deal_custom_fields']:
+            field = dict_custom_fields[c_field['custom_field_id']]
+            if field not in custom:
+                custom[field] = [MISSING] * len(list_deals)
+            custom[field][row] = value_to_str(c_field['value'])
+    for field, values in custom.items():
+        if field in columns:
+            # Custom fields named as a deal column overwrite it for the deals that have them
+            columns[field] = [current if value is MISSING else value for value, current in zip(values, columns[field])]
+            continue
+        values = [None if value is MISSING else value for value in values]
+        if drop_empty is False or any([value is not None for value in values]):
+            columns[field] = values
+    return pa.table({column: column_array(values, DEALS_DTYPES.get(column, 'str')) for column, values in columns.items()})
+
+def deals_products_table(list_deals):
+    'Returns the arrow deals products table of a list of raw deals (see rd.normalize_deals_products).'
+    return rows_to_table(deals_products_rows(list_deals), DEALS_PRODUCTS_DTYPES)
+
+def deals_contacts_table(list_deals):
+    'Returns the arrow deals contacts table of a list of raw deals (see rd.normalize_deals_contacts).'
+    return rows_to_table(deals_contacts_rows(list_deals), {})
+
+def decode(table):
+    'Returns the table with its dictionary encoded columns cast back to their value types.'
+    fields = [pa.field(field.name, field.type.value_type) if pa.types.is_dictionary(field.type) else field for field in table.schema]
+    return table.cast(pa.schema(fields)) if fields != list(table.schema) else table
+
+def concat_tables(tables):
+    '''
+    Concatenates arrow tables, adding the columns missing in some of them as nulls (dictionary
+    encoded columns are decoded, as each table may encode different columns).
+    '''
+    tables = [decode(table) for table in tables if table.num_columns > 0]
+    if len(tables) == 0:
+        return pa.table({})
+    return pa.concat_tables(tables, promote_options='default')
+
+def drop_empty_custom_fields(table):
+    'Drops the custom fields columns of an arrow deals table without any value.'
+    empty = [name for name in table.column_names if name not in DEALS_COLUMNS and table.column(name).null_count == table.num_rows]
+    return table.drop_columns(empty) if len(empty) > 0 else table
+
+def to_parquet(table):
+    'Returns a parquet file in memory with the table, ready to be loaded in BigQuery.'
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer)
+    buffer.seek(0)
+    return buffer
@@ -0,0 +1,141 @@
+from google.cloud import bigquery
+from google.cloud.exceptions import NotFound
+import pandas as pd
+import threading
+import time
+import io
+import re
+
+# Pandas dtype kinds to BigQuery types, for tables loaded without an explicit schema
+DTYPE_TYPES = {'M': 'TIMESTAMP', 'f': 'FLOAT', 'i': 'INTEGER', 'u': 'INTEGER', 'b': 'BOOLEAN'}
+
+class FakeTable:
+    def __init__(self, table_id, schema):
+        self.table_id = table_id
+        self.schema = schema
+
+class FakeJob:
+    def __init__(self, rows=None, output_rows=None):
+        self._rows = rows or []
+        self.output_rows = output_rows
+
+    def result(self):
+        return self._rows
+
+class FakeBigQueryClient:
+    '''
+    In-memory stand-in of bigquery.Client for the calls made by the jobs module (load jobs from
+    dataframes and parquet files, tables metadata, MERGE statements, watermark and plain column queries).
+    Dataframes are serialized to parquet as the real client does, so client side costs are kept.
+    latency: Seconds added to each load job and query (BigQuery server side time).
+    Statistics of the jobs are kept in `stats` (load jobs, queries, rows and bytes loaded, seconds).
+    '''
+    def __init__(self, latency: float = 0.0, serialize: bool = True):
+        self.latency = latency
+        self.serialize = serialize
+        self.tables = {}  # {table_id: dataframe}
+        self.schemas = {}  # {table_id: list of SchemaField}
+        self.expires = {}  # {table_id: expiration datetime} of tables created with create_table
+        self.stats = {'load_jobs': 0, 'queries': 0, 'rows': 0, 'bytes': 0, 'seconds': 0.0}
+        self._lock = threading.Lock()
+
+    def reset_stats(self):
+        with self._lock:
+            self.stats = {'load_jobs': 0, 'queries': 0, 'rows': 0, 'bytes': 0, 'seconds': 0.0}
+
+    def _write(self, table_id, df, job_config, size, started):
+        if self.latency > 0:
+            time.sleep(self.latency)
+        output_rows = df.shape[0]
+        schema = list(job_config.schema or []) or [
+            bigquery.SchemaField(str(column), DTYPE_TYPES.get(df[column].dtype.kind, 'STRING'))
+            for column in df.columns
+        ]
+        with self._lock:
+            if job_config.write_disposition == bigquery.WriteDisposition.WRITE_APPEND and table_id in self.tables:
+                df = pd.concat([self.tables[table_id], df], ignore_index=True)
+            self.tables[table_id] = df
+            self.schemas[table_id] = schema
+            self.stats['load_jobs'] += 1
+            self.stats['rows'] += output_rows
+            self.stats['bytes'] += size
+            self.stats['seconds'] += time.perf_counter() - started
+        return FakeJob(output_rows=output_rows)
+
+    def load_table_from_dataframe(self, df, table_id, job_config=None):
+        started = time.perf_counter()
+        size = 0
+        if self.serialize is True:
+            buffer = io.BytesIO()
+            df.to_parquet(buffer, index=False)
+            size = buffer.tell()
+        return self._write(table_id, df.reset_index(drop=True), job_config or bigquery.LoadJobConfig(), size, started)
+
+    def load_table_from_file(self, file, table_id, job_config=None):
+        started = time.perf_counter()
+        data = file.read()
+        df = pd.read_parquet(io.BytesIO(data))
+        return self._write(table_id, df, job_config or bigquery.LoadJobConfig(), len(data), started)
+
+    def create_table(self, table):
+        table_id = f'{table.project}.{table.dataset_id}.{table.table_id}'
+        with self._lock:
+            self.tables[table_id] = pd.DataFrame()
+            self.schemas[table_id] = list(table.schema)
+            self.expires[table_id] = table.expires
+        return FakeTable(table_id, list(table.schema))
+
+    def get_table(self, table_id):
+        with self._lock:
+            if table_id not in self.tables:
+                raise NotFound(f'Not found: Table {table_id}')
+            return FakeTable(table_id, list(self.schemas[table_id]))
+
+    def update_table(self, table, fields):
+        with self._lock:
+            self.schemas[table.table_id] = list(table.schema)
+        return table
+
+    def delete_table(self, table_id, not_found_ok: bool = False):
+        with self._lock:
+            if table_id not in self.tables and not_found_ok is False:
+                raise NotFound(f'Not found: Table {table_id}')
+            self.tables.pop(table_id, None)
+            self.schemas.pop(table_id, None)
+            self.expires.pop(table_id, None)
+
+    def query(self, query):
+        started = time.perf_counter()
+        if self.latency > 0:
+            time.sleep(self.latency)
+        rows = []
+        merge = re.search(r'MERGE `(?P<target>[^`]+)` T\s+USING `(?P<source>[^`]+)` S\s+ON T\.`(?P<key>[^`]+)`', query)
+        select_max = re.search(r'SELECT MAX\(`(?P<column>[^`]+)`\) AS (?P<alias>\w+) FROM `(?P<table>[^`]+)`', query)
+        select = re.fullmatch(r'\s*SELECT (?P<columns>[\w, ]+) FROM `(?P<table>[^`]+)`\s*', query)
+        with self._lock:
+            if merge is not None:
+                target, source = self.tables[merge['target']], self.tables[merge['source']]
+                key = merge['key']
+                version = re.search(r'WHEN MATCHED AND \(T\.`(?P<column>[^`]+)` IS NULL', query)
+                if version is not None:
+                    # Matched rows are only updated by rows at least as recent
+                    column = version['column']
+                    current = source[key].map(dict(zip(target[key], target[column])))
+                    source = source[current.isna() | (pd.to_datetime(source[column], utc=True) >= pd.to_datetime(current, utc=True))]
+                self.tables[merge['target']] = pd.concat([target[~target[key].isin(source[key])], source], ignore_index=True)
+            elif select_max is not None:
+                if select_max['table'] not in self.tables:
+                    raise NotFound(f'Not found: Table {select_max["table"]}')
+                df = self.tables[select_max['table']]
+                value = df[select_max['column']].max() if df.shape[0] > 0 else None
+                rows = [{select_max['alias']: None if pd.isna(value) else value}]
+            elif select is not None:
+                if select['table'] not in self.tables:
+                    raise NotFound(f'Not found: Table {select["table"]}')
+                columns = [column.strip() for column in select['columns'].split(',')]
+                rows = self.tables[select['table']][columns].to_dict('records')
+            else:
+                raise NotImplementedError(f'Query not supported by the fake client: {query}')
+            self.stats['queries'] += 1
+            self.stats['seconds'] += time.perf_counter() - started
+        return FakeJob(rows)
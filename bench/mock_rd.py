@@ -0,0 +1,258 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from collections import OrderedDict
+from bench.synthetic import SyntheticAccount
+import multiprocessing
+import argparse
+import datetime
+import threading
+import hashlib
+import random
+import json
+import time
+
+class MockRDServer(ThreadingHTTPServer):
+    '''
+    Local stand-in of the RD CRM API (v1) serving a SyntheticAccount, for benchmarks and offline runs.
+    Implements the endpoints used by RDClient with RD pagination (page, limit, has_more, total),
+    its refusal of /deals pages beyond max_results, deals filters and ordering, and ETag revalidation.
+    latency, jitter: Seconds added to every response (uniformly jittered by +/- jitter).
+    rate_limit: Requests per second accepted per token before answering 429 with Retry-After (None: unlimited).
+    error_rate: Share of requests answered with a 503, to exercise retries.
+    '''
+    daemon_threads = True
+
+    def __init__(
+            self,
+            account: SyntheticAccount,
+            token: str = 'bench-token',
+            host: str = '127.0.0.1',
+            port: int = 0,
+            latency: float = 0.0,
+            jitter: float = 0.0,
+            rate_limit: float = None,
+            error_rate: float = 0.0,
+            max_results: int = 10000
+        ):
+        super().__init__((host, port), MockRDHandler)
+        self.account = account
+        self.token = token
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.error_rate = error_rate
+        self.max_results = max_results
+        self.requests = 0
+        self._window = (0, 0)  # (second, requests in that second) for the rate limit
+        self._queries = OrderedDict()  # Recently selected deals indexes by query
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/api/v1'
+
+    def start(self):
+        'Serves in a background thread and returns the API base url.'
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self.url
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def throttled(self):
+        'Counts a request and returns whether it exceeds the rate limit.'
+        with self._lock:
+            self.requests += 1
+            if self.rate_limit is None:
+                return False
+            second = int(time.monotonic())
+            start, count = self._window
+            count = count + 1 if start == second else 1
+            self._window = (second, count)
+            return count > self.rate_limit
+
+    def select_deals(self, **query):
+        'Returns the deals indexes of a query, reusing the selection of recent queries (pages of the same scan).'
+        key = tuple(sorted(query.items()))
+        with self._lock:
+            indexes = self._queries.get(key)
+            if indexes is not None:
+                self._queries.move_to_end(key)
+                return indexes
+        indexes = self.account.select(**query)
+        with self._lock:
+            self._queries[key] = indexes
+            while len(self._queries) > 64:
+                self._queries.popitem(last=False)
+        return indexes
+
+    def invalidate_queries(self):
+        'Forgets cached selections (call after SyntheticAccount.touch).'
+        with self._lock:
+            self._queries.clear()
+
+class MockRDHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive, as the RD API
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body, etag: bool = False):
+        data = json.dumps(body).encode()
+        headers = {'Content-Type': 'application/json'}
+        if etag is True:
+            headers['ETag'] = '"' + hashlib.sha256(data).hexdigest()[:32] + '"'
+            if self.headers.get('If-None-Match') == headers['ETag']:
+                status, data = 304, b''
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        server = self.server
+        if server.latency > 0 or server.jitter > 0:
+            time.sleep(max(0.0, server.latency + random.uniform(-server.jitter, server.jitter)))
+        parsed = urlparse(self.path)
+        params = {name: values[-1] for name, values in parse_qs(parsed.query).items()}
+        if server.throttled():
+            self.send_response(429)
+            self.send_header('Retry-After', '1')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if server.error_rate > 0 and random.random() < server.error_rate:
+            return self.send_json(503, {'errors': 'Service unavailable'})
+        if params.get('token') != server.token:
+            return self.send_json(401, {'errors': 'Unauthorized'})
+        route = parsed.path.removeprefix('/api/v1')
+        routes = {
+            '/token/check': self.token_check,
+            '/custom_fields': self.custom_fields,
+            '/deal_pipelines': self.pipelines,
+            '/deal_stages': self.stages,
+            '/deal_sources': lambda params: self.paginated(params, 'deal_sources', server.account.sources),
+            '/deal_lost_reasons': lambda params: self.paginated(params, 'deal_lost_reasons', server.account.lost_reasons),
+            '/campaigns': lambda params: self.paginated(params, 'campaigns', server.account.campaigns),
+            '/products': lambda params: self.send_json(200, {'products': server.account.products, 'total': len(server.account.products)}, etag=True),
+            '/teams': lambda params: self.send_json(200, {'teams': server.account.teams}, etag=True),
+            '/users': lambda params: self.send_json(200, {'users': server.account.users}, etag=True),
+            '/deals': self.deals,
+            '/_bench/touch': self.touch
+        }
+        if route not in routes:
+            return self.send_json(404, {'errors': f'Not found: {route}'})
+        return routes[route](params)
+
+    def touch(self, params):
+        'Benchmark control endpoint: updates random deals now (SyntheticAccount.touch).'
+        indexes = self.server.account.touch(int(params.get('count', 100)), seed=int(params['seed']) if 'seed' in params else None)
+        self.server.invalidate_queries()
+        return self.send_json(200, {'touched': len(indexes)})
+
+    def token_check(self, params):
+        return self.send_json(200, {'name': 'Benchmark account'})
+
+    def custom_fields(self, params):
+        return self.send_json(200, self.server.account.custom_fields, etag=True)
+
+    def pipelines(self, params):
+        account = self.server.account
+        body = [{**pipeline, 'deal_stages': account.stages[pipeline['id']]} for pipeline in account.pipelines]
+        return self.send_json(200, body, etag=True)
+
+    def stages(self, params):
+        stages = self.server.account.stages.get(params.get('deal_pipeline_id'), [])
+        return self.send_json(200, {'deal_stages': stages[:int(params.get('limit', 20))]}, etag=True)
+
+    def paginated(self, params, list_key, items):
+        page = int(params.get('page', 1))
+        limit = int(params.get('limit', 20))
+        start = (page - 1) * limit
+        return self.send_json(200, {list_key: items[start:start + limit], 'has_more': start + limit < len(items), 'total': len(items)})
+
+    def deals(self, params):
+        server = self.server
+        account = server.account
+        page = int(params.get('page', 1))
+        limit = min(int(params.get('limit', 20)), 200)
+        pipeline_id = params.get('deal_pipeline_id') or params.get('pipeline_id')
+        query = {
+            'pipeline': account.pipeline_index(pipeline_id) if pipeline_id is not None else None,
+            'products': params.get('product_presence') == 'true',
+            'order': params.get('order'),
+            'direction': params.get('direction', 'asc')
+        }
+        if pipeline_id is not None and query['pipeline'] is None:
+            return self.send_json(200, {'deals': [], 'has_more': False, 'total': 0})
+        if params.get('created_at_period') == 'true':
+            for name, param in (('start_day', 'start_date'), ('end_day', 'end_date')):
+                if param in params:
+                    query[name] = (datetime.date.fromisoformat(params[param][:10]) - datetime.date(1970, 1, 1)).days
+        indexes = server.select_deals(**query)
+        start = (page - 1) * limit
+        if start + limit > server.max_results and page > 1:
+            return self.send_json(400, {'errors': f'Page limit exceeded: max of {server.max_results} results'})
+        page_indexes = indexes[start:start + limit]
+        return self.send_json(200, {
+            'deals': [account.deal(index) for index in page_indexes],
+            'has_more': start + limit < len(indexes) and start + limit < server.max_results,
+            'total': int(len(indexes))
+        })
+
+def _serve(connection, account_options, server_options):
+    server = MockRDServer(SyntheticAccount(**account_options), **server_options)
+    connection.send(server.url)
+    connection.close()
+    server.serve_forever()
+
+def start_process(account_options: dict = None, server_options: dict = None):
+    '''
+    Starts a mock server of a new SyntheticAccount in a child process, so serving does not compete
+    for the GIL (and tracemalloc) with the client being measured. Returns (process, url).
+    '''
+    context = multiprocessing.get_context('spawn')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_serve, args=(sender, account_options or {}, server_options or {}), daemon=True)
+    process.start()
+    return process, receiver.recv()
+
+def main():
+    parser = argparse.ArgumentParser(description='Serves a synthetic RD CRM account (point RD_CRM_URL to the printed url).')
+    parser.add_argument('--deals', type=int, default=100000)
+    parser.add_argument('--pipelines', type=int, default=4)
+    parser.add_argument('--custom-fields', type=int, default=40)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--token', default='bench-token')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every response.')
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--rate-limit', type=float, default=None, help='Requests per second before 429.')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    args = parser.parse_args()
+    account = SyntheticAccount(deals=args.deals, pipelines=args.pipelines, custom_fields=args.custom_fields, seed=args.seed)
+    server = MockRDServer(
+        account,
+        token=args.token,
+        host=args.host,
+        port=args.port,
+        latency=args.latency,
+        jitter=args.jitter,
+        rate_limit=args.rate_limit,
+        error_rate=args.error_rate
+    )
+    print(f'Mock RD CRM serving {account.num_deals} deals at {server.url} (token: {args.token})')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
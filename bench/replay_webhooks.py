@@ -0,0 +1,89 @@
+from bench.synthetic import SyntheticAccount
+import requests
+import argparse
+import random
+import json
+import time
+
+def synthetic_events(account: SyntheticAccount, count: int, created: float = 0.2, seed: int = None):
+    '''
+    Returns RD CRM webhook events of count random deals of a synthetic account, updated now (a share
+    of them sent as creations). Serve the same account with bench.mock_rd (same deals, pipelines,
+    custom fields and seed) for the app to resolve their stages and custom fields.
+    '''
+    rng = random.Random(seed)
+    return [
+        {'event_name': 'crm_deal_created' if rng.random() < created else 'crm_deal_updated', 'document': account.deal(index)}
+        for index in account.touch(count, seed=seed)
+    ]
+
+def read_events(path):
+    'Returns the events of a json lines file (one webhook payload per line, e.g. recorded with --dump).'
+    with open(path) as file:
+        return [json.loads(line) for line in file if line.strip() != '']
+
+def replay(events, url: str, batch: int = 1, rate: float = 0.0, max_retries: int = 10, session=None):
+    '''
+    Posts the events to a webhook url, batch events per request and up to rate events per second
+    (0: as fast as possible). Requests answered 503 are retried after their Retry-After seconds.
+    Returns the replay stats.
+    '''
+    session = session or requests.Session()
+    stats = {'events': 0, 'requests': 0, 'retries': 0, 'failed': 0}
+    started = time.perf_counter()
+    for start in range(0, len(events), batch):
+        payload = events[start:start + batch]
+        if rate > 0:
+            # Paces the events at rate per second since the start
+            time.sleep(max(0, started + start / rate - time.perf_counter()))
+        for attempt in range(max_retries + 1):
+            response = session.post(url, json=payload if batch > 1 else payload[0])
+            stats['requests'] += 1
+            if response.status_code != 503 or attempt == max_retries:
+                break
+            stats['retries'] += 1
+            time.sleep(float(response.headers.get('Retry-After', 1)))
+        if response.status_code >= 300:
+            stats['failed'] += len(payload)
+            print(f'Events {start}-{start + len(payload) - 1} failed: {response.status_code} {response.text[:200]}')
+        else:
+            stats['events'] += len(payload)
+    stats['seconds'] = round(time.perf_counter() - started, 3)
+    stats['events_per_second'] = round(stats['events'] / stats['seconds'], 1) if stats['seconds'] > 0 else None
+    return stats
+
+def main():
+    parser = argparse.ArgumentParser(description='Replays RD CRM deal webhook events (recorded or synthetic) against the /webhook/rd endpoint.')
+    parser.add_argument('--url', default='http://127.0.0.1:8080/webhook/rd')
+    parser.add_argument('--secret', default=None, help='WEBHOOK_SECRET of the app.')
+    parser.add_argument('--file', default=None, help='Json lines file of events to replay (default: synthetic events).')
+    parser.add_argument('--events', type=int, default=1000, help='Synthetic events (updated deals).')
+    parser.add_argument('--deals', type=int, default=100000, help='Synthetic account options, as in bench.mock_rd.')
+    parser.add_argument('--pipelines', type=int, default=4)
+    parser.add_argument('--custom-fields', type=int, default=40)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--duplicates', type=float, default=0.0, help='Share of events sent twice (webhook redeliveries).')
+    parser.add_argument('--shuffle', action='store_true', help='Sends the events out of order.')
+    parser.add_argument('--batch', type=int, default=1, help='Events per request.')
+    parser.add_argument('--rate', type=float, default=0.0, help='Events per second (default: as fast as possible).')
+    parser.add_argument('--dump', default=None, help='Writes the events to this json lines file instead of sending them.')
+    args = parser.parse_args()
+    if args.file is not None:
+        events = read_events(args.file)
+    else:
+        account = SyntheticAccount(deals=args.deals, pipelines=args.pipelines, custom_fields=args.custom_fields, seed=args.seed)
+        events = synthetic_events(account, args.events, seed=args.seed)
+    rng = random.Random(args.seed)
+    events = events + rng.sample(events, k=int(len(events) * args.duplicates))
+    if args.shuffle is True:
+        rng.shuffle(events)
+    if args.dump is not None:
+        with open(args.dump, 'w') as file:
+            file.writelines([json.dumps(event) + '\n' for event in events])
+        print(f'{len(events)} events written to {args.dump}')
+        return
+    url = args.url if args.secret is None else f'{args.url}?{requests.compat.urlencode({"secret": args.secret})}'
+    print(json.dumps(replay(events, url, batch=args.batch, rate=args.rate)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,252 @@
+from bench.mock_rd import start_process
+from bench.fake_bigquery import FakeBigQueryClient
+from rd import RDClient, normalize_deals, normalize_deals_products, normalize_deals_contacts
+from cache import MemoryCache
+from jobs import load_all, update_deals
+from workers import NormalizePool
+from parquet_sink import ParquetSink
+import arrow_backend
+import numpy as np
+import tracemalloc
+import tempfile
+import argparse
+import threading
+import time
+import json
+
+SCENARIOS = [
+    'reference',
+    'reference_cached',
+    'extract',
+    'normalize',
+    'normalize_arrow',
+    'extract_sharded',
+    'load_all',
+    'load_all_stream',
+    'load_all_arrow',
+    'load_all_pool',
+    'load_all_parquet',
+    'load_all_tables',
+    'load_all_sharded',
+    'update_deals',
+    'update_deals_incremental'
+]
+
+class RequestStats:
+    'Collects the latency of every RD request made through a client session (response hook).'
+    def __init__(self, session):
+        self.latencies = []
+        self._lock = threading.Lock()
+        session.hooks['response'].append(self.hook)
+
+    def hook(self, response, *args, **kwargs):
+        with self._lock:
+            self.latencies.append(response.elapsed.total_seconds())
+
+    def reset(self):
+        with self._lock:
+            latencies, self.latencies = self.latencies, []
+        return latencies
+
+class Benchmark:
+    '''
+    Runs benchmark stages against a mock RD CRM server and a fake BigQuery client, recording
+    for each stage: seconds, rows processed and throughput, RD requests and their latency
+    percentiles, BigQuery load jobs and seconds, and peak Python memory (tracemalloc).
+    '''
+    def __init__(self, rd_client: RDClient, bq_client: FakeBigQueryClient, memory: bool = True):
+        self.rd_client = rd_client
+        self.bq_client = bq_client
+        self.memory = memory
+        self.requests = RequestStats(rd_client.session)
+        self.records = []
+
+    def measure(self, stage, func, rows=None):
+        '''
+        Runs func() as a stage and records its measures.
+        rows: Rows processed by the stage, or a function of func's result returning them
+        (default: rows loaded in the fake BigQuery).
+        '''
+        self.requests.reset()
+        self.bq_client.reset_stats()
+        if self.memory is True:
+            tracemalloc.start()
+            tracemalloc.reset_peak()
+        started = time.perf_counter()
+        result = func()
+        seconds = time.perf_counter() - started
+        peak = None
+        if self.memory is True:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        if callable(rows):
+            rows = rows(result)
+        elif rows is None:
+            rows = self.bq_client.stats['rows']
+        latencies = np.array(self.requests.reset()) * 1000
+        record = {
+            'stage': stage,
+            'seconds': round(seconds, 3),
+            'rows': int(rows),
+            'rows_per_second': round(rows / seconds, 1) if seconds > 0 else None,
+            'requests': int(len(latencies)),
+            'latency_p50_ms': round(float(np.percentile(latencies, 50)), 1) if len(latencies) > 0 else None,
+            'latency_p95_ms': round(float(np.percentile(latencies, 95)), 1) if len(latencies) > 0 else None,
+            'bq_load_jobs': self.bq_client.stats['load_jobs'],
+            'bq_seconds': round(self.bq_client.stats['seconds'], 3),
+            'peak_memory_mb': round(peak / 2 ** 20, 1) if peak is not None else None
+        }
+        self.records.append(record)
+        print(format_record(record), flush=True)
+        return result
+
+def format_record(record):
+    columns = [
+        ('stage', 26), ('seconds', 9), ('rows', 9), ('rows_per_second', 11), ('requests', 9),
+        ('latency_p50_ms', 8), ('latency_p95_ms', 8), ('bq_load_jobs', 8), ('bq_seconds', 8), ('peak_memory_mb', 9)
+    ]
+    return ' '.join([str(record[column] if record[column] is not None else '-').rjust(width) if column != 'stage' else record[column].ljust(width) for column, width in columns])
+
+def header():
+    names = ['stage', 'seconds', 'rows', 'rows/s', 'requests', 'p50 ms', 'p95 ms', 'bq jobs', 'bq s', 'peak MB']
+    widths = [26, 9, 9, 11, 9, 8, 8, 8, 8, 9]
+    return ' '.join([name.ljust(width) if name == 'stage' else name.rjust(width) for name, width in zip(names, widths)])
+
+def run(args):
+    account_options = {
+        'deals': args.deals,
+        'pipelines': args.pipelines,
+        'custom_fields': args.custom_fields,
+        'fill_rate': args.fill_rate,
+        'seed': args.seed
+    }
+    server, url = start_process(account_options, {'latency': args.latency, 'jitter': args.jitter})
+    rd_client = RDClient(
+        'bench-token',
+        url=url,
+        rate_limit=args.client_rate,
+        burst=args.client_burst,
+        page_window=args.page_window,
+        pipeline_workers=args.pipeline_workers,
+        cache=MemoryCache()
+    )
+    bq_client = FakeBigQueryClient(latency=args.bq_latency)
+    bench = Benchmark(rd_client, bq_client, memory=not args.no_memory)
+    pool = NormalizePool(max_workers=args.normalize_workers)
+    project, dataset = 'bench-project', 'bench_dataset'
+    scenarios = args.scenarios or SCENARIOS
+    dict_pipelines = rd_client.pipelines(output='dict')
+    dict_custom_fields = rd_client.custom_fields(output='dict')
+    print(f'{args.deals} deals, {len(dict_pipelines)} pipelines, {len(dict_custom_fields)} custom fields; mock RD at {url}')
+    print(header())
+    # Largest pipeline (the first one of synthetic accounts), for single pipeline stages
+    pipeline_id = list(dict_pipelines)[0]
+    deals_table_id = f'{project}.{dataset}.deals_{dict_pipelines[pipeline_id]}'
+    raw_deals = {}
+
+    def reference():
+        rd_client.pipelines()
+        rd_client.custom_fields()
+        rd_client.general_stages(dict_pipelines=dict_pipelines)
+        rd_client.sources()
+        rd_client.products()
+        rd_client.teams()
+        rd_client.users()
+        rd_client.deal_lost_reasons()
+        rd_client.campaigns()
+
+    def extract():
+        for id in dict_pipelines:
+            raw_deals[id] = [deal for page in rd_client.pipeline_deal_pages(pipeline_id=id) for deal in page]
+        return sum([len(list_deals) for list_deals in raw_deals.values()])
+
+    def normalize():
+        rows = 0
+        for list_deals in raw_deals.values():
+            rows += normalize_deals(list_deals, dict_custom_fields).shape[0]
+            normalize_deals_products(list_deals)
+            normalize_deals_contacts(list_deals)
+        return rows
+
+    def normalize_arrow():
+        rows = 0
+        for list_deals in raw_deals.values():
+            rows += arrow_backend.deals_table(list_deals, dict_custom_fields).num_rows
+            arrow_backend.deals_products_table(list_deals)
+            arrow_backend.deals_contacts_table(list_deals)
+        return rows
+
+    def load_all_parquet():
+        with tempfile.TemporaryDirectory() as directory:
+            sink = ParquetSink(directory)
+            load_all(rd_client, bq_client, project, dataset, sink=sink)
+            return sum([sink.read(table_id).num_rows for table_id in sink.table_ids()])
+
+    def incremental():
+        rd_client._get('/_bench/touch', {'count': args.touch, 'seed': args.seed})
+        update_deals(rd_client, bq_client, pipeline_id=pipeline_id, deals_table_id=deals_table_id, incremental=True)
+
+    stages = {
+        'reference': (lambda: (rd_client.invalidate_cache(), reference()), lambda result: 0),
+        'reference_cached': (reference, lambda result: 0),
+        'extract': (extract, lambda rows: rows),
+        'normalize': (normalize, lambda rows: rows),
+        'normalize_arrow': (normalize_arrow, lambda rows: rows),
+        'extract_sharded': (
+            lambda: sum([len(rd_client.sharded_deals(pipeline_id=id)) for id in dict_pipelines]),
+            lambda rows: rows
+        ),
+        'load_all': (lambda: load_all(rd_client, bq_client, project, dataset), None),
+        'load_all_stream': (lambda: load_all(rd_client, bq_client, project, dataset, stream=True), None),
+        'load_all_arrow': (lambda: load_all(rd_client, bq_client, project, dataset, backend='arrow'), None),
+        'load_all_pool': (lambda: load_all(rd_client, bq_client, project, dataset, pool=pool), None),
+        'load_all_parquet': (load_all_parquet, lambda rows: rows),
+        'load_all_tables': (lambda: load_all(rd_client, bq_client, project, dataset, products=True, contacts=True), None),
+        'load_all_sharded': (lambda: load_all(rd_client, bq_client, project, dataset, sharded=True), None),
+        'update_deals': (
+            lambda: update_deals(rd_client, bq_client, pipeline_id=pipeline_id, deals_table_id=deals_table_id),
+            None
+        ),
+        'update_deals_incremental': (incremental, None)
+    }
+    try:
+        for stage in scenarios:
+            if stage in ('normalize', 'normalize_arrow') and len(raw_deals) == 0:
+                extract()
+            func, rows = stages[stage]
+            bench.measure(stage, func, rows=rows)
+    finally:
+        pool.shutdown()
+        server.terminate()
+    return bench.records
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks extraction, normalization and loads against a local mock RD CRM and a fake BigQuery.')
+    parser.add_argument('--deals', type=int, default=50000)
+    parser.add_argument('--pipelines', type=int, default=4)
+    parser.add_argument('--custom-fields', type=int, default=40)
+    parser.add_argument('--fill-rate', type=float, default=0.3, help='Share of custom fields set in each deal.')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every mock RD response.')
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--bq-latency', type=float, default=0.0, help='Seconds added to every fake BigQuery job.')
+    parser.add_argument('--client-rate', type=float, default=1000.0, help='RDClient requests per second (RD CRM production pacing is 2).')
+    parser.add_argument('--client-burst', type=int, default=50)
+    parser.add_argument('--page-window', type=int, default=4)
+    parser.add_argument('--pipeline-workers', type=int, default=4)
+    parser.add_argument('--normalize-workers', type=int, default=4, help='Processes of the load_all_pool stage.')
+    parser.add_argument('--touch', type=int, default=500, help='Deals updated before the incremental stage.')
+    parser.add_argument('--no-memory', action='store_true', help='Skips tracemalloc (it slows allocation heavy stages).')
+    parser.add_argument('--json', default=None, help='Path to write the records as json.')
+    parser.add_argument('scenarios', nargs='*', help=f'Stages to run, in order (default: all). Options: {", ".join(SCENARIOS)}.')
+    args = parser.parse_args()
+    invalid = [stage for stage in args.scenarios if stage not in SCENARIOS]
+    if len(invalid) > 0:
+        parser.error(f'Invalid stages: {", ".join(invalid)}')
+    records = run(args)
+    if args.json is not None:
+        with open(args.json, 'w') as file:
+            json.dump({'args': vars(args), 'records': records}, file, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+import statistics
+import subprocess
+import argparse
+import json
+import sys
+import os
+
+# Entry points and the modules of a first job, as imported by fresh interpreters
+TARGETS = {
+    'app': 'import app',
+    'cli': 'import cli',
+    'first_job': 'import app, pandas, requests, pyarrow, google.cloud.bigquery'
+}
+
+def import_seconds(statement, env):
+    'Returns the seconds taken by a fresh interpreter to run an import statement.'
+    code = f'import time; started = time.perf_counter(); {statement}; print(time.perf_counter() - started)'
+    output = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True, check=True)
+    return float(output.stdout.strip().splitlines()[-1])
+
+def slowest_imports(statement, env, top: int = 10):
+    'Returns the (cumulative microseconds, module) of the slowest top level imports of a statement (python -X importtime).'
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement], env=env, capture_output=True, text=True, check=True)
+    imports = []
+    for line in output.stderr.splitlines():
+        parts = line.split('|')
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            imports.append((int(parts[1]), parts[2].rstrip()))
+    return sorted(imports, reverse=True)[:top]
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures the cold import time of the entry points in fresh interpreters.')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=0, help='Also lists the slowest imports of each target (python -X importtime).')
+    parser.add_argument('--json', default=None, help='Path to write the results as json.')
+    args = parser.parse_args()
+    # Background preloading of the app would compete with the measured imports
+    env = {**os.environ, 'PRELOAD_IMPORTS': 'false'}
+    results = {}
+    for target, statement in TARGETS.items():
+        seconds = [import_seconds(statement, env) for _ in range(args.repeat)]
+        results[target] = {'median_seconds': round(statistics.median(seconds), 4), 'min_seconds': round(min(seconds), 4)}
+        print(f'{target.ljust(12)} median {results[target]["median_seconds"]:.3f}s  min {results[target]["min_seconds"]:.3f}s', flush=True)
+        for microseconds, module in (slowest_imports(statement, env, args.top) if args.top > 0 else []):
+            print(f'    {microseconds / 1e6:8.3f}s {module}')
+    if args.json is not None:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,261 @@
+import numpy as np
+import datetime
+import hashlib
+import random
+
+# RD CRM timestamps are in the account timezone (Brasília)
+TIMEZONE = datetime.timezone(datetime.timedelta(hours=-3))
+UTC_OFFSET = -3 * 3600
+DAY = 86400
+
+FIELD_TYPES = ['text', 'option', 'multiple_choice', 'number', 'date']
+WORDS = [
+    'alpha', 'bravo', 'delta', 'echo', 'gold', 'silver', 'north', 'south', 'prime', 'basic',
+    'retail', 'online', 'partner', 'inbound', 'outbound', 'premium', 'trial', 'renewal'
+]
+
+def object_id(kind, index):
+    'Returns a deterministic 24 hex chars id (as RD CRM ids) for the index-th object of a kind.'
+    return hashlib.md5(f'{kind}:{index}'.encode()).hexdigest()[:24]
+
+def format_timestamp(seconds):
+    'Formats epoch seconds as an RD CRM timestamp in the account timezone.'
+    return datetime.datetime.fromtimestamp(int(seconds), TIMEZONE).isoformat(timespec='milliseconds')
+
+class SyntheticAccount:
+    '''
+    Deterministic synthetic RD CRM account: reference entities and any number of deals.
+    Only a few numpy arrays per deal (pipeline, creation and update times, products presence)
+    are kept in memory; the json of each deal is rendered from its index when requested, so
+    accounts scale to hundreds of thousands of deals.
+    deals: Number of deals of the account.
+    pipelines: Number of pipelines, with skewed sizes (the first holds about half of the deals).
+    custom_fields: Number of deal custom fields; fill_rate: share of them set in each deal.
+    days: Deals are created over that number of days up to now.
+    '''
+    def __init__(
+            self,
+            deals: int = 100000,
+            pipelines: int = 4,
+            custom_fields: int = 40,
+            fill_rate: float = 0.3,
+            products: int = 50,
+            users: int = 30,
+            stages: int = 6,
+            days: int = 1095,
+            seed: int = 42
+        ):
+        self.seed = seed
+        self.fill_rate = fill_rate
+        rng = np.random.default_rng(seed)
+        self.now = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
+        created_at = np.sort(rng.integers(self.now - days * DAY, self.now, size=deals))
+        self.created_at = created_at
+        self.updated_at = np.minimum(created_at + rng.exponential(30 * DAY, size=deals).astype(np.int64), self.now)
+        weights = 0.5 ** np.arange(pipelines)
+        self.pipeline = rng.choice(pipelines, size=deals, p=weights / weights.sum())
+        self.has_products = rng.random(size=deals) < 0.4
+
+        self.pipelines = [
+            {'id': object_id('pipeline', index), 'name': f'Pipeline {index + 1}', 'order': index + 1}
+            for index in range(pipelines)
+        ]
+        self.stages = {
+            pipeline['id']: [
+                {
+                    'id': object_id(f'stage:{pipeline["id"]}', index),
+                    'name': f'Stage {index + 1}',
+                    'nickname': f'S{index + 1}',
+                    'order': index + 1,
+                    'objective': None,
+                    'description': None,
+                    'created_at': format_timestamp(self.now - days * DAY),
+                    'updated_at': format_timestamp(self.now - days * DAY),
+                    'deal_pipeline': {'id': pipeline['id'], 'name': pipeline['name']}
+                }
+                for index in range(stages)
+            ]
+            for pipeline in self.pipelines
+        }
+        self.custom_fields = [
+            {
+                'id': object_id('custom_field', index),
+                'label': f'Custom Field {index + 1} {WORDS[index % len(WORDS)].title()}',
+                'type': FIELD_TYPES[index % len(FIELD_TYPES)],
+                'for': 'deal',
+                'required': False,
+                'allow_new': index % 2 == 0,
+                'order': index + 1,
+                'opts': [],
+                'created_at': format_timestamp(self.now - days * DAY),
+                'updated_at': format_timestamp(self.now - days * DAY)
+            }
+            for index in range(custom_fields)
+        ]
+        self.products = [
+            {
+                'id': object_id('product', index),
+                'name': f'Product {index + 1}',
+                'description': f'{WORDS[index % len(WORDS)]} plan',
+                'base_price': float(50 + index * 10),
+                'visible': True,
+                'created_at': format_timestamp(self.now - days * DAY),
+                'updated_at': format_timestamp(self.now - days * DAY)
+            }
+            for index in range(products)
+        ]
+        self.users = [
+            {
+                'id': object_id('user', index),
+                'name': f'User {index + 1}',
+                'nickname': f'U{index + 1}',
+                'email': f'user{index + 1}@example.com',
+                'active': True,
+                'hidden': False,
+                'last_login': format_timestamp(self.now - index * DAY),
+                'created_at': format_timestamp(self.now - days * DAY),
+                'updated_at': format_timestamp(self.now - days * DAY)
+            }
+            for index in range(users)
+        ]
+        self.teams = [
+            {
+                'id': object_id('team', index),
+                'name': f'Team {index + 1}',
+                'created_at': format_timestamp(self.now - days * DAY),
+                'updated_at': format_timestamp(self.now - days * DAY),
+                'team_users': [{'id': user['id'], 'name': user['name']} for user in self.users[index::3]]
+            }
+            for index in range(3)
+        ]
+        self.sources = self._named('source', ['Website', 'Referral', 'Event', 'Ads', 'Outbound'], days)
+        self.lost_reasons = self._named('lost_reason', ['Price', 'Timing', 'Competitor', 'No answer'], days)
+        self.campaigns = self._named('campaign', [f'Campaign {index + 1}' for index in range(12)], days)
+
+    def _named(self, kind, names, days):
+        return [
+            {
+                'id': object_id(kind, index),
+                'name': name,
+                'created_at': format_timestamp(self.now - days * DAY),
+                'updated_at': format_timestamp(self.now - days * DAY)
+            }
+            for index, name in enumerate(names)
+        ]
+
+    @property
+    def num_deals(self):
+        return len(self.created_at)
+
+    def pipeline_index(self, pipeline_id):
+        'Returns the index of a pipeline id, or None if it is unknown.'
+        for index, pipeline in enumerate(self.pipelines):
+            if pipeline['id'] == pipeline_id:
+                return index
+        return None
+
+    def touch(self, count: int, seed: int = None):
+        'Updates count random deals now (to exercise incremental syncs) and returns their indexes.'
+        rng = np.random.default_rng(seed)
+        indexes = rng.choice(self.num_deals, size=min(count, self.num_deals), replace=False)
+        self.now = int(datetime.datetime.now(datetime.timezone.utc).timestamp()) + 1
+        self.updated_at[indexes] = self.now
+        return indexes
+
+    def select(self, pipeline: int = None, products: bool = False, start_day: int = None, end_day: int = None, order: str = None, direction: str = 'asc'):
+        '''
+        Returns the indexes of the deals matching a /deals query, sorted as requested.
+        start_day, end_day: Days since epoch (account timezone) of the created_at window, both inclusive.
+        '''
+        mask = np.ones(self.num_deals, dtype=bool)
+        if pipeline is not None:
+            mask &= self.pipeline == pipeline
+        if products is True:
+            mask &= self.has_products
+        if start_day is not None or end_day is not None:
+            created_day = (self.created_at + UTC_OFFSET) // DAY
+            if start_day is not None:
+                mask &= created_day >= start_day
+            if end_day is not None:
+                mask &= created_day <= end_day
+        indexes = np.flatnonzero(mask)
+        if order == 'updated_at':
+            indexes = indexes[np.argsort(self.updated_at[indexes], kind='stable')]
+        if direction == 'desc':
+            indexes = indexes[::-1]
+        return indexes
+
+    def deal(self, index: int):
+        'Renders the RD CRM json of the index-th deal.'
+        index = int(index)
+        rng = random.Random(self.seed * 1000003 + index)
+        pipeline = self.pipelines[int(self.pipeline[index])]
+        stage = rng.choice(self.stages[pipeline['id']])
+        user = rng.choice(self.users)
+        win = rng.choice([None, None, True, False])
+        created_at = int(self.created_at[index])
+        updated_at = int(self.updated_at[index])
+        deal_products = []
+        if self.has_products[index]:
+            for product in rng.sample(self.products, k=min(len(self.products), rng.randint(1, 3))):
+                amount = rng.randint(1, 10)
+                discount = rng.choice([0.0, 5.0, 10.0])
+                deal_products.append({
+                    'id': object_id(f'deal_product:{index}', product['id']),
+                    'product_id': product['id'],
+                    'name': product['name'],
+                    'description': product['description'],
+                    'base_price': product['base_price'],
+                    'price': product['base_price'],
+                    'amount': amount,
+                    'recurrence': rng.choice(['spare', 'monthly']),
+                    'discount': discount,
+                    'discount_type': 'percentage',
+                    'total': round(product['base_price'] * amount * (1 - discount / 100), 2),
+                    'created_at': format_timestamp(created_at),
+                    'updated_at': format_timestamp(updated_at)
+                })
+        amount_total = sum([product['total'] for product in deal_products])
+        contacts = [
+            {
+                'name': f'Contact {index}-{number}',
+                'title': rng.choice(['CEO', 'Buyer', 'Manager', None]),
+                'emails': [{'email': f'contact{index}.{number}@example.com'}],
+                'phones': [{'phone': f'+55 11 9{rng.randint(10000000, 99999999)}'}] if rng.random() < 0.7 else []
+            }
+            for number in range(rng.randint(0, 2))
+        ]
+        deal_custom_fields = []
+        for field in self.custom_fields:
+            if rng.random() >= self.fill_rate:
+                continue
+            if field['type'] == 'number':
+                value = rng.randint(0, 100000)
+            elif field['type'] == 'multiple_choice':
+                value = rng.sample(WORDS, k=rng.randint(1, 3))
+            elif field['type'] == 'date':
+                value = format_timestamp(created_at + rng.randint(0, 90) * DAY)[:10]
+            else:
+                value = ' '.join(rng.sample(WORDS, k=rng.randint(1, 4)))
+            deal_custom_fields.append({'custom_field_id': field['id'], 'value': value})
+        return {
+            'id': object_id('deal', index),
+            'name': f'Deal {index}',
+            'amount_montly': 0.0,
+            'amount_unique': amount_total,
+            'amount_total': amount_total,
+            'win': win,
+            'closed_at': format_timestamp(updated_at) if win is not None else None,
+            'created_at': format_timestamp(created_at),
+            'updated_at': format_timestamp(updated_at),
+            'rating': rng.randint(1, 5),
+            'deal_stage': {'id': stage['id'], 'name': stage['name'], 'nickname': stage['nickname']},
+            'user': {'id': user['id'], 'name': user['name'], 'email': user['email']},
+            'organization': {'id': object_id('organization', index % 5000), 'name': f'Company {index % 5000}'} if rng.random() < 0.8 else None,
+            'deal_source': rng.choice(self.sources + [None]),
+            'campaign': rng.choice(self.campaigns + [None, None]),
+            'deal_lost_reason': rng.choice(self.lost_reasons) if win is False else None,
+            'deal_products': deal_products,
+            'contacts': contacts,
+            'deal_custom_fields': deal_custom_fields
+        }
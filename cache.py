@@ -0,0 +1,71 @@
+from urllib.parse import quote
+import threading
+import pickle
+import os
+
+
+class MemoryCache:
+    'Thread-safe in-memory cache backend (values live as long as the process).'
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        'Returns the value stored for key, or None.'
+        with self._lock:
+            return self._data.get(key)
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def delete_prefix(self, prefix):
+        'Deletes every key starting with prefix.'
+        with self._lock:
+            for key in [key for key in self._data if key.startswith(prefix)]:
+                del self._data[key]
+
+class DiskCache:
+    'On-disk cache backend: one pickle file per key in a directory (survives restarts and can be shared by processes).'
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, quote(key, safe='') + '.pkl')
+
+    def get(self, key):
+        'Returns the value stored for key, or None (unreadable files are ignored).'
+        try:
+            with open(self._path(key), 'rb') as file:
+                return pickle.load(file)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def set(self, key, value):
+        # Written to a temporary file first, so readers never see a partial file
+        path = self._path(key)
+        temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temp_path, 'wb') as file:
+            pickle.dump(value, file)
+        os.replace(temp_path, path)
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def delete_prefix(self, prefix):
+        'Deletes every key starting with prefix.'
+        quoted_prefix = quote(prefix, safe='')
+        for file_name in os.listdir(self.directory):
+            if file_name.startswith(quoted_prefix) and file_name.endswith('.pkl'):
+                try:
+                    os.remove(os.path.join(self.directory, file_name))
+                except FileNotFoundError:
+                    pass
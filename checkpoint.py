@@ -0,0 +1,91 @@
+import contextvars
+import threading
+import hashlib
+import shutil
+import json
+import time
+import os
+
+# Checkpoint store of the current run (set by RDClient.checkpointing), read by RDClient._paginate
+current_checkpoint = contextvars.ContextVar('current_checkpoint', default=None)
+
+class CheckpointStore:
+    '''
+    On-disk checkpoints of a run, so a failed run can resume where it stopped.
+    Raw pages are spilled as JSONL files (one item per line) per entity and page, and a
+    manifest.json records the completed pages (with their has_more flag) and the loaded tables.
+    '''
+    def __init__(self, directory: str, run_id: str):
+        self.run_id = run_id
+        self.path = os.path.join(directory, run_id)
+        self._manifest_path = os.path.join(self.path, 'manifest.json')
+        self._lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+        if os.path.exists(self._manifest_path):
+            with open(self._manifest_path) as file:
+                self._manifest = json.load(file)
+        else:
+            self._manifest = {'run_id': run_id, 'created_at': time.time(), 'pages': {}, 'tables': []}
+            self._save()
+
+    @staticmethod
+    def entity_key(endpoint, params: dict = None):
+        'Returns the checkpoint entity of a paginated request (endpoint and a hash of its params).'
+        params_hash = hashlib.sha1(json.dumps(params or {}, sort_keys=True).encode()).hexdigest()[:12]
+        return f"{endpoint.strip('/').replace('/', '_')}_{params_hash}"
+
+    def _save(self):
+        'Writes the manifest (caller holds the lock, except on creation).'
+        temp_path = self._manifest_path + '.tmp'
+        with open(temp_path, 'w') as file:
+            json.dump(self._manifest, file)
+        os.replace(temp_path, self._manifest_path)
+
+    def _page_path(self, entity, page):
+        return os.path.join(self.path, 'pages', entity, f'{page:06d}.jsonl')
+
+    def has_page(self, entity, page):
+        with self._lock:
+            return str(page) in self._manifest['pages'].get(entity, {})
+
+    def read_page(self, entity, page):
+        'Returns (items, has_more) of a checkpointed page.'
+        with self._lock:
+            has_more = self._manifest['pages'][entity][str(page)]
+        with open(self._page_path(entity, page)) as file:
+            items = [json.loads(line) for line in file if line.strip()]
+        return items, has_more
+
+    def write_page(self, entity, page, items, has_more):
+        'Spills a page to disk and records it as completed in the manifest.'
+        path = self._page_path(entity, page)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as file:
+            for item in items:
+                file.write(json.dumps(item) + '\n')
+        with self._lock:
+            self._manifest['pages'].setdefault(entity, {})[str(page)] = has_more
+            self._save()
+
+    def is_table_loaded(self, table_id):
+        with self._lock:
+            return table_id in self._manifest['tables']
+
+    def mark_table_loaded(self, table_id):
+        with self._lock:
+            if table_id not in self._manifest['tables']:
+                self._manifest['tables'].append(table_id)
+                self._save()
+
+    def progress(self, progress=None):
+        'Returns a progress callback that marks loaded tables and forwards statuses to progress.'
+        def callback(table_id, status):
+            if status == 'loaded':
+                self.mark_table_loaded(table_id)
+            if progress is not None:
+                progress(table_id, status)
+        return callback
+
+    def clear(self):
+        'Removes the run checkpoints (after the run succeeded).'
+        shutil.rmtree(self.path, ignore_errors=True)
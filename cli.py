@@ -0,0 +1,157 @@
+import time
+IMPORT_STARTED = time.perf_counter()
+import argparse
+import tempfile
+import json
+import sys
+import os
+import metrics
+
+IMPORT_SECONDS = time.perf_counter() - IMPORT_STARTED
+
+# Variables read from the environment when missing from the arguments and the config file
+ENV_VARIABLES = ['RD_CRM_TOKEN', 'BQ_PROJECT_ID', 'BQ_DATASET', 'BQ_CREDENTIALS']
+LOAD_OPTIONS = ['sharded', 'stream', 'skip_unchanged', 'products', 'contacts']
+UPDATE_DEALS_OPTIONS = ['products', 'stream', 'incremental']
+
+def flag(value):
+    'Parses a boolean config value (true or "true").'
+    return value in (True, "True", "true")
+
+def read_config(path):
+    'Returns the variables of a json config file (same keys as the app payloads), or {} if path is None.'
+    if path is None:
+        return {}
+    with open(path) as file:
+        return json.load(file)
+
+def read_credentials(value):
+    'Returns service account credentials from their json content or the path of their .json file (None uses default credentials).'
+    if value is None or isinstance(value, dict):
+        return value
+    if value.lstrip().startswith('{'):
+        return json.loads(value)
+    with open(value) as file:
+        return json.load(file)
+
+def get_config(args):
+    '''
+    Merges the job variables: command line arguments override the config file (--config or the
+    RD_CONFIG environment variable), which overrides the environment variables.
+    '''
+    config = {name: os.environ[name] for name in ENV_VARIABLES if os.environ.get(name) is not None}
+    config.update(read_config(args.config or os.environ.get('RD_CONFIG')))
+    config.update({name: value for name, value in vars(args).items() if value is not None and name not in ('command', 'config')})
+    return config
+
+def get_sink(config):
+    'Returns the local parquet sink of the output_dir config variable, or None to load in BigQuery.'
+    if config.get('output_dir') is None:
+        return None
+    from parquet_sink import ParquetSink
+    return ParquetSink(config['output_dir'], duckdb_path=config.get('duckdb_path'))
+
+def bq_client(config, sink):
+    'Returns the BigQuery client of the job (None when it writes to a local sink).'
+    from clients import get_bq_client
+    if sink is not None:
+        return None
+    return get_bq_client(credentials=read_credentials(config.get('BQ_CREDENTIALS')))
+
+def load(config):
+    'Runs jobs.load_all with the config variables.'
+    # Imported here so --help and config errors don't pay for the heavy dependencies
+    from jobs import load_all
+    from clients import get_rd_client
+    from checkpoint import CheckpointStore
+    for name in ('RD_CRM_TOKEN', 'BQ_PROJECT_ID', 'BQ_DATASET'):
+        if config.get(name) is None:
+            raise ValueError(f'Missing {name}! Please, set it in the arguments, config file or environment.')
+    checkpoint = None
+    if config.get('run_id') is not None:
+        directory = os.environ.get('CHECKPOINT_DIR', os.path.join(tempfile.gettempdir(), 'rd_checkpoints'))
+        checkpoint = CheckpointStore(directory=directory, run_id=config['run_id'])
+    sink = get_sink(config)
+    return load_all(
+        rd_client=get_rd_client(config['RD_CRM_TOKEN']),
+        bq_client=bq_client(config, sink),
+        BQ_PROJECT_ID=config['BQ_PROJECT_ID'],
+        BQ_DATASET=config['BQ_DATASET'],
+        checkpoint=checkpoint,
+        backend=config.get('backend', 'pandas'),
+        sink=sink,
+        **{name: flag(config.get(name, False)) for name in LOAD_OPTIONS}
+    )
+
+def update_deals(config):
+    'Runs jobs.update_deals with the config variables.'
+    from jobs import update_deals
+    from clients import get_rd_client
+    for name in ('RD_CRM_TOKEN', 'pipeline_id'):
+        if config.get(name) is None:
+            raise ValueError(f'Missing {name}! Please, set it in the arguments, config file or environment.')
+    sink = get_sink(config)
+    return update_deals(
+        rd_client=get_rd_client(config['RD_CRM_TOKEN']),
+        bq_client=bq_client(config, sink),
+        pipeline_id=config['pipeline_id'],
+        deals_table_id=config.get('deals_table_id'),
+        prods_table_id=config.get('prods_table_id'),
+        deals=config.get('deals', True) not in (False, "False", "false"),
+        sink=sink,
+        **{name: flag(config.get(name, False)) for name in UPDATE_DEALS_OPTIONS}
+    )
+
+COMMANDS = {'load': load, 'update_deals': update_deals}
+
+def parser():
+    parser = argparse.ArgumentParser(
+        description='Runs a load job from the command line (e.g. Cloud Run Jobs or cron), with the variables of the app payloads.'
+    )
+    parser.add_argument('--config', default=None, help='Json file with the job variables (default: RD_CONFIG environment variable).')
+    parser.add_argument('--token', dest='RD_CRM_TOKEN', default=None, help='RD CRM token (default: RD_CRM_TOKEN).')
+    parser.add_argument('--credentials', dest='BQ_CREDENTIALS', default=None, help='Service account .json file or content (default: BQ_CREDENTIALS, else default credentials).')
+    parser.add_argument('--output-dir', dest='output_dir', default=None, help='Writes the tables as local partitioned parquet files in this directory instead of BigQuery.')
+    parser.add_argument('--duckdb', dest='duckdb_path', default=None, help='With --output-dir, DuckDB database file where the written tables are registered as views.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    load_parser = commands.add_parser('load', help='Loads all tables of an account (jobs.load_all).')
+    load_parser.add_argument('--project', dest='BQ_PROJECT_ID', default=None, help='Default: BQ_PROJECT_ID.')
+    load_parser.add_argument('--dataset', dest='BQ_DATASET', default=None, help='Default: BQ_DATASET.')
+    load_parser.add_argument('--run-id', dest='run_id', default=None, help='Checkpoints the run (CHECKPOINT_DIR) to resume it with the same id.')
+    load_parser.add_argument('--backend', dest='backend', default=None, choices=['pandas', 'arrow'], help='Tables backend (default: pandas).')
+    for name in LOAD_OPTIONS:
+        load_parser.add_argument(f'--{name.replace("_", "-")}', dest=name, action='store_const', const=True, default=None)
+    update_parser = commands.add_parser('update_deals', help='Updates the deals and/or deals products tables of a pipeline (jobs.update_deals).')
+    update_parser.add_argument('--pipeline-id', dest='pipeline_id', default=None)
+    update_parser.add_argument('--deals-table-id', dest='deals_table_id', default=None)
+    update_parser.add_argument('--prods-table-id', dest='prods_table_id', default=None)
+    update_parser.add_argument('--no-deals', dest='deals', action='store_const', const=False, default=None)
+    for name in UPDATE_DEALS_OPTIONS:
+        update_parser.add_argument(f'--{name.replace("_", "-")}', dest=name, action='store_const', const=True, default=None)
+    return parser
+
+def main(argv=None):
+    '''
+    Runs the command and returns the exit code (1 if the job fails). The run logs a structured json
+    line (see metrics.run) including the seconds spent importing the cli and the heavy dependencies.
+    '''
+    args = parser().parse_args(argv)
+    config = get_config(args)
+    command = COMMANDS[args.command]
+    try:
+        with metrics.run(args.command, entry_point='cli', import_seconds=round(IMPORT_SECONDS, 4)) as stats:
+            try:
+                result = command(config)
+            finally:
+                # Seconds of the modules imported on first use during the job (see lazy.LazyModule)
+                stats.fields['lazy_import_seconds'] = metrics.IMPORT_SECONDS.values()
+    except Exception as error:
+        for table_id, table_error in getattr(error, 'errors', {}).items():
+            print(f'{table_id}: {table_error}', file=sys.stderr)
+        return 1
+    if result is not None:
+        print(json.dumps(result, default=str))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
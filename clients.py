@@ -0,0 +1,81 @@
+from cachetools import TTLCache
+from rd import RDClient
+from cache import MemoryCache
+from jobs import bq_service_account_auth
+from lazy import LazyModule
+import threading
+import hashlib
+import json
+import os
+
+bigquery = LazyModule('google.cloud.bigquery')
+
+def credentials_key(credentials):
+    'Returns a sha256 hash identifying credentials (token string or service account dictionary).'
+    if not isinstance(credentials, str):
+        credentials = json.dumps(credentials, sort_keys=True)
+    return hashlib.sha256(credentials.encode()).hexdigest()
+
+class ClientCache:
+    '''
+    Thread-safe cache of authenticated clients, keyed by a hash of their credentials.
+    Clients expire after ttl seconds and the least recently used are evicted beyond maxsize.
+    A client is created once per key: concurrent requests for a missing key wait for the first one,
+    so e.g. the jobs of a token share one RDClient (and its rate limiter).
+    '''
+    def __init__(self, maxsize: int = 64, ttl: float = 3600):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+        self._key_locks = {}  # {key: lock held while its client is created}
+
+    def get_or_create(self, key, factory):
+        'Returns the cached client for key, or creates it with factory() (clients failing to be created are not cached).'
+        with self._lock:
+            client = self._cache.get(key)
+            if client is not None:
+                return client
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            with self._lock:
+                client = self._cache.get(key)  # Created by another thread while waiting
+            if client is None:
+                client = factory()
+                with self._lock:
+                    self._cache[key] = client
+        return client
+
+    def invalidate(self, key=None):
+        'Removes a client (or all of them) from the cache.'
+        with self._lock:
+            if key is None:
+                self._cache.clear()
+            else:
+                self._cache.pop(key, None)
+
+# Process-wide caches (CLIENTS_CACHE_TTL in seconds, CLIENTS_CACHE_SIZE clients of each kind)
+rd_clients = ClientCache(
+    maxsize=int(os.environ.get('CLIENTS_CACHE_SIZE', 64)),
+    ttl=float(os.environ.get('CLIENTS_CACHE_TTL', 3600))
+)
+bq_clients = ClientCache(
+    maxsize=int(os.environ.get('CLIENTS_CACHE_SIZE', 64)),
+    ttl=float(os.environ.get('CLIENTS_CACHE_TTL', 3600))
+)
+
+# Process-wide cache of RD reference entities (custom fields, pipelines, users...), shared by the RDClients
+reference_cache = MemoryCache()
+
+def get_rd_client(token):
+    'Returns a validated RDClient for the token, reusing the cached one (and its connection pool) when available.'
+    if token is None:
+        raise ValueError('Please, insert an access token.')
+    return rd_clients.get_or_create(credentials_key(token), lambda: RDClient(token, cache=reference_cache))
+
+def get_bq_client(credentials: dict = None):
+    'Returns a BigQuery client from service account credentials (or default credentials if None), reusing cached clients.'
+    if credentials is None:
+        return bq_clients.get_or_create('default', bigquery.Client)
+    return bq_clients.get_or_create(
+        credentials_key(credentials),
+        lambda: bq_service_account_auth(credentials=credentials)
+    )
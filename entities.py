@@ -0,0 +1,143 @@
+from lazy import LazyModule
+
+pd = LazyModule('pandas')
+
+# Column dtypes of entity specs: pandas dtype (datetimes are parsed with pd.to_datetime) and BigQuery type
+DTYPES = {
+    'str': (str, 'STRING'),
+    'bool': (bool, 'BOOLEAN'),
+    'int': (int, 'INTEGER'),
+    'float': (float, 'FLOAT'),
+    'datetime': (None, 'TIMESTAMP')
+}
+TIMESTAMPS = {'created_at': 'datetime', 'updated_at': 'datetime'}
+
+def cast_columns(df, dtypes: dict):
+    '''
+    Types a dataframe in bulk: columns in dtypes are cast to their dtype ('datetime', 'bool',
+    'int' or 'float') and any other column to str, with a single astype for the non datetime columns.
+    '''
+    for column in [column for column in df.columns if dtypes.get(column) == 'datetime']:
+        df[column] = pd.to_datetime(df[column])
+    casts = {column: DTYPES[dtypes.get(column, 'str')][0] for column in df.columns if dtypes.get(column) != 'datetime'}
+    if len(casts) > 0:
+        df = df.astype(casts)
+    return df
+
+class EntitySpec:
+    '''
+    Declarative description of an RD CRM reference entity, used by RDClient.entity to fetch and type it.
+    name: Entity name (also its key in the RDClient cache, when it has a cache TTL).
+    endpoint: API endpoint; params: default request params.
+    list_key: Key of the items list in the response json (None when the response is the list).
+    paginated: Whether the endpoint is paginated (page/has_more) instead of answered in a single response.
+    dtypes: {column: 'datetime', 'bool', 'int' or 'float'} (any other column is typed as str).
+    drop_columns: Raw keys dropped before normalization; transform: Optional function of each raw item.
+    table: BigQuery table built from the entity by jobs.load_all (None if it has no table).
+    '''
+    def __init__(
+            self,
+            name: str,
+            endpoint: str,
+            list_key: str = None,
+            paginated: bool = False,
+            params: dict = None,
+            dtypes: dict = None,
+            drop_columns: list = None,
+            transform=None,
+            table: str = None
+        ):
+        self.name = name
+        self.endpoint = endpoint
+        self.list_key = list_key
+        self.paginated = paginated
+        self.params = params or {}
+        self.dtypes = dtypes or {}
+        self.drop_columns = drop_columns or []
+        self.transform = transform
+        self.table = table
+
+    def items(self, response_json):
+        'Returns the list of raw items of a (non paginated) response json.'
+        return response_json if self.list_key is None else response_json[self.list_key]
+
+    def prepare(self, items):
+        'Returns the raw items transformed and without the dropped keys (before flattening and typing).'
+        if self.transform is not None:
+            items = [self.transform(item) for item in items]
+        if len(self.drop_columns) > 0:
+            items = [{key: value for key, value in item.items() if key not in self.drop_columns} for item in items]
+        return items
+
+    def to_frame(self, items):
+        'Returns the typed dataframe of a list of raw items.'
+        df = pd.json_normalize(self.prepare(items))
+        df.columns = [column.replace('.', '_') for column in df.columns]
+        return cast_columns(df, self.dtypes)
+
+    def bq_types(self):
+        'Returns the BigQuery types of the typed columns of the entity table.'
+        return {column: DTYPES[dtype][1] for column, dtype in self.dtypes.items()}
+
+def team_row(team):
+    'Flattens a team with the ids and names of its users joined by commas.'
+    return {
+        'id': team['id'],
+        'name': team['name'],
+        'created_at': team['created_at'],
+        'updated_at': team['updated_at'],
+        'user_ids': ', '.join([user['id'] for user in team['team_users']]),
+        'usernames': ', '.join([user['name'] for user in team['team_users']])
+    }
+
+ENTITIES = {spec.name: spec for spec in [
+    EntitySpec(
+        'custom_fields',
+        '/custom_fields',
+        dtypes={**TIMESTAMPS, 'required': 'bool', 'allow_new': 'bool', 'order': 'int'},
+        table='custom_fields'
+    ),
+    EntitySpec(
+        'pipelines',
+        '/deal_pipelines',
+        params={'limit': 200},
+        dtypes={'order': 'int'},
+        drop_columns=['deal_stages'],
+        table='pipelines'
+    ),
+    EntitySpec(
+        'pipeline_stages',
+        '/deal_stages',
+        list_key='deal_stages',
+        params={'limit': 12},
+        dtypes={**TIMESTAMPS, 'order': 'int'},
+        table='stages'
+    ),
+    EntitySpec('sources', '/deal_sources', list_key='deal_sources', paginated=True, params={'limit': 200}, dtypes=TIMESTAMPS, table='sources'),
+    EntitySpec(
+        'products',
+        '/products',
+        list_key='products',
+        params={'limit': 200},
+        dtypes={**TIMESTAMPS, 'base_price': 'float', 'visible': 'bool'},
+        table='products'
+    ),
+    EntitySpec('teams', '/teams', list_key='teams', dtypes=TIMESTAMPS, transform=team_row, table='teams'),
+    EntitySpec(
+        'users',
+        '/users',
+        list_key='users',
+        dtypes={**TIMESTAMPS, 'last_login': 'datetime', 'active': 'bool', 'hidden': 'bool'},
+        table='users'
+    ),
+    EntitySpec(
+        'deal_lost_reasons',
+        '/deal_lost_reasons',
+        list_key='deal_lost_reasons',
+        paginated=True,
+        params={'limit': 200},
+        dtypes=TIMESTAMPS,
+        table='deal_lost_reasons'
+    ),
+    EntitySpec('campaigns', '/campaigns', list_key='campaigns', paginated=True, params={'limit': 200}, dtypes=TIMESTAMPS, table='campaigns')
+]}
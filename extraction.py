@@ -0,0 +1,181 @@
+from rd import RDClient, normalize_deals, normalize_deals_products, normalize_deals_contacts, drop_empty_custom_fields
+from lazy import LazyModule
+from collections import deque
+import metrics
+import copy
+import time
+
+pd = LazyModule('pandas')
+arrow_backend = LazyModule('arrow_backend')
+
+# Tables that can be built from a pipeline deals scan
+PIPELINE_TABLES = ['deals', 'deals_products', 'deals_contacts']
+
+# Table backends: 'pandas' builds dataframes, 'arrow' builds pyarrow.Tables straight from the json (see arrow_backend)
+BACKENDS = ['pandas', 'arrow']
+
+class PagesCollector:
+    'Collector of the tables normalized from each page, which can also run on pool workers (see scan_pipeline).'
+    def empty(self):
+        'Returns a copy of the collector without pages, to consume a page in a pool worker.'
+        collector = copy.copy(self)
+        collector._dfs = []
+        return collector
+
+    def merge(self, collector):
+        'Adds the pages consumed by a copy of the collector (see empty).'
+        self._dfs.extend(collector._dfs)
+
+class DealsCollector(PagesCollector):
+    'Normalizes each deals page into the pipeline deals table.'
+    entity = 'deals'
+
+    def __init__(self, dict_custom_fields, backend: str = 'pandas'):
+        self.dict_custom_fields = dict_custom_fields
+        self.backend = backend
+        self._dfs = []
+
+    def consume(self, list_deals):
+        if len(list_deals) > 0:
+            if self.backend == 'arrow':
+                self._dfs.append(arrow_backend.deals_table(list_deals, self.dict_custom_fields, drop_empty=False))
+            else:
+                self._dfs.append(normalize_deals(list_deals, self.dict_custom_fields, drop_empty=False))
+
+    def result(self):
+        if self.backend == 'arrow':
+            table = arrow_backend.drop_empty_custom_fields(arrow_backend.concat_tables(self._dfs))
+            return arrow_backend.encode_low_cardinality(table)
+        if len(self._dfs) == 0:
+            return pd.DataFrame()
+        return drop_empty_custom_fields(pd.concat(self._dfs, ignore_index=True))
+
+class ProductsCollector(PagesCollector):
+    'Normalizes the products of each deals page into the deals products table.'
+    entity = 'deals_products'
+
+    def __init__(self, backend: str = 'pandas'):
+        self.backend = backend
+        self._dfs = []
+
+    def consume(self, list_deals):
+        if self.backend == 'arrow':
+            df_deals_prods = arrow_backend.deals_products_table(list_deals)
+        else:
+            df_deals_prods = normalize_deals_products(list_deals)
+        if df_deals_prods.shape[0] > 0:
+            self._dfs.append(df_deals_prods)
+
+    def result(self):
+        if self.backend == 'arrow':
+            return arrow_backend.encode_low_cardinality(arrow_backend.concat_tables(self._dfs))
+        if len(self._dfs) == 0:
+            return pd.DataFrame()
+        return pd.concat(self._dfs, ignore_index=True)
+
+class ContactsCollector(PagesCollector):
+    'Normalizes the contacts of each deals page into the deals contacts table.'
+    entity = 'deals_contacts'
+
+    def __init__(self, backend: str = 'pandas'):
+        self.backend = backend
+        self._dfs = []
+
+    def consume(self, list_deals):
+        if self.backend == 'arrow':
+            df_deals_contacts = arrow_backend.deals_contacts_table(list_deals)
+        else:
+            df_deals_contacts = normalize_deals_contacts(list_deals)
+        if df_deals_contacts.shape[0] > 0:
+            self._dfs.append(df_deals_contacts)
+
+    def result(self):
+        if self.backend == 'arrow':
+            return arrow_backend.encode_low_cardinality(arrow_backend.concat_tables(self._dfs))
+        if len(self._dfs) == 0:
+            return pd.DataFrame()
+        return pd.concat(self._dfs, ignore_index=True)
+
+def consume_page(collectors, list_deals):
+    'Runs collectors (empty copies, in a pool worker) on a page and returns them with the seconds spent by each one.'
+    seconds = []
+    for collector in collectors:
+        started = time.perf_counter()
+        collector.consume(list_deals)
+        seconds.append(time.perf_counter() - started)
+    return collectors, seconds
+
+def scan_pipeline(rd_client: RDClient, pipeline_id, collectors: list, sharded: bool = False, pool=None):
+    '''
+    Scans the deals of a pipeline once, handing each raw page to every collector
+    (any object with a consume(list_deals) method). The dict_custom_fields of the collectors
+    normalizing deals are refreshed when a page has unknown custom fields.
+    sharded: Scans by created_at date windows (the whole deduplicated scan is handed as one page).
+    pool: Optional workers.NormalizePool: pages (in batches) are consumed by copies of the collectors
+    in worker processes while the next pages are fetched, and merged back in page order. Only used
+    when every collector is a PagesCollector (e.g. not with the stream writer).
+    '''
+    if sharded is True:
+        pages = [rd_client.sharded_deals(pipeline_id=pipeline_id)]
+    else:
+        pages = rd_client.pipeline_deal_pages(pipeline_id=pipeline_id)
+    if pool is not None and not all([isinstance(collector, PagesCollector) for collector in collectors]):
+        pool = None
+    pending = deque()
+
+    def merge_next():
+        page_collectors, seconds = pending.popleft().result()
+        for collector, page_collector, collector_seconds in zip(collectors, page_collectors, seconds):
+            collector.merge(page_collector)
+            metrics.record_stage('normalize', collector.entity, collector_seconds, detail=pipeline_id)
+
+    # Time waiting for pages is recorded as the extract stage, and each collector as a normalize stage
+    for page in metrics.timed_pages(pages, 'deals', detail=pipeline_id):
+        for collector in collectors:
+            if getattr(collector, 'dict_custom_fields', None) is not None:
+                # Custom fields created after the (cached) custom fields were fetched
+                rd_client.refresh_custom_fields(page, collector.dict_custom_fields)
+        if pool is None:
+            for collector in collectors:
+                with metrics.stage('normalize', getattr(collector, 'entity', 'deals'), detail=pipeline_id):
+                    collector.consume(page)
+            continue
+        for batch in pool.batches(page):
+            pending.append(pool.submit(consume_page, [collector.empty() for collector in collectors], batch))
+            while len(pending) > pool.max_pending:
+                merge_next()
+    while len(pending) > 0:
+        merge_next()
+
+def extract_pipeline_tables(
+        rd_client: RDClient,
+        pipeline_id,
+        dict_custom_fields: dict = None,
+        tables: list = None,
+        sharded: bool = False,
+        backend: str = 'pandas',
+        pool=None
+    ):
+    '''
+    Returns a dictionary {table: dataframe} of the requested pipeline tables (deals, deals_products
+    and/or deals_contacts), all built from a single scan of the pipeline deals.
+    backend: 'pandas' or 'arrow' (tables are pyarrow.Tables, see arrow_backend).
+    pool: Optional workers.NormalizePool normalizing the pages in worker processes.
+    '''
+    tables = tables or ['deals']
+    invalid_tables = [table for table in tables if table not in PIPELINE_TABLES]
+    if len(invalid_tables) > 0:
+        raise ValueError(f'Invalid tables {invalid_tables}! Please call the options: {PIPELINE_TABLES}')
+    if backend not in BACKENDS:
+        raise ValueError(f'Invalid backend! Please call one of the options: {BACKENDS}')
+    collectors = {}
+    if 'deals' in tables:
+        if dict_custom_fields is None:
+            dict_custom_fields = rd_client.custom_fields(output='dict')
+        collectors['deals'] = DealsCollector(dict_custom_fields, backend=backend)
+    if 'deals_products' in tables:
+        collectors['deals_products'] = ProductsCollector(backend=backend)
+    if 'deals_contacts' in tables:
+        collectors['deals_contacts'] = ContactsCollector(backend=backend)
+    scan_pipeline(rd_client, pipeline_id=pipeline_id, collectors=list(collectors.values()), sharded=sharded, pool=pool)
+    return {table: collector.result() for table, collector in collectors.items()}
@@ -0,0 +1,111 @@
+from lazy import LazyModule
+import datetime
+import hashlib
+import json
+
+bigquery = LazyModule('google.cloud.bigquery')
+exceptions = LazyModule('google.cloud.exceptions')
+pd = LazyModule('pandas')
+pa = LazyModule('pyarrow')
+arrow_backend = LazyModule('arrow_backend')
+
+def fingerprint(df):
+    '''
+    Returns a stable content hash (sha256) of a dataframe: its columns, dtypes and row values
+    (pandas row hashes, which are the same across processes; rows order is part of the content).
+    Arrow tables (arrow backend) are hashed from their schema and serialized columns.
+    '''
+    digest = hashlib.sha256()
+    if arrow_backend.is_table(df):
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, df.schema) as writer:
+            writer.write_table(df.combine_chunks())
+        digest.update(sink.getvalue())
+        return digest.hexdigest()
+    digest.update(json.dumps([[str(column), str(dtype)] for column, dtype in df.dtypes.items()]).encode())
+    digest.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+class BigQueryFingerprintStore:
+    '''
+    Fingerprints of the loaded tables kept in a small BigQuery state table (table_id, fingerprint,
+    rows, loaded_at), usually in the dataset of the tables, so every service instance shares them.
+    '''
+    COLUMNS = [('table_id', 'STRING'), ('fingerprint', 'STRING'), ('rows', 'INTEGER'), ('loaded_at', 'TIMESTAMP')]
+
+    def __init__(self, client, table_id: str):
+        self.client = client
+        self.table_id = table_id
+        self._state = None  # State table rows, read on first use
+
+    def _read(self):
+        if self._state is None:
+            try:
+                rows = self.client.query(f'SELECT table_id, fingerprint, rows, loaded_at FROM `{self.table_id}`').result()
+                self._state = {row['table_id']: dict(row) for row in rows}
+            except exceptions.NotFound:
+                self._state = {}
+        return self._state
+
+    def get(self, table_ids):
+        'Returns {table_id: fingerprint} of the given tables that have one.'
+        state = self._read()
+        return {table_id: state[table_id]['fingerprint'] for table_id in table_ids if table_id in state}
+
+    def update(self, dict_fingerprints: dict, dict_rows: dict = None):
+        'Records the fingerprints of loaded tables (rewrites the state table in a single load job).'
+        if len(dict_fingerprints) == 0:
+            return
+        state = dict(self._read())
+        now = datetime.datetime.now(datetime.timezone.utc)
+        for table_id, table_fingerprint in dict_fingerprints.items():
+            state[table_id] = {
+                'table_id': table_id,
+                'fingerprint': table_fingerprint,
+                'rows': (dict_rows or {}).get(table_id),
+                'loaded_at': now
+            }
+        self._write(state)
+
+    def _write(self, state):
+        schema = [bigquery.SchemaField(name, field_type) for name, field_type in self.COLUMNS]
+        df_state = pd.DataFrame(list(state.values()), columns=[name for name, field_type in self.COLUMNS])
+        df_state['rows'] = df_state['rows'].astype('Int64')
+        df_state['loaded_at'] = pd.to_datetime(df_state['loaded_at'], utc=True)
+        job_config = bigquery.LoadJobConfig(schema=schema, write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE)
+        self.client.load_table_from_dataframe(df_state, self.table_id, job_config=job_config).result()
+        self._state = state
+
+    def clear(self, table_ids=None):
+        'Forgets the fingerprints of some tables (or all of them), forcing their next load.'
+        state = dict(self._read())
+        for table_id in (list(state) if table_ids is None else table_ids):
+            state.pop(table_id, None)
+        if len(state) == 0:
+            self.client.delete_table(self.table_id, not_found_ok=True)
+            self._state = {}
+        else:
+            self._write(state)
+
+class CacheFingerprintStore:
+    'Fingerprints of the loaded tables kept in a local cache backend (cache.MemoryCache or cache.DiskCache).'
+    def __init__(self, cache):
+        self.cache = cache
+
+    def get(self, table_ids):
+        'Returns {table_id: fingerprint} of the given tables that have one.'
+        fingerprints = {table_id: self.cache.get(f'fingerprint:{table_id}') for table_id in table_ids}
+        return {table_id: value for table_id, value in fingerprints.items() if value is not None}
+
+    def update(self, dict_fingerprints: dict, dict_rows: dict = None):
+        'Records the fingerprints of loaded tables.'
+        for table_id, table_fingerprint in dict_fingerprints.items():
+            self.cache.set(f'fingerprint:{table_id}', table_fingerprint)
+
+    def clear(self, table_ids=None):
+        'Forgets the fingerprints of some tables (or all of them), forcing their next load.'
+        if table_ids is None:
+            self.cache.delete_prefix('fingerprint:')
+            return
+        for table_id in table_ids:
+            self.cache.delete(f'fingerprint:{table_id}')
@@ -1,6 +1,62 @@
-from google.cloud import bigquery
-from google.oauth2 import service_account
 from rd import RDClient
+from extraction import scan_pipeline, extract_pipeline_tables, ProductsCollector, ContactsCollector, BACKENDS
+from schemas import schema_cache, account_key
+from checkpoint import CheckpointStore
+from fingerprints import fingerprint, BigQueryFingerprintStore
+from lazy import LazyModule
+from workers import normalize_pool
+import metrics
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from collections import Counter, OrderedDict, deque
+import contextlib
+import contextvars
+import threading
+import datetime
+import time
+import uuid
+import os
+
+bigquery = LazyModule('google.cloud.bigquery')
+exceptions = LazyModule('google.cloud.exceptions')
+service_account = LazyModule('google.oauth2.service_account')
+streaming = LazyModule('streaming')  # Builds pyarrow schemas at import
+arrow_backend = LazyModule('arrow_backend')
+
+# BigQuery load types to standard SQL types, used to cast staged columns in MERGE statements
+SQL_TYPES = {
+    'INTEGER': 'INT64',
+    'FLOAT': 'FLOAT64',
+    'BOOLEAN': 'BOOL'
+}
+
+# Staging tables of merges expire after this time, so tables left by a crashed merge are removed
+STAGING_EXPIRATION = datetime.timedelta(hours=1)
+
+# Process-wide cap of BigQuery load jobs in flight, shared by all runs and accounts (BQ_MAX_LOAD_JOBS)
+bq_load_slots = threading.BoundedSemaphore(int(os.environ.get('BQ_MAX_LOAD_JOBS', 8)))
+
+# load_all options that each account of a batch can set
+ACCOUNT_OPTIONS = ('sharded', 'stream', 'skip_unchanged', 'products', 'contacts', 'max_concurrent_loads', 'backend')
+
+class LoadJobsError(RuntimeError):
+    'Raised when one or more tables of a batch of load jobs failed, after all of them finished.'
+    def __init__(self, errors: dict):
+        self.errors = errors  # {table_id: exception}
+        details = '; '.join([f'{table_id}: {error}' for table_id, error in errors.items()])
+        super().__init__(f'{len(errors)} table(s) failed to load. {details}')
+
+class AccountsLoadError(RuntimeError):
+    'Raised when one or more accounts of a batch failed to load, after all of them finished.'
+    def __init__(self, errors: dict, result: dict):
+        self.errors = errors  # {account: exception}
+        self.result = result  # Batch report with the timings of every account
+        details = '; '.join([f'{account}: {error}' for account, error in errors.items()])
+        super().__init__(f'{len(errors)} account(s) failed to load. {details}')
+
+def report_progress(progress, table_id, status):
+    'Calls the progress callback, if any, with the status of a table (loading, loaded or failed).'
+    if progress is not None:
+        progress(table_id, status)
 
 def bq_service_account_auth(credentials):
     '''
@@ -11,51 +67,516 @@ def bq_service_account_auth(credentials):
     client = bigquery.Client(credentials=credentials)
     return client
 
-def df_to_bq(table_id, df, write_mode, client):
-    '''Takes a dataframe and writes it in a BigQuery table.'''
+def table_schema(rd_client: RDClient, entity: str, df):
+    'Returns the cached explicit BigQuery schema of a dataframe (or arrow table) from a RD CRM table entity (e.g. "users", "deals").'
+    columns = df.column_names if arrow_backend.is_table(df) else df.columns
+    return schema_cache.get(account=account_key(rd_client.token), entity=entity, columns=columns)
+
+def df_to_bq(table_id, df, write_mode, client, schema: list = None, progress=None):
+    '''
+    Takes a dataframe (or an arrow table, see arrow_backend) and writes it in a BigQuery table
+    (schema: explicit list of SchemaField, skips inference).
+    '''
     if write_mode == 'truncate':
-        job_config = bigquery.LoadJobConfig(write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE)
+        job_config = bigquery.LoadJobConfig(schema=schema, write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE)
     elif write_mode == 'append':
-        job_config = bigquery.LoadJobConfig(write_disposition=bigquery.WriteDisposition.WRITE_APPEND)
+        job_config = bigquery.LoadJobConfig(schema=schema, write_disposition=bigquery.WriteDisposition.WRITE_APPEND)
     else:
         print("Invalid write mode value. \nPlease insert 'truncate' or 'append'.")
-    job = client.load_table_from_dataframe(df, table_id, job_config=job_config)
-    job.result()
-
-
-def load_all(rd_client, bq_client, BQ_PROJECT_ID, BQ_DATASET):
-    'Loads all dataframes in a specified BigQuery dataset.'
-    # Creating dataframes
-    df_pipelines, dict_pipelines = rd_client.pipelines()
-    df_custom_fields, dict_custom_fields = rd_client.custom_fields()
-    df_stages = rd_client.general_stages(dict_pipelines=dict_pipelines)
-    df_sources = rd_client.sources()
-    df_products = rd_client.products()
-    df_teams = rd_client.teams()
-    df_users = rd_client.users()
-    df_deal_lost_reasons = rd_client.deal_lost_reasons()
-    df_campaigns = rd_client.campaigns()
-
-    # Dictionary of all dataframes to load
-    dict_dfs = {
-        'pipelines': df_pipelines,
-        'custom_fields': df_custom_fields,
-        'stages': df_stages,
-        'sources': df_sources,
-        'products': df_products,
-        'teams': df_teams,
-        'users': df_users,
-        'deal_lost_reasons': df_deal_lost_reasons,
-        'campaigns': df_campaigns
-    }
-    # Dictionary of pipeline deals dataframes
-    dict_deals_dfs = rd_client.all_pipeline_deals(dict_custom_fields=dict_custom_fields, dict_pipelines=dict_pipelines)
-    dict_dfs.update(dict_deals_dfs)
-
-    for table_name, df in dict_dfs.items():
-        table_id = f'{BQ_PROJECT_ID}.{BQ_DATASET}.{table_name}'
-        if df.shape != (0, 0):
-            df_to_bq(table_id=table_id, df=df, write_mode='truncate', client=bq_client)
+    report_progress(progress, table_id, 'loading')
+    started = time.perf_counter()
+    try:
+        with bq_load_slots:
+            if arrow_backend.is_table(df):
+                # Arrow tables are written to parquet as they are, without the client dataframe conversion
+                job_config.source_format = bigquery.SourceFormat.PARQUET
+                job = client.load_table_from_file(arrow_backend.to_parquet(df), table_id, job_config=job_config)
+            else:
+                job = client.load_table_from_dataframe(df, table_id, job_config=job_config)
+            job.result()
+    except Exception:
+        metrics.record_load(table_id, 'failed', time.perf_counter() - started)
+        report_progress(progress, table_id, 'failed')
+        raise
+    metrics.record_load(table_id, 'loaded', time.perf_counter() - started, rows=df.shape[0])
+    report_progress(progress, table_id, 'loaded')
+
+def dfs_to_bq(dict_loads: dict, write_mode, client, max_in_flight: int = 4, progress=None):
+    '''
+    Writes dataframes in BigQuery tables with up to max_in_flight load jobs running at once.
+    dict_loads: {table_id: (df, schema)}.
+    Waits for all jobs and raises LoadJobsError with the errors of every failed table.
+    '''
+    write_tables(BigQuerySink(client), dict_loads=dict_loads, write_mode=write_mode, max_in_flight=max_in_flight, progress=progress)
+
+def write_tables(sink, dict_loads: dict, write_mode, max_in_flight: int = 4, progress=None):
+    '''
+    Writes dataframes in the tables of a sink (see Sink) with up to max_in_flight writes running at once.
+    dict_loads: {table_id: (df, schema)}.
+    Waits for all writes and raises LoadJobsError with the errors of every failed table.
+    '''
+    errors = {}
+    with ThreadPoolExecutor(max_workers=max(1, max_in_flight)) as executor:
+        futures = {
+            executor.submit(contextvars.copy_context().run, sink.write, table_id=table_id, df=df, write_mode=write_mode, schema=schema, progress=progress): table_id
+            for table_id, (df, schema) in dict_loads.items()
+        }
+        for future in as_completed(futures):
+            if future.exception() is not None:
+                errors[futures[future]] = future.exception()
+    if len(errors) > 0:
+        raise LoadJobsError(errors)
+
+def file_to_bq(table_id, path, write_mode, client, progress=None):
+    '''Takes a local parquet file and writes it in a BigQuery table.'''
+    if write_mode == 'truncate':
+        write_disposition = bigquery.WriteDisposition.WRITE_TRUNCATE
+    elif write_mode == 'append':
+        write_disposition = bigquery.WriteDisposition.WRITE_APPEND
+    else:
+        raise ValueError("Invalid write mode value. Please insert 'truncate' or 'append'.")
+    job_config = bigquery.LoadJobConfig(
+        source_format=bigquery.SourceFormat.PARQUET,
+        write_disposition=write_disposition
+    )
+    report_progress(progress, table_id, 'loading')
+    started = time.perf_counter()
+    try:
+        with bq_load_slots:
+            with open(path, 'rb') as file:
+                job = client.load_table_from_file(file, table_id, job_config=job_config)
+            job.result()
+    except Exception:
+        metrics.record_load(table_id, 'failed', time.perf_counter() - started)
+        report_progress(progress, table_id, 'failed')
+        raise
+    metrics.record_load(table_id, 'loaded', time.perf_counter() - started, rows=getattr(job, 'output_rows', None))
+    report_progress(progress, table_id, 'loaded')
+
+def stream_deals_to_bq(
+        rd_client: RDClient,
+        bq_client,
+        pipeline_id: str,
+        table_id: str,
+        dict_custom_fields: dict = None,
+        write_mode: str = 'truncate',
+        prods_table_id: str = None,
+        contacts_table_id: str = None,
+        backend: str = 'pandas',
+        sink=None,
+        progress=None
+    ):
+    '''
+    Loads a pipeline deals table with bounded memory: each page is normalized as it arrives and
+    spilled to a local parquet file, which is then loaded in BigQuery.
+    prods_table_id, contacts_table_id: Also loads the deals products/contacts tables from the same scan.
+    backend: Backend of the products/contacts tables ('pandas' or 'arrow').
+    sink: Destination of the tables (see Sink; default: BigQuerySink(bq_client)).
+    Returns the number of deals loaded.
+    '''
+    sink = sink or BigQuerySink(bq_client)
+    if dict_custom_fields is None:
+        dict_custom_fields = rd_client.custom_fields(output='dict')
+    writer = streaming.DealsParquetWriter(dict_custom_fields)
+    extra_tables = {}  # {table_id: (entity, collector)}
+    if prods_table_id is not None:
+        extra_tables[prods_table_id] = ('deals_products', ProductsCollector(backend=backend))
+    if contacts_table_id is not None:
+        extra_tables[contacts_table_id] = ('deals_contacts', ContactsCollector(backend=backend))
+    try:
+        collectors = [writer] + [collector for entity, collector in extra_tables.values()]
+        scan_pipeline(rd_client, pipeline_id=pipeline_id, collectors=collectors)
+        path = writer.close()
+        if writer.num_rows > 0:
+            sink.write_file(table_id=table_id, path=path, write_mode=write_mode, progress=progress)
+    finally:
+        writer.discard()
+    for extra_table_id, (entity, collector) in extra_tables.items():
+        df = collector.result()
+        sink.write(
+            table_id=extra_table_id,
+            df=df,
+            write_mode=write_mode,
+            schema=table_schema(rd_client, entity, df),
+            progress=progress
+        )
+    return writer.num_rows
+
+def merge_df_to_bq(table_id, df, client, key: str = 'id', schema: list = None, version: str = 'updated_at', progress=None):
+    '''
+    Upserts a dataframe into an existing BigQuery table by `key`.
+    The dataframe is loaded in a staging table (unique per merge, so concurrent merges into the same
+    table don't overwrite each other's, and created to expire after STAGING_EXPIRATION in case the
+    process dies before deleting it), new columns are added to the target table and a MERGE updates
+    matched rows (target columns missing in the dataframe are set to NULL) and inserts the new ones.
+    version: Column ordering the versions of a row (e.g. updated_at): matched rows are only updated
+    by rows at least as recent, so late or repeated updates don't overwrite newer ones (None: always).
+    '''
+    staging_table_id = f'{table_id}__staging_{uuid.uuid4().hex[:8]}'
+    report_progress(progress, table_id, 'loading')
+    staging_table = bigquery.Table(staging_table_id)
+    staging_table.expires = datetime.datetime.now(datetime.timezone.utc) + STAGING_EXPIRATION
+    client.create_table(staging_table)
+    try:
+        df_to_bq(table_id=staging_table_id, df=df, write_mode='truncate', client=client, schema=schema)
+        table = client.get_table(table_id)
+        staging_table = client.get_table(staging_table_id)
+        target_fields = {field.name: field for field in table.schema}
+        new_fields = [field for field in staging_table.schema if field.name not in target_fields]
+        if len(new_fields) > 0:
+            table.schema = list(table.schema) + new_fields
+            table = client.update_table(table, ['schema'])
+            target_fields = {field.name: field for field in table.schema}
+        staging_columns = [field.name for field in staging_table.schema]
+        staging_types = {field.name: field.field_type for field in staging_table.schema}
+        values = {}
+        for column, field in target_fields.items():
+            if column not in staging_types:
+                values[column] = 'NULL'
+            elif staging_types[column] == field.field_type or field.mode == 'REPEATED' or field.field_type == 'RECORD':
+                values[column] = f'S.`{column}`'
+            else:
+                values[column] = f'CAST(S.`{column}` AS {SQL_TYPES.get(field.field_type, field.field_type)})'
+        update_set = ', '.join([f'`{column}` = {value}' for column, value in values.items() if column != key])
+        insert_columns = ', '.join([f'`{column}`' for column in staging_columns])
+        insert_values = ', '.join([values[column] for column in staging_columns])
+        matched = 'WHEN MATCHED'
+        if version is not None and version in staging_types and version in target_fields:
+            matched = f'WHEN MATCHED AND (T.`{version}` IS NULL OR {values[version]} >= T.`{version}`)'
+        query = f'''
+            MERGE `{table_id}` T
+            USING `{staging_table_id}` S
+            ON T.`{key}` = S.`{key}`
+            {matched} THEN UPDATE SET {update_set}
+            WHEN NOT MATCHED THEN INSERT ({insert_columns}) VALUES ({insert_values})
+        '''
+        started = time.perf_counter()
+        with bq_load_slots:
+            client.query(query).result()
+    except Exception:
+        report_progress(progress, table_id, 'failed')
+        raise
+    finally:
+        client.delete_table(staging_table_id, not_found_ok=True)
+    metrics.record_load(table_id, 'merged', time.perf_counter() - started, rows=df.shape[0])
+    report_progress(progress, table_id, 'loaded')
+
+def get_watermark(client, table_id, column: str = 'updated_at'):
+    'Returns the high-water mark (max value of `column`) of a BigQuery table, or None when the table does not exist or is empty.'
+    try:
+        rows = client.query(f'SELECT MAX(`{column}`) AS watermark FROM `{table_id}`').result()
+    except exceptions.NotFound:
+        return None
+    for row in rows:
+        return row['watermark']
+    return None
+
+class Sink:
+    '''
+    Destination of the tables written by load_all and update_deals (BigQuerySink by default, or
+    parquet_sink.ParquetSink for local files). Table ids are "project.dataset.table" and write_mode
+    is 'truncate' or 'append'.
+    '''
+    def write(self, table_id, df, write_mode, schema: list = None, progress=None):
+        'Writes a dataframe (or arrow table) in a table (schema: explicit list of bigquery.SchemaField).'
+        raise NotImplementedError
+
+    def write_file(self, table_id, path, write_mode, progress=None):
+        'Writes a local parquet file in a table.'
+        raise NotImplementedError
+
+    def merge(self, table_id, df, key: str = 'id', schema: list = None, version: str = 'updated_at', progress=None):
+        'Upserts a dataframe into an existing table by key (matched rows are only replaced by rows with a version at least as recent).'
+        raise NotImplementedError
+
+    def watermark(self, table_id, column: str = 'updated_at'):
+        'Returns the max value of a table column, or None when the table does not exist or is empty.'
+        raise NotImplementedError
+
+    def fingerprint_store(self, table_id):
+        'Returns the store of the fingerprints of loaded tables (see fingerprints), kept in table_id.'
+        raise NotImplementedError
+
+class BigQuerySink(Sink):
+    'Writes the tables in BigQuery with a client (load jobs capped by BQ_MAX_LOAD_JOBS).'
+    def __init__(self, client):
+        self.client = client
+
+    def write(self, table_id, df, write_mode, schema: list = None, progress=None):
+        df_to_bq(table_id=table_id, df=df, write_mode=write_mode, client=self.client, schema=schema, progress=progress)
+
+    def write_file(self, table_id, path, write_mode, progress=None):
+        file_to_bq(table_id=table_id, path=path, write_mode=write_mode, client=self.client, progress=progress)
+
+    def merge(self, table_id, df, key: str = 'id', schema: list = None, version: str = 'updated_at', progress=None):
+        merge_df_to_bq(table_id=table_id, df=df, client=self.client, key=key, schema=schema, version=version, progress=progress)
+
+    def watermark(self, table_id, column: str = 'updated_at'):
+        return get_watermark(client=self.client, table_id=table_id, column=column)
+
+    def fingerprint_store(self, table_id):
+        return BigQueryFingerprintStore(self.client, table_id)
+
+
+def load_all(
+        rd_client,
+        bq_client,
+        BQ_PROJECT_ID,
+        BQ_DATASET,
+        sharded: bool = False,
+        stream: bool = False,
+        max_concurrent_loads: int = 4,
+        skip_unchanged: bool = False,
+        products: bool = False,
+        contacts: bool = False,
+        checkpoint: CheckpointStore = None,
+        fingerprints=None,
+        backend: str = 'pandas',
+        pool=None,
+        sink=None,
+        progress=None
+    ):
+    '''
+    Loads all dataframes in a specified BigQuery dataset.
+    products, contacts: Also loads deals_<pipeline>_products/contacts tables, built from the same scan as the deals.
+    sharded: Extracts pipelines beyond 10.000 deals.
+    stream: Loads deals tables page by page through local parquet files (bounded memory, not sharded).
+    max_concurrent_loads: Maximum number of BigQuery load jobs in flight (failed tables are reported together at the end).
+    skip_unchanged: Skips tables whose content fingerprint (see fingerprints.fingerprint) did not change since
+    they were last loaded (streamed deals tables are always loaded).
+    fingerprints: Store of the fingerprints of loaded tables (default: the _load_fingerprints state table of the dataset).
+    checkpoint: Run checkpoint store: pages are spilled to disk and, when a previous run with the same store
+    failed, completed pages are read from disk and loaded tables are skipped (cleared after success).
+    backend: 'pandas' (dataframes) or 'arrow': tables are built as pyarrow.Tables straight from the RD json,
+    with native types and dictionary encoded low cardinality columns, and loaded as parquet (see arrow_backend).
+    pool: workers.NormalizePool normalizing deals pages in worker processes (default: the process-wide pool
+    of NORMALIZE_WORKERS processes, if set; streamed deals are normalized by the stream writer thread).
+    sink: Destination of the tables (see Sink; default: BigQuerySink(bq_client), e.g. parquet_sink.ParquetSink
+    writes local files instead).
+    progress: Optional callback(table_id, status) called as each table is loaded.
+    '''
+    if sharded is True and stream is True:
+        raise ValueError('sharded and stream can not be used together.')
+    if backend not in BACKENDS:
+        raise ValueError(f'Invalid backend! Please call one of the options: {BACKENDS}')
+    if checkpoint is not None:
+        progress = checkpoint.progress(progress)  # Loaded tables are recorded in the run manifest
+    context = rd_client.checkpointing(checkpoint) if checkpoint is not None else contextlib.nullcontext()
+    pool = pool or normalize_pool()
+    sink = sink or BigQuerySink(bq_client)
+    with context:
+        # Creating dataframes
+        if backend == 'arrow':
+            df_pipelines = rd_client.entity('pipelines', backend='arrow')
+            dict_pipelines = arrow_backend.labels(df_pipelines, 'name')
+            df_custom_fields = rd_client.entity('custom_fields', backend='arrow')
+            dict_custom_fields = arrow_backend.labels(df_custom_fields, 'label')
+            df_stages = rd_client.general_stages(dict_pipelines=dict_pipelines, backend='arrow')
+            df_sources, df_products, df_teams, df_users, df_deal_lost_reasons, df_campaigns = [
+                rd_client.entity(name, backend='arrow') for name in ('sources', 'products', 'teams', 'users', 'deal_lost_reasons', 'campaigns')
+            ]
+        else:
+            df_pipelines, dict_pipelines = rd_client.pipelines()
+            df_custom_fields, dict_custom_fields = rd_client.custom_fields()
+            df_stages = rd_client.general_stages(dict_pipelines=dict_pipelines)
+            df_sources = rd_client.sources()
+            df_products = rd_client.products()
+            df_teams = rd_client.teams()
+            df_users = rd_client.users()
+            df_deal_lost_reasons = rd_client.deal_lost_reasons()
+            df_campaigns = rd_client.campaigns()
+
+        # Dictionary of all dataframes to load
+        dict_dfs = {
+            'pipelines': df_pipelines,
+            'custom_fields': df_custom_fields,
+            'stages': df_stages,
+            'sources': df_sources,
+            'products': df_products,
+            'teams': df_teams,
+            'users': df_users,
+            'deal_lost_reasons': df_deal_lost_reasons,
+            'campaigns': df_campaigns
+        }
+        dict_entities = {table_name: table_name for table_name in dict_dfs}
+        # Pipeline tables (deals and optionally products/contacts) from a single scan of each pipeline
+        pipeline_tables = ['deals'] + (['deals_products'] if products is True else []) + (['deals_contacts'] if contacts is True else [])
+        pipeline_suffixes = {'deals': '', 'deals_products': '_products', 'deals_contacts': '_contacts'}
+
+        def pipeline_loaded(pipeline_id):
+            'Whether a failed run with the same checkpoint already loaded all tables of the pipeline.'
+            return checkpoint is not None and all([
+                checkpoint.is_table_loaded(f'{BQ_PROJECT_ID}.{BQ_DATASET}.deals_{dict_pipelines[pipeline_id]}{pipeline_suffixes[entity]}')
+                for entity in pipeline_tables
+            ])
+
+        if stream is False:
+            pipelines_ids = [pipeline_id for pipeline_id in dict_pipelines if not pipeline_loaded(pipeline_id)]
+            contexts = [contextvars.copy_context() for pipeline_id in pipelines_ids]  # Keeps the checkpoint in workers
+            with ThreadPoolExecutor(max_workers=max(1, rd_client.pipeline_workers)) as executor:
+                list_tables = list(executor.map(
+                    lambda context, pipeline_id: context.run(
+                        extract_pipeline_tables,
+                        rd_client,
+                        pipeline_id=pipeline_id,
+                        dict_custom_fields=dict_custom_fields,
+                        tables=pipeline_tables,
+                        sharded=sharded,
+                        backend=backend,
+                        pool=pool
+                    ),
+                    contexts,
+                    pipelines_ids
+                ))
+            for pipeline_id, dict_pipeline_dfs in zip(pipelines_ids, list_tables):
+                for entity, df in dict_pipeline_dfs.items():
+                    table_name = f'deals_{dict_pipelines[pipeline_id]}{pipeline_suffixes[entity]}'
+                    dict_dfs[table_name] = df
+                    dict_entities[table_name] = entity
+
+        # Content fingerprints of the tables, compared with the ones of their last load
+        dict_fingerprints = {}
+        stored_fingerprints = {}
+        if skip_unchanged is True:
+            if fingerprints is None:
+                fingerprints = sink.fingerprint_store(f'{BQ_PROJECT_ID}.{BQ_DATASET}._load_fingerprints')
+            stored_fingerprints = fingerprints.get([f'{BQ_PROJECT_ID}.{BQ_DATASET}.{table_name}' for table_name in dict_dfs])
+        dict_loads = {}
+        for table_name, df in dict_dfs.items():
+            table_id = f'{BQ_PROJECT_ID}.{BQ_DATASET}.{table_name}'
+            if checkpoint is not None and checkpoint.is_table_loaded(table_id):
+                report_progress(progress, table_id, 'skipped')
+            elif df.shape != (0, 0):
+                if skip_unchanged is True:
+                    dict_fingerprints[table_id] = fingerprint(df)
+                    if stored_fingerprints.get(table_id) == dict_fingerprints[table_id]:
+                        report_progress(progress, table_id, 'skipped')
+                        continue
+                dict_loads[table_id] = (df, table_schema(rd_client, dict_entities[table_name], df))
+        load_errors = {}
+        try:
+            write_tables(sink, dict_loads=dict_loads, write_mode='truncate', max_in_flight=max_concurrent_loads, progress=progress)
+        except LoadJobsError as error:
+            load_errors.update(error.errors)
+        if skip_unchanged is True:
+            loaded = [table_id for table_id in dict_loads if table_id not in load_errors]
+            fingerprints.update(
+                {table_id: dict_fingerprints[table_id] for table_id in loaded},
+                {table_id: dict_loads[table_id][0].shape[0] for table_id in loaded}
+            )
+
+        if stream is True:
+            # Pipelines are streamed one at a time to keep memory bounded
+            for id, deal_pipeline in dict_pipelines.items():
+                table_id = f'{BQ_PROJECT_ID}.{BQ_DATASET}.deals_{deal_pipeline}'
+                if pipeline_loaded(id):
+                    report_progress(progress, table_id, 'skipped')
+                    continue
+                try:
+                    stream_deals_to_bq(
+                        rd_client=rd_client,
+                        bq_client=bq_client,
+                        pipeline_id=id,
+                        table_id=table_id,
+                        dict_custom_fields=dict_custom_fields,
+                        prods_table_id=f'{table_id}_products' if products is True else None,
+                        contacts_table_id=f'{table_id}_contacts' if contacts is True else None,
+                        backend=backend,
+                        sink=sink,
+                        progress=progress
+                    )
+                except Exception as error:
+                    load_errors[table_id] = error
+        if len(load_errors) > 0:
+            raise LoadJobsError(load_errors)
+    if checkpoint is not None:
+        checkpoint.clear()
+
+def load_accounts(
+        accounts: list,
+        bq_client,
+        rd_client_factory,
+        max_workers: int = 4,
+        max_per_token: int = 1,
+        progress=None,
+        **options
+    ):
+    '''
+    Loads several CRM accounts (load_all) on a shared pool of max_workers threads.
+    accounts: List of dictionaries with RD_CRM_TOKEN, BQ_PROJECT_ID, BQ_DATASET and optionally
+    load_all options (sharded, stream, skip_unchanged, products, contacts, max_concurrent_loads, backend)
+    overriding the batch **options.
+    rd_client_factory: Returns the RDClient of a token (e.g. clients.get_rd_client).
+    max_per_token: Maximum number of accounts running at once with the same RD token, so the token
+    rate limit is not split among too many runs. Accounts are started round-robin across tokens.
+    BigQuery load jobs of all accounts share the process-wide cap (BQ_MAX_LOAD_JOBS).
+    Returns a report with the status and timings (seconds queued and running) of each account, in the
+    order given, and raises AccountsLoadError (with the report) if any account failed.
+    '''
+    for account in accounts:
+        missing = [name for name in ('RD_CRM_TOKEN', 'BQ_PROJECT_ID', 'BQ_DATASET') if not account.get(name)]
+        if len(missing) > 0:
+            raise ValueError(f'Account config without {", ".join(missing)}.')
+    # Round-robin order across tokens, so accounts sharing a token do not hold back the others
+    token_queues = OrderedDict()
+    for index, account in enumerate(accounts):
+        token_queues.setdefault(account_key(account['RD_CRM_TOKEN']), deque()).append(index)
+    pending = []
+    while any(token_queues.values()):
+        for token, queue in token_queues.items():
+            if len(queue) > 0:
+                pending.append((token, queue.popleft()))
+
+    batch_started = time.monotonic()
+    report = [None] * len(accounts)
+    errors = {}
+
+    def load_account(token, index):
+        account = accounts[index]
+        name = f"{account['BQ_PROJECT_ID']}.{account['BQ_DATASET']}"
+        account_options = {**options, **{option: account[option] for option in ACCOUNT_OPTIONS if option in account}}
+        started = time.monotonic()
+        entry = {'account': name, 'rd_account': token, 'queued_seconds': round(started - batch_started, 3)}
+        try:
+            with metrics.run('load_account', account=name, rd_account=token):
+                load_all(
+                    rd_client=rd_client_factory(account['RD_CRM_TOKEN']),
+                    bq_client=bq_client,
+                    BQ_PROJECT_ID=account['BQ_PROJECT_ID'],
+                    BQ_DATASET=account['BQ_DATASET'],
+                    progress=progress,
+                    **account_options
+                )
+            entry['status'] = 'succeeded'
+        except Exception as error:
+            entry['status'] = 'failed'
+            entry['error'] = f'{type(error).__name__}: {error}'
+            errors[name] = error
+        entry['seconds'] = round(time.monotonic() - started, 3)
+        return entry
+
+    running = {}  # {future: (token, index)}
+    running_per_token = Counter()
+    with ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix='account') as executor:
+        while len(pending) > 0 or len(running) > 0:
+            # Starts the first pending accounts whose token is below its cap, while there are free workers
+            for token, index in list(pending):
+                if len(running) >= max(1, max_workers):
+                    break
+                if running_per_token[token] < max(1, max_per_token):
+                    pending.remove((token, index))
+                    running_per_token[token] += 1
+                    running[executor.submit(contextvars.copy_context().run, load_account, token, index)] = (token, index)
+            done, not_done = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                token, index = running.pop(future)
+                running_per_token[token] -= 1
+                report[index] = future.result()
+
+    result = {'seconds': round(time.monotonic() - batch_started, 3), 'accounts': report}
+    if len(errors) > 0:
+        raise AccountsLoadError(errors, result)
+    return result
 
 def update_deals(
         rd_client: RDClient, 
@@ -64,44 +585,117 @@ def update_deals(
         deals_table_id: str = None,
         prods_table_id: str = None,
         deals: bool = True, 
-        products: bool = False
+        products: bool = False,
+        stream: bool = False,
+        incremental: bool = False,
+        sink=None,
+        progress=None
     ):
+    '''
+    Updates deals and/or deals products tables of a pipeline.
+    stream: Loads deals with bounded memory.
+    incremental: Merges only deals updated since the last load (products are still fully reloaded).
+    sink: Destination of the tables (see Sink; default: BigQuerySink(bq_client)).
+    progress: Optional callback(table_id, status) called as each table is loaded.
+    '''
+    sink = sink or BigQuerySink(bq_client)
     if (deals is True and deals_table_id is None) or (products is True and prods_table_id is None):
         raise ValueError("Unmatching values for table ID's and tables to be updated/loaded.")
     if deals is False and products is False:
         raise ValueError('deals and products are set to False, at least one needs to be True.')
+    elif deals is True and (stream is True or incremental is True):
+        if incremental is False:
+            # Products (if requested) are built from the same scan
+            stream_deals_to_bq(
+                rd_client=rd_client,
+                bq_client=bq_client,
+                pipeline_id=pipeline_id,
+                table_id=deals_table_id,
+                prods_table_id=prods_table_id if products is True else None,
+                sink=sink,
+                progress=progress
+            )
+            return
+        sync_deals_incremental(
+            rd_client=rd_client,
+            bq_client=bq_client,
+            pipeline_id=pipeline_id,
+            deals_table_id=deals_table_id,
+            sink=sink,
+            progress=progress
+        )
+        if products is True:
+            update_deals(
+                rd_client=rd_client,
+                bq_client=bq_client,
+                pipeline_id=pipeline_id,
+                prods_table_id=prods_table_id,
+                deals=False,
+                products=True,
+                sink=sink,
+                progress=progress
+            )
     elif deals is True and products is True:
-        output = 'both'
-        dict_custom_fields = rd_client.custom_fields(output='dict')
-        df_deals, list_deals = rd_client.pipeline_deals(pipeline_id=pipeline_id, dict_custom_fields=dict_custom_fields, output=output)
-        df_deals_prods = rd_client.deals_products(pipeline_id=pipeline_id, data=list_deals)
-        df_to_bq(
+        # Both tables from a single scan of the pipeline
+        dict_pipeline_dfs = extract_pipeline_tables(rd_client, pipeline_id=pipeline_id, tables=['deals', 'deals_products'], pool=normalize_pool())
+        df_deals = dict_pipeline_dfs['deals']
+        df_deals_prods = dict_pipeline_dfs['deals_products']
+        sink.write(
             table_id=deals_table_id, 
             df=df_deals,
             write_mode='truncate',
-            client=bq_client
+            schema=table_schema(rd_client, 'deals', df_deals),
+            progress=progress
         )
-        df_to_bq(
+        sink.write(
             table_id=prods_table_id, 
             df=df_deals_prods,
             write_mode='truncate',
-            client=bq_client
+            schema=table_schema(rd_client, 'deals_products', df_deals_prods),
+            progress=progress
         )
     elif deals is False and products is True:
         df_deals_prods = rd_client.deals_products(pipeline_id=pipeline_id)
-        df_to_bq(
+        sink.write(
             table_id=prods_table_id, 
             df=df_deals_prods,
             write_mode='truncate',
-            client=bq_client
+            schema=table_schema(rd_client, 'deals_products', df_deals_prods),
+            progress=progress
         )
     else:
         output = 'df'
         dict_custom_fields = rd_client.custom_fields(output='dict')
         df_deals = rd_client.pipeline_deals(pipeline_id=pipeline_id, dict_custom_fields=dict_custom_fields, output=output)
-        df_to_bq(
+        sink.write(
             table_id=deals_table_id, 
             df=df_deals,
             write_mode='truncate',
-            client=bq_client
-        )
\ No newline at end of file
+            schema=table_schema(rd_client, 'deals', df_deals),
+            progress=progress
+        )
+
+def sync_deals_incremental(rd_client: RDClient, bq_client, pipeline_id: str, deals_table_id: str, sink=None, progress=None):
+    '''
+    Incrementally updates a pipeline deals table.
+    The max updated_at already loaded in the table is the pipeline high-water mark: only deals updated
+    after it are fetched and merged by id. If the table has no watermark yet, it is fully loaded.
+    sink: Destination of the table (see Sink; default: BigQuerySink(bq_client)).
+    Returns the number of deals written.
+    '''
+    sink = sink or BigQuerySink(bq_client)
+    dict_custom_fields = rd_client.custom_fields(output='dict')
+    watermark = sink.watermark(table_id=deals_table_id)
+    df_deals = rd_client.pipeline_deals(
+        pipeline_id=pipeline_id,
+        dict_custom_fields=dict_custom_fields,
+        updated_since=watermark
+    )
+    if df_deals.shape[0] == 0:
+        return 0
+    schema = table_schema(rd_client, 'deals', df_deals)
+    if watermark is None:
+        sink.write(table_id=deals_table_id, df=df_deals, write_mode='truncate', schema=schema, progress=progress)
+    else:
+        sink.merge(table_id=deals_table_id, df=df_deals, schema=schema, progress=progress)
+    return df_deals.shape[0]
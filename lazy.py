@@ -0,0 +1,47 @@
+import importlib
+import threading
+import time
+import sys
+import metrics
+
+class LazyModule:
+    '''
+    Module imported on its first attribute access instead of at import time, to keep heavy
+    dependencies (pandas, pyarrow, google-cloud-bigquery) off the startup path of entry points
+    that don't use them. The import seconds are recorded in metrics.IMPORT_SECONDS.
+    '''
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._module is None:
+                imported = self._name in sys.modules  # Already imported elsewhere (e.g. by another proxy)
+                started = time.perf_counter()
+                module = importlib.import_module(self._name)
+                if imported is False:
+                    metrics.IMPORT_SECONDS.set(round(time.perf_counter() - started, 4), module=self._name)
+                self._module = module
+        return self._module
+
+    def __getattr__(self, attr):
+        # Only called for attributes not found on the proxy itself, i.e. the module's attributes
+        module = self._module if self._module is not None else self._load()
+        return getattr(module, attr)
+
+    def __repr__(self):
+        return f'<LazyModule {self._name} ({"imported" if self._module is not None else "not imported"})>'
+
+def preload(*modules):
+    '''
+    Imports lazy modules in a background (daemon) thread, e.g. right after a server starts
+    answering requests, so the first job doesn't wait for them. Returns the thread.
+    '''
+    def load():
+        for module in modules:
+            module._load()
+    thread = threading.Thread(target=load, name='preload', daemon=True)
+    thread.start()
+    return thread
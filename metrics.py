@@ -0,0 +1,271 @@
+from collections import defaultdict
+import contextlib
+import contextvars
+import threading
+import bisect
+import json
+import time
+import uuid
+
+# Seconds buckets of latency histograms (RD requests, stages and BigQuery load jobs)
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+def format_labels(labelnames, values, extra: dict = None):
+    'Returns the Prometheus label set of a sample, e.g. {endpoint="/deals",status="200"}.'
+    pairs = list(zip(labelnames, values)) + list((extra or {}).items())
+    if len(pairs) == 0:
+        return ''
+    escaped = [(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in pairs]
+    return '{' + ','.join([f'{name}="{value}"' for name, value in escaped]) + '}'
+
+class Counter:
+    'Monotonic counter with labels (Prometheus text format).'
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple([str(labels[name]) for name in self.labelnames])
+        with self._lock:
+            self._values[key] += amount
+
+    def value(self, **labels):
+        key = tuple([str(labels[name]) for name in self.labelnames])
+        with self._lock:
+            return self._values.get(key, 0.0)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{format_labels(self.labelnames, key)} {value}')
+        return lines
+
+class Gauge:
+    'Value that is set (not summed) with labels, e.g. durations measured once per process.'
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def set(self, value: float, **labels):
+        key = tuple([str(labels[name]) for name in self.labelnames])
+        with self._lock:
+            self._values[key] = value
+
+    def value(self, **labels):
+        key = tuple([str(labels[name]) for name in self.labelnames])
+        with self._lock:
+            return self._values.get(key)
+
+    def values(self):
+        'Returns {label value: value} of a gauge with a single label.'
+        with self._lock:
+            return {key[0]: value for key, value in self._values.items()}
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} gauge']
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{format_labels(self.labelnames, key)} {value}')
+        return lines
+
+class Histogram:
+    'Histogram of observations with labels (cumulative buckets, sum and count).'
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._counts = {}  # {labels: [count per bucket + inf]}
+        self._sums = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple([str(labels[name]) for name in self.labelnames])
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._counts.setdefault(key, [0] * (len(self.buckets) + 1))
+            counts[index] += 1
+            self._sums[key] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for key, counts in sorted(self._counts.items()):
+                cumulative = 0
+                for bound, count in zip(list(self.buckets) + ['+Inf'], counts):
+                    cumulative += count
+                    lines.append(f'{self.name}_bucket{format_labels(self.labelnames, key, {"le": bound})} {cumulative}')
+                lines.append(f'{self.name}_sum{format_labels(self.labelnames, key)} {self._sums[key]}')
+                lines.append(f'{self.name}_count{format_labels(self.labelnames, key)} {cumulative}')
+        return lines
+
+class Registry:
+    'Set of metrics rendered together by the /metrics endpoint.'
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        return '\n'.join([line for metric in self._metrics for line in metric.render()]) + '\n'
+
+registry = Registry()
+RD_REQUESTS = registry.register(Counter('rd_requests_total', 'RD CRM API responses by endpoint and status code.', ('endpoint', 'status')))
+RD_REQUEST_SECONDS = registry.register(Histogram('rd_request_seconds', 'RD CRM API request latency by endpoint.', ('endpoint',)))
+RD_RESPONSE_BYTES = registry.register(Counter('rd_response_bytes_total', 'Bytes received from the RD CRM API by endpoint.', ('endpoint',)))
+RD_RETRIES = registry.register(Counter('rd_retries_total', 'RD CRM API requests retried by endpoint and reason.', ('endpoint', 'reason')))
+STAGE_SECONDS = registry.register(Histogram('stage_seconds', 'Seconds spent in extract, normalize and load stages by entity.', ('stage', 'entity')))
+TABLE_ROWS = registry.register(Counter('table_rows_total', 'Rows loaded in BigQuery by table name.', ('table',)))
+BQ_LOAD_SECONDS = registry.register(Histogram('bq_load_seconds', 'BigQuery load job (or MERGE) duration by table name and status.', ('table', 'status')))
+RUNS = registry.register(Counter('runs_total', 'Jobs executed by kind and status.', ('kind', 'status')))
+RUN_SECONDS = registry.register(Histogram('run_seconds', 'Job duration by kind.', ('kind',)))
+WEBHOOK_EVENTS = registry.register(Counter('webhook_events_total', 'RD CRM webhook deal events by status (accepted, ignored, rejected, invalid, flushed, failed).', ('status',)))
+WEBHOOK_QUEUE = registry.register(Gauge('webhook_queue_events', 'Deal events buffered by the webhook, waiting for a flush.'))
+IMPORT_SECONDS = registry.register(Gauge('import_seconds', 'Seconds spent importing modules (entry points and lazily imported dependencies).', ('module',)))
+
+class RunStats:
+    'Totals of a run (job), logged as one structured json line when it finishes.'
+    def __init__(self, kind: str, parent=None, **fields):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.parent = parent
+        self.fields = fields
+        self.started = time.perf_counter()
+        self.requests = defaultdict(int)  # {endpoint: requests}
+        self.request_seconds = defaultdict(float)
+        self.bytes = 0
+        self.retries = 0
+        self.stages = defaultdict(float)  # {stage:entity: seconds}
+        self.tables = {}  # {table: rows}
+        self._lock = threading.Lock()
+
+    def chain(self):
+        'The run and its ancestors (nested runs, e.g. accounts of a batch, also count in the batch).'
+        run = self
+        while run is not None:
+            yield run
+            run = run.parent
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'run_id': self.id,
+                'kind': self.kind,
+                **self.fields,
+                'seconds': round(time.perf_counter() - self.started, 3),
+                'requests': dict(self.requests),
+                'request_seconds': {endpoint: round(seconds, 3) for endpoint, seconds in self.request_seconds.items()},
+                'bytes_received': self.bytes,
+                'retries': self.retries,
+                'stages': {stage: round(seconds, 3) for stage, seconds in self.stages.items()},
+                'tables': dict(self.tables)
+            }
+
+current_run = contextvars.ContextVar('current_run', default=None)
+
+def active_runs():
+    'Returns the current run and its ancestors (empty outside of runs).'
+    run = current_run.get()
+    return list(run.chain()) if run is not None else []
+
+def record_request(endpoint, status, seconds, size):
+    'Records an RD CRM API response.'
+    RD_REQUESTS.inc(endpoint=endpoint, status=status)
+    RD_REQUEST_SECONDS.observe(seconds, endpoint=endpoint)
+    RD_RESPONSE_BYTES.inc(size, endpoint=endpoint)
+    for stats in active_runs():
+        with stats._lock:
+            stats.requests[endpoint] += 1
+            stats.request_seconds[endpoint] += seconds
+            stats.bytes += size
+
+def record_retry(endpoint, reason):
+    'Records an RD CRM API request about to be retried (reason: status code or error name).'
+    RD_RETRIES.inc(endpoint=endpoint, reason=reason)
+    for stats in active_runs():
+        with stats._lock:
+            stats.retries += 1
+
+def record_stage(stage, entity, seconds, detail: str = None):
+    '''
+    Records seconds spent in a stage (extract, normalize or load) of an entity (e.g. deals).
+    detail: Finer key kept only in run logs (e.g. the pipeline id or table name).
+    '''
+    STAGE_SECONDS.observe(seconds, stage=stage, entity=entity)
+    key = f'{stage}:{entity}' + (f':{detail}' if detail is not None else '')
+    for stats in active_runs():
+        with stats._lock:
+            stats.stages[key] += seconds
+
+def record_load(table_id, status, seconds, rows=None):
+    'Records a BigQuery load job (or MERGE) of a table and its rows.'
+    table = table_id.split('.')[-1]
+    BQ_LOAD_SECONDS.observe(seconds, table=table, status=status)
+    record_stage('load', 'table', seconds, detail=table)
+    if rows is not None:
+        TABLE_ROWS.inc(rows, table=table)
+        for stats in active_runs():
+            with stats._lock:
+                stats.tables[table_id] = stats.tables.get(table_id, 0) + rows
+
+@contextlib.contextmanager
+def stage(stage, entity, detail: str = None):
+    'Context timing a stage (see record_stage).'
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, entity, time.perf_counter() - started, detail=detail)
+
+def timed_pages(pages, entity, detail: str = None):
+    'Yields the pages of an iterator, recording the time waiting for each one as the extract stage.'
+    pages = iter(pages)
+    while True:
+        started = time.perf_counter()
+        try:
+            page = next(pages)
+        except StopIteration:
+            record_stage('extract', entity, time.perf_counter() - started, detail=detail)
+            return
+        record_stage('extract', entity, time.perf_counter() - started, detail=detail)
+        yield page
+
+@contextlib.contextmanager
+def run(kind: str, **fields):
+    '''
+    Context of a run (job): request, stage and load measures of this thread and of the workers
+    started with a copy of its context are summed, and a structured json log line is printed at
+    the end (with status and error when the run fails).
+    '''
+    stats = RunStats(kind, parent=current_run.get(), **fields)
+    token = current_run.set(stats)
+    status, error = 'succeeded', None
+    try:
+        yield stats
+    except Exception as exception:
+        status, error = 'failed', f'{type(exception).__name__}: {exception}'
+        raise
+    finally:
+        current_run.reset(token)
+        log = {'severity': 'INFO' if status == 'succeeded' else 'ERROR', 'message': f'{kind} {status}', **stats.to_dict(), 'status': status}
+        if error is not None:
+            log['error'] = error
+        RUNS.inc(kind=kind, status=status)
+        RUN_SECONDS.observe(log['seconds'], kind=kind)
+        print(json.dumps(log, default=str), flush=True)
+
+def logged(kind: str, func, **fields):
+    'Returns func wrapped to execute inside a run (see run).'
+    def wrapper(*args, **kwargs):
+        with run(kind, **fields):
+            return func(*args, **kwargs)
+    return wrapper
@@ -0,0 +1,194 @@
+from jobs import Sink, report_progress
+from fingerprints import CacheFingerprintStore
+from cache import DiskCache
+import arrow_backend
+import metrics
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import threading
+import shutil
+import uuid
+import time
+import os
+
+# Arrow types of the BigQuery types of explicit schemas (see schemas.TABLE_TYPES)
+ARROW_TYPES = {
+    'STRING': pa.string(),
+    'BOOLEAN': pa.bool_(),
+    'INTEGER': pa.int64(),
+    'FLOAT': pa.float64(),
+    'TIMESTAMP': pa.timestamp('us', tz='UTC')
+}
+# Hive partition directory of the month of the partition column (e.g. created_month=2024-05)
+PARTITION_KEY = 'created_month'
+
+class ParquetSink(Sink):
+    '''
+    Writes the tables as local parquet files instead of BigQuery, for tests, backfill dry runs and
+    offline analysis. Each table is a directory {directory}/{project}/{dataset}/{table} (deals tables
+    are one per pipeline) partitioned by the month of partition_column when the table has it, in
+    hive directories (created_month=YYYY-MM). Truncate writes replace the table directory once the
+    new files are complete and append writes add new files. Merges and watermarks read the files.
+    duckdb_path: Optional DuckDB database file where each written table is registered as a view
+    ({dataset}.{table}) over its files (requires the duckdb package).
+    '''
+    def __init__(self, directory: str, partition_column: str = 'created_at', duckdb_path: str = None):
+        self.directory = directory
+        self.partition_column = partition_column
+        self.duckdb_path = duckdb_path
+        self._duckdb = None
+        if duckdb_path is not None:
+            try:
+                import duckdb
+            except ImportError:
+                raise ImportError('duckdb_path requires the duckdb package (pip install duckdb).')
+            self._duckdb = duckdb
+        self._locks = {}  # {table_id: lock}, writes of a table are serialized
+        self._lock = threading.Lock()
+
+    def _path(self, table_id):
+        return os.path.join(self.directory, *table_id.split('.'))
+
+    def _table_lock(self, table_id):
+        with self._lock:
+            return self._locks.setdefault(table_id, threading.Lock())
+
+    def table_ids(self):
+        'Returns the ids of the tables written in the directory.'
+        table_ids = []
+        for root, directories, files in os.walk(self.directory):
+            # A table directory has parquet files or partition directories
+            if any([file.endswith('.parquet') for file in files]) or any([directory.startswith(f'{PARTITION_KEY}=') for directory in directories]):
+                table_ids.append('.'.join(os.path.relpath(root, self.directory).split(os.sep)))
+                directories[:] = []
+        return sorted(table_ids)
+
+    def read(self, table_id, columns: list = None):
+        'Returns a table as an arrow table (files with different columns are unified), or None if it does not exist.'
+        path = self._path(table_id)
+        if not os.path.isdir(path):
+            return None
+        dataset = ds.dataset(path, format='parquet', partitioning='hive')
+        schemas = [dataset.schema] + [fragment.physical_schema for fragment in dataset.get_fragments()]
+        schema = pa.unify_schemas(schemas, promote_options='permissive')
+        table = ds.dataset(path, schema=schema, format='parquet', partitioning='hive').to_table(columns=columns)
+        if columns is None and PARTITION_KEY in table.column_names:
+            table = table.drop_columns([PARTITION_KEY])
+        return table
+
+    def _arrow_schema(self, schema, columns):
+        'Returns the arrow schema of an explicit BigQuery schema (None when there is no schema).'
+        if schema is None:
+            return None
+        types = {field.name: ARROW_TYPES.get(field.field_type, pa.string()) for field in schema}
+        return pa.schema([(column, types.get(column, pa.string())) for column in columns])
+
+    def _to_arrow(self, df, schema: list = None):
+        if arrow_backend.is_table(df):
+            return df
+        return pa.Table.from_pandas(df, schema=self._arrow_schema(schema, [str(column) for column in df.columns]), preserve_index=False)
+
+    def _partitioned(self, batch):
+        'Adds the partition key column (month of the partition column) to a record batch.'
+        column = batch.column(self.partition_column)
+        return batch.append_column(PARTITION_KEY, pc.strftime(column, format='%Y-%m'))
+
+    def _write_batches(self, table_id, schema, batches, write_mode, progress=None):
+        if write_mode not in ('truncate', 'append'):
+            raise ValueError("Invalid write mode value. Please insert 'truncate' or 'append'.")
+        path = self._path(table_id)
+        partitioned = self.partition_column in schema.names and pa.types.is_timestamp(schema.field(self.partition_column).type)
+        if partitioned is True:
+            batches = (self._partitioned(batch) for batch in batches)
+            schema = schema.append(pa.field(PARTITION_KEY, pa.string()))
+        report_progress(progress, table_id, 'loading')
+        started = time.perf_counter()
+        rows = 0
+
+        def counted(batches):
+            nonlocal rows
+            for batch in batches:
+                rows += batch.num_rows
+                yield batch
+
+        try:
+            with self._table_lock(table_id):
+                target = f'{path}.tmp-{uuid.uuid4().hex[:8]}' if write_mode == 'truncate' else path
+                ds.write_dataset(
+                    ds.Scanner.from_batches(counted(batches), schema=schema),
+                    target,
+                    format='parquet',
+                    partitioning=[PARTITION_KEY] if partitioned is True else None,
+                    partitioning_flavor='hive' if partitioned is True else None,
+                    basename_template=f'part-{uuid.uuid4().hex[:12]}-{{i}}.parquet',
+                    existing_data_behavior='overwrite_or_ignore'
+                )
+                if write_mode == 'truncate':
+                    if os.path.isdir(path):
+                        shutil.rmtree(path)
+                    os.replace(target, path)
+                self._register(table_id)
+        except Exception:
+            metrics.record_load(table_id, 'failed', time.perf_counter() - started)
+            report_progress(progress, table_id, 'failed')
+            raise
+        metrics.record_load(table_id, 'loaded', time.perf_counter() - started, rows=rows)
+        report_progress(progress, table_id, 'loaded')
+
+    def _register(self, table_id):
+        'Creates or replaces the DuckDB view of a table over its files.'
+        if self._duckdb is None:
+            return
+        parts = table_id.split('.')
+        dataset, table = (parts[-2] if len(parts) > 1 else 'main'), parts[-1]
+        files = os.path.join(self._path(table_id), '**', '*.parquet').replace("'", "''")
+        with self._lock:
+            connection = self._duckdb.connect(self.duckdb_path)
+            try:
+                connection.execute(f'CREATE SCHEMA IF NOT EXISTS "{dataset}"')
+                connection.execute(
+                    f'CREATE OR REPLACE VIEW "{dataset}"."{table}" AS '
+                    f"SELECT * FROM read_parquet('{files}', hive_partitioning = true, union_by_name = true)"
+                )
+            finally:
+                connection.close()
+
+    def write(self, table_id, df, write_mode, schema: list = None, progress=None):
+        table = self._to_arrow(df, schema)
+        self._write_batches(table_id, table.schema, table.to_batches(), write_mode, progress=progress)
+
+    def write_file(self, table_id, path, write_mode, progress=None):
+        # Row group by row group, so streamed deals files keep a bounded memory
+        with pq.ParquetFile(path) as parquet_file:
+            self._write_batches(table_id, parquet_file.schema_arrow, parquet_file.iter_batches(), write_mode, progress=progress)
+
+    def merge(self, table_id, df, key: str = 'id', schema: list = None, version: str = 'updated_at', progress=None):
+        '''
+        Upserts by key: rows of the table with a key in df are replaced (unless the table row has a more
+        recent version, as in jobs.merge_df_to_bq) and the table files are rewritten.
+        '''
+        table = self._to_arrow(df, schema)
+        current = self.read(table_id)
+        if current is not None and version is not None and version in current.column_names and version in table.column_names:
+            # Rows older than the table ones are skipped (a null table version is always replaced)
+            versions = dict(zip(current.column(key).to_pylist(), current.column(version).to_pylist()))
+            newer = [
+                versions.get(row_key) is None or (row_version is not None and row_version >= versions[row_key])
+                for row_key, row_version in zip(table.column(key).to_pylist(), table.column(version).to_pylist())
+            ]
+            table = table.filter(pa.array(newer, type=pa.bool_()))
+        if current is not None:
+            current = current.filter(pc.invert(pc.is_in(current.column(key), value_set=table.column(key).combine_chunks())))
+            table = arrow_backend.concat_tables([current, table])
+        self._write_batches(table_id, table.schema, table.to_batches(), 'truncate', progress=progress)
+
+    def watermark(self, table_id, column: str = 'updated_at'):
+        table = self.read(table_id, columns=[column]) if os.path.isdir(self._path(table_id)) else None
+        if table is None or table.num_rows == 0:
+            return None
+        return pc.max(table.column(column)).as_py()
+
+    def fingerprint_store(self, table_id):
+        return CacheFingerprintStore(DiskCache(self._path(table_id)))
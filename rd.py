@@ -1,10 +1,33 @@
-import requests
-import pandas as pd
-import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from checkpoint import current_checkpoint, CheckpointStore
+import metrics
+from entities import ENTITIES, TIMESTAMPS, cast_columns
+from lazy import LazyModule
+from workers import normalize_pool
+import contextlib
+import contextvars
 import unicodedata
+import functools
+import threading
+import datetime
+import hashlib
+import json
+import random
+import time
+import os
 import re
 
+requests = LazyModule('requests')
+pd = LazyModule('pandas')
+arrow_backend = LazyModule('arrow_backend')
 
+
+def account_key(token):
+    'Returns a non reversible key identifying an RD CRM account by its token.'
+    return hashlib.sha256(token.encode()).hexdigest()[:16]
+
+@functools.lru_cache(maxsize=4096)
 def text_to_snakecase(text):
     'Takes text input and returns in snakecase (it limits string length to 40).'
     # Normalize the string to decompose characters with accents
@@ -16,40 +39,426 @@ def text_to_snakecase(text):
     header_text = cleaned_text.lower().replace(' ', '_')
     return header_text[:40]
 
+def value_to_str(value):
+    'Returns a custom field value as string (lists are joined by commas) or None for null values.'
+    if value is None or (isinstance(value, float) and value != value):
+        return None
+    if isinstance(value, list):
+        return ', '.join([str(item) for item in value])
+    return str(value)
+
+# Columns of the deals table built from the deal fields (custom fields columns follow them)
+DEALS_COLUMNS = [
+    'id',
+    'name',
+    'organization',
+    'win',
+    'stage',
+    'user',
+    'created_at',
+    'updated_at',
+    'closed_at',
+    'amount_montly',
+    'amount_unique',
+    'amount_total',
+    'source',
+    'campaign',
+    'lost_reason',
+    'products',
+    'contact_name',
+    'phone',
+    'email'
+]
+
+def deal_row(deal):
+    'Returns the values of the DEALS_COLUMNS of a raw deal (RD CRM json), in order.'
+    contact = deal['contacts'][0] if len(deal['contacts']) > 0 else {}  # 1st contact values
+    emails = contact.get('emails', [])
+    phones = contact.get('phones', [])
+    return (
+        deal['id'],
+        deal['name'],
+        (deal.get('organization') or {}).get('name'),
+        deal['win'],
+        deal['deal_stage']['name'],
+        deal['user']['name'],
+        deal['created_at'],
+        deal['updated_at'],
+        deal['closed_at'],
+        deal['amount_montly'],
+        deal['amount_unique'],
+        deal['amount_total'],
+        (deal.get('deal_source') or {}).get('name'),
+        (deal.get('campaign') or {}).get('name'),
+        (deal.get('deal_lost_reason') or {}).get('name'),
+        ', '.join([prod['name'] for prod in deal['deal_products']]),
+        contact.get('name'),
+        phones[0]['phone'] if len(phones) > 0 else None,
+        emails[0]['email'] if len(emails) > 0 else None
+    )
+
+def normalize_deals(list_deals, dict_custom_fields, drop_empty: bool = True):
+    'Takes a list of raw deals (RD CRM json) and returns the normalized deals dataframe (drop_empty: drops all null custom fields).'
+    if len(list_deals) == 0:
+        return pd.DataFrame()
+    normal_deals_list = [deal_row(deal) for deal in list_deals]  # Personalized treatment to normalize json into rows
+    df_pipeline_deals = pd.DataFrame.from_records(normal_deals_list, columns=DEALS_COLUMNS)
+    # Custom fields: long table (deal row, field, value) pivoted to one column per field
+    custom_fields_list = [
+        (row, dict_custom_fields[c_field['custom_field_id']], value_to_str(c_field['value']))  # Custom fields are loaded as strings
+        for row, deal in enumerate(list_deals)
+        for c_field in deal['deal_custom_fields']
+    ]
+    if len(custom_fields_list) > 0:
+        df_long = pd.DataFrame.from_records(custom_fields_list, columns=['row', 'field', 'value'])
+        fields_order = pd.unique(df_long['field'])  # Columns in order of first appearance
+        df_long = df_long.drop_duplicates(subset=['row', 'field'], keep='last')
+        df_custom = df_long.pivot(index='row', columns='field', values='value')
+        df_custom = df_custom.reindex(index=range(len(list_deals)), columns=fields_order)
+        df_custom.columns.name = None
+        df_custom = df_custom.where(df_custom.notna(), None)  # Cells without value are null
+        # Custom fields named as a deal column overwrite it for the deals that have them
+        for column in [c for c in fields_order if c in DEALS_COLUMNS]:
+            rows = df_long.loc[df_long['field'] == column, 'row'].to_numpy()
+            df_pipeline_deals.loc[rows, column] = df_custom.loc[rows, column].to_numpy()
+        custom_columns = [c for c in fields_order if c not in DEALS_COLUMNS]
+        df_pipeline_deals = pd.concat([df_pipeline_deals, df_custom[custom_columns]], axis=1)
+    # Typing in bulk
+    for column in ['created_at', 'updated_at', 'closed_at']:
+        df_pipeline_deals[column] = pd.to_datetime(df_pipeline_deals[column])
+    amount_columns = ['amount_montly', 'amount_unique', 'amount_total']
+    df_pipeline_deals[amount_columns] = df_pipeline_deals[amount_columns].astype(float)
+    if drop_empty is True:
+        df_pipeline_deals = drop_empty_custom_fields(df_pipeline_deals)  # Drop custom fields with all null values
+    return df_pipeline_deals
+
+# Typed columns of the deals products table (any other column is typed as str)
+DEALS_PRODUCTS_DTYPES = {
+    **TIMESTAMPS,
+    'base_price': 'float',
+    'price': 'float',
+    'amount': 'float',
+    'discount': 'float',
+    'total': 'float'
+}
+
+def deals_products_rows(list_deals):
+    'Returns the rows (dictionaries) of the deals products table of a list of raw deals (RD CRM json).'
+    normal_data = []
+    for deal in list_deals:
+        if len(deal['deal_products']) > 0:
+            for prod in deal['deal_products']:
+                item = {
+                    'deal_id': deal['id'],
+                    'product_id': prod['product_id'],
+                    'name': prod['name'],
+                    'description': prod['description'],
+                    'base_price': prod['base_price'],
+                    'created_at': prod['created_at'],
+                    'updated_at': prod['updated_at'],
+                    'price': prod['price'],
+                    'amount': prod['amount'],
+                    'recurrence': prod['recurrence'],
+                    'discount': prod['discount'],
+                    'discount_type': prod['discount_type'],
+                    'total': prod['total']
+                }
+                normal_data.append(item)  
+    return normal_data
+
+def normalize_deals_products(list_deals):
+    'Takes a list of raw deals (RD CRM json) and returns a dataframe with one row per deal product.'
+    df_deals_prods = pd.DataFrame(deals_products_rows(list_deals))
+    return cast_columns(df_deals_prods, DEALS_PRODUCTS_DTYPES)
+
+def deals_contacts_rows(list_deals):
+    'Returns the rows (dictionaries) of the deals contacts table of a list of raw deals (RD CRM json).'
+    normal_data = []
+    for deal in list_deals:
+        for contact in deal.get('contacts', []):
+            normal_data.append({
+                'deal_id': deal['id'],
+                'name': contact.get('name'),
+                'title': contact.get('title'),
+                'emails': ', '.join([email['email'] for email in contact.get('emails', [])]),
+                'phones': ', '.join([phone['phone'] for phone in contact.get('phones', [])])
+            })
+    return normal_data
+
+def normalize_deals_contacts(list_deals):
+    'Takes a list of raw deals (RD CRM json) and returns a dataframe with one row per deal contact.'
+    df_deals_contacts = pd.DataFrame(deals_contacts_rows(list_deals))
+    return cast_columns(df_deals_contacts, {})
+
+def drop_empty_custom_fields(df_deals):
+    'Drops the custom fields columns of a normalized deals dataframe without any value.'
+    custom_columns = [column for column in df_deals.columns if column not in DEALS_COLUMNS]
+    if len(custom_columns) == 0:
+        return df_deals
+    filled = df_deals[custom_columns].notna().any()
+    return df_deals.drop(columns=list(filled.index[~filled]))
+
+class RateLimiter:
+    'Thread-safe token bucket: allows bursts of `burst` requests and refills at `rate` requests per second.'
+    def __init__(self, rate: float = 2.0, burst: int = 5):
+        if rate <= 0 or burst < 1:
+            raise ValueError('rate must be positive and burst must be at least 1.')
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        'Blocks until a request token is available.'
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
 class RDClient:
-    def __init__(self, token=None):
-        self.url = 'https://crm.rdstation.com/api/v1'
+    # RD CRM API base url (RD_CRM_URL environment variable or url argument point clients elsewhere, e.g. bench.mock_rd)
+    BASE_URL = 'https://crm.rdstation.com/api/v1'
+    # Status codes worth another attempt: throttling and transient server errors
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+    # RD CRM refuses deals pages beyond that number of results for a query
+    MAX_DEALS = 10000
+    # Seconds a cached response of slow changing reference entities is used without a request
+    CACHE_TTLS = {
+        'custom_fields': 3600,
+        'pipelines': 3600,
+        'pipeline_stages': 3600,
+        'users': 3600,
+        'teams': 3600,
+        'products': 3600
+    }
+
+    def __init__(
+            self,
+            token=None,
+            rate_limit: float = 2.0,
+            burst: int = 5,
+            max_retries: int = 5,
+            backoff_factor: float = 1.0,
+            max_backoff: float = 60.0,
+            pool_size: int = 16,
+            timeout: float = 60.0,
+            page_window: int = 4,
+            pipeline_workers: int = 4,
+            cache=None,
+            cache_ttls: dict = None,
+            url: str = None
+        ):
+        self.url = (url or os.environ.get('RD_CRM_URL') or self.BASE_URL).rstrip('/')
         self.token = token
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.page_window = page_window
+        self.pipeline_workers = pipeline_workers
+        # Reference entities cache (cache.MemoryCache, cache.DiskCache or None to always request)
+        self.cache = cache
+        self.cache_ttls = {**self.CACHE_TTLS, **(cache_ttls or {})}
+        # Shared keep-alive connection pool and client-side pacing (RD CRM limits requests per token)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.limiter = RateLimiter(rate=rate_limit, burst=burst)
+        self._custom_fields_lock = threading.Lock()
 
         if self.token is None:
             raise ValueError('Please, insert an access token.')
         else:
-            test_url = self.url + '/token/check'
-            params = {'token': self.token}
-            test_token = requests.get(test_url, params=params)
+            test_token = self._get('/token/check')
             if test_token.status_code != 200:
                 raise PermissionError(f'Invalid access token! RD response: {test_token.text}')   
 
+    def _backoff(self, attempt, response=None):
+        'Returns seconds to wait before the next attempt (Retry-After header or jittered exponential backoff).'
+        if response is not None:
+            retry_after = response.headers.get('Retry-After')
+            if retry_after is not None:
+                try:
+                    return min(float(retry_after), self.max_backoff)
+                except ValueError:
+                    pass
+        return random.uniform(0, min(self.max_backoff, self.backoff_factor * 2 ** attempt))
+
+    def _get(self, endpoint, params: dict = None, headers: dict = None):
+        'GET request to an RD CRM endpoint through the pooled session, with rate limiting and retries.'
+        url = self.url + endpoint
+        params = {'token': self.token, **(params or {})}
+        attempt = 0
+        while True:
+            self.limiter.acquire()
+            started = time.perf_counter()
+            try:
+                response = self.session.get(url=url, params=params, headers=headers, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as error:
+                if attempt >= self.max_retries:
+                    raise
+                metrics.record_retry(endpoint, type(error).__name__)
+                time.sleep(self._backoff(attempt))
+                attempt += 1
+                continue
+            metrics.record_request(endpoint, response.status_code, time.perf_counter() - started, len(response.content))
+            if response.status_code in self.RETRY_STATUS and attempt < self.max_retries:
+                metrics.record_retry(endpoint, response.status_code)
+                time.sleep(self._backoff(attempt, response))
+                attempt += 1
+                continue
+            return response
+
+    def _cache_key(self, entity, params: dict = None):
+        'Returns the cache key of an entity response for the account.'
+        return f'rd:{account_key(self.token)}:{entity}:{json.dumps(params or {}, sort_keys=True)}'
+
+    def _cached_json(self, entity, endpoint, params: dict = None):
+        '''
+        Returns the json response of a reference entity endpoint through the cache.
+        Cached responses younger than the entity TTL are used without a request; older ones are
+        revalidated with their ETag (If-None-Match) when the API provided one. Only successful
+        responses are cached: error responses (once retries run out) raise ValueError.
+        '''
+        if self.cache is None or entity not in self.cache_ttls:
+            response = self._get(endpoint, params)
+            if response.status_code != 200:
+                raise ValueError(f'API response: {response.text}')
+            return response.json()
+        key = self._cache_key(entity, params)
+        entry = self.cache.get(key)
+        now = time.time()
+        if entry is not None and now - entry['fetched_at'] < self.cache_ttls[entity]:
+            return entry['data']
+        headers = None
+        if entry is not None and entry.get('etag') is not None:
+            headers = {'If-None-Match': entry['etag']}
+        response = self._get(endpoint, params, headers=headers)
+        if response.status_code == 304 and entry is not None:
+            entry = {**entry, 'fetched_at': now}
+        elif response.status_code != 200:
+            raise ValueError(f'API response: {response.text}')
+        else:
+            entry = {'data': response.json(), 'etag': response.headers.get('ETag'), 'fetched_at': now}
+        self.cache.set(key, entry)
+        return entry['data']
+
+    def invalidate_cache(self, entity: str = None):
+        'Removes the cached responses of an entity (or of every entity) of the account.'
+        if self.cache is None:
+            return
+        if entity is None:
+            self.cache.delete_prefix(f'rd:{account_key(self.token)}:')
+        else:
+            self.cache.delete_prefix(f'rd:{account_key(self.token)}:{entity}:')
+
+    def _beyond_page_limit(self, response, page, params):
+        'Whether an error response is RD refusing a page beyond the MAX_DEALS results of a query (the end of the pagination).'
+        return response.status_code == 400 and page * int(params.get('limit', 200)) > self.MAX_DEALS
+
+    def _paginate(self, endpoint, list_key, params: dict = None, window: int = None):
+        '''
+        Yields the list of items of each page from a paginated endpoint, in page order.
+        After the first page, up to `window` pages are fetched ahead concurrently; it stops at the
+        first page with has_more false or refused beyond the MAX_DEALS results limit. Any other
+        error response (once retries run out) raises ValueError.
+        Inside RDClient.checkpointing, pages are spilled to the checkpoint store and pages already
+        there (from a failed run) are read from disk instead of requested.
+        '''
+        window = window or self.page_window
+        params = dict(params or {})
+        checkpoint = current_checkpoint.get()
+        entity = CheckpointStore.entity_key(endpoint, params)
+
+        def fetch(page):
+            if checkpoint is not None and checkpoint.has_page(entity, page):
+                items, has_more = checkpoint.read_page(entity, page)
+                return {list_key: items, 'has_more': has_more}
+            response = self._get(endpoint, {**params, 'page': page})
+            if response.status_code != 200:
+                if page > 1 and self._beyond_page_limit(response, page, params):
+                    return {'has_more': False}
+                raise ValueError(f'API response: {response.text}')
+            response_json = response.json()
+            if checkpoint is not None and list_key in response_json:
+                checkpoint.write_page(entity, page, response_json[list_key], response_json.get('has_more'))
+            return response_json
+
+        response_json = fetch(1)
+        yield response_json[list_key]
+        if response_json.get('has_more') is not True:
+            return
+        executor = ThreadPoolExecutor(max_workers=window)
+        pending = deque()
+        next_page = 2
+        try:
+            while True:
+                while len(pending) < window:
+                    # Each page is fetched in a copy of the caller context (current run metrics)
+                    pending.append(executor.submit(contextvars.copy_context().run, fetch, next_page))
+                    next_page += 1
+                response_json = pending.popleft().result()
+                if list_key not in response_json:
+                    break  # Page beyond the results limit
+                yield response_json[list_key]
+                if response_json.get('has_more') is not True:
+                    break
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _map_concurrently(self, func, items, max_workers: int = None):
+        'Applies func to each item (e.g. pipeline ids), concurrently when max_workers > 1, returning results in input order.'
+        max_workers = max_workers or self.pipeline_workers
+        if max_workers <= 1 or len(items) <= 1:
+            return [func(item) for item in items]
+        # Each task runs in a copy of the caller context (e.g. the current checkpoint store)
+        contexts = [contextvars.copy_context() for item in items]
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+            return list(executor.map(lambda context, item: context.run(func, item), contexts, items))
+
+    @contextlib.contextmanager
+    def checkpointing(self, checkpoint):
+        'Context in which paginated requests (of this thread and its pipeline workers) are checkpointed in the store.'
+        token = current_checkpoint.set(checkpoint)
+        try:
+            yield checkpoint
+        finally:
+            current_checkpoint.reset(token)
+
+    def fetch_entity(self, name, params: dict = None):
+        'Returns the list of raw items (RD CRM json) of a reference entity spec (see entities.ENTITIES).'
+        spec = ENTITIES[name]
+        params = {**spec.params, **(params or {})}
+        if spec.paginated is True:
+            return [item for page in self._paginate(spec.endpoint, spec.list_key, params) for item in page]
+        return spec.items(self._cached_json(name, spec.endpoint, params))
+
+    def entity(self, name, params: dict = None, backend: str = 'pandas'):
+        '''
+        Returns the typed dataframe of a reference entity spec (see entities.ENTITIES).
+        backend: 'pandas' or 'arrow' (returns a pyarrow.Table, see arrow_backend).
+        '''
+        with metrics.stage('extract', name):
+            items = self.fetch_entity(name, params)
+        with metrics.stage('normalize', name):
+            if backend == 'arrow':
+                return arrow_backend.entity_table(ENTITIES[name], items)
+            return ENTITIES[name].to_frame(items)
+
     def custom_fields(self, output: str = 'both'):
         'Returns dataframe and dictionary of custom fields from the account.'
         valid_out = ['both', 'df', 'dict']
         if valid_out.count(output) != 1:
             raise ValueError(f'Invalid output value called! Please call one of the options: {valid_out}')
-        url = self.url + '/custom_fields'
-        params = {'token': self.token}
-        response = requests.get(url=url, params=params)
-        response_json = response.json()
-        df_custom_fields = pd.json_normalize(response_json)
-        df_custom_fields.columns = [col_name.replace('.', '_') for col_name in df_custom_fields.columns]
-        for column in df_custom_fields.columns:
-            if column == 'created_at' or column == 'updated_at':
-                df_custom_fields[column] = pd.to_datetime(df_custom_fields[column])
-            elif column == 'required' or column == 'allow_new':
-                df_custom_fields[column] = df_custom_fields[column].astype(bool)
-            elif column == 'order':
-                df_custom_fields[column] = df_custom_fields[column].astype(int)
-            else:
-                df_custom_fields[column] = df_custom_fields[column].astype(str)
+        df_custom_fields = self.entity('custom_fields')
         dict_custom_fields = dict(zip(
             df_custom_fields['id'],
             df_custom_fields['label'].apply(text_to_snakecase)
@@ -61,25 +470,31 @@ class RDClient:
         elif output == 'dict':
             return dict_custom_fields
 
+    def refresh_custom_fields(self, list_deals, dict_custom_fields, strict: bool = True):
+        '''
+        Adds to dict_custom_fields (in place, so every holder of the dictionary sees them) the custom
+        fields of raw deals created after it was fetched: on an unknown custom field id the cached
+        custom fields are invalidated and refetched once. Returns dict_custom_fields.
+        strict: Raises ValueError for ids still unknown after the refetch (False leaves them to the caller).
+        '''
+        fields = {c_field['custom_field_id'] for deal in list_deals for c_field in deal['deal_custom_fields']}
+        if fields.issubset(dict_custom_fields):
+            return dict_custom_fields
+        with self._custom_fields_lock:
+            if not fields.issubset(dict_custom_fields):  # Unless another thread already refreshed them
+                self.invalidate_cache('custom_fields')
+                dict_custom_fields.update(self.custom_fields(output='dict'))
+        unknown = fields.difference(dict_custom_fields)
+        if len(unknown) > 0 and strict is True:
+            raise ValueError(f'Unknown custom fields {sorted(unknown)} in deals, not found in the account custom fields.')
+        return dict_custom_fields
+
     def pipelines(self, output: str = 'both'):
         'Returns dataframe and dictionary ({id: name}) of pipelines from RD CRM account (until 200 pipelines).'
         valid_out = ['both', 'df', 'dict']
         if valid_out.count(output) != 1:
             raise ValueError(f'Invalid output value called! Please call one of the options: {valid_out}')
-        url = self.url + '/deal_pipelines'
-        params = {
-            'token': self.token,
-            'limit': 200
-        }
-        response = requests.get(url=url, params=params)
-        response_json = response.json()
-        df_pipelines = pd.json_normalize(response_json).drop(columns=['deal_stages'])
-        df_pipelines.columns = [col_name.replace('.', '_') for col_name in df_pipelines.columns]
-        for column in df_pipelines.columns:
-            if column == 'order':
-                df_pipelines[column] = df_pipelines[column].astype(int)
-            else:  
-                df_pipelines[column] = df_pipelines[column].astype(str)
+        df_pipelines = self.entity('pipelines')
         dict_pipelines = dict(zip(
             df_pipelines['id'],
             df_pipelines['name'].apply(text_to_snakecase)
@@ -91,337 +506,238 @@ class RDClient:
         elif output == 'dict':
             return dict_pipelines
 
-    def pipeline_stages(self, pipeline_id):
+    def pipeline_stages(self, pipeline_id, backend: str = 'pandas'):
         'Returns pipeline stages.'
-        url = self.url + '/deal_stages'
-        params = {
-            'token': self.token,
-            'deal_pipeline_id': pipeline_id,
-            'limit': 12
-        }
-        response = requests.get(url=url, params=params)
-        response_json = response.json()
-        df_pipeline_stages = pd.json_normalize(response_json['deal_stages'])
-        df_pipeline_stages.columns = [col_name.replace('.', '_') for col_name in df_pipeline_stages.columns]
-        for column in df_pipeline_stages.columns:
-            if column == 'created_at' or column == 'updated_at':
-                df_pipeline_stages[column] = pd.to_datetime(df_pipeline_stages[column])
-            elif column == 'order':
-                df_pipeline_stages[column] = df_pipeline_stages[column].astype(int)
-            else:
-                df_pipeline_stages[column] = df_pipeline_stages[column].astype(str)
-        return df_pipeline_stages
+        return self.entity('pipeline_stages', {'deal_pipeline_id': pipeline_id}, backend=backend)
 
-    def general_stages(self, dict_pipelines):
-        'Returns table with all stages from rd account'
+    def general_stages(self, dict_pipelines, max_workers: int = None, backend: str = 'pandas'):
+        '''
+        Returns table with all stages from rd account (pipelines are fetched by up to max_workers threads).
+        backend: 'pandas' or 'arrow' (returns a pyarrow.Table, see arrow_backend).
+        '''
         pipelines_ids = list(dict_pipelines.keys())
-        df_stages = pd.DataFrame()
-        for pipeline in pipelines_ids:
-            df_stages_upd = self.pipeline_stages(pipeline_id=pipeline)
-            df_stages_upd = df_stages_upd[[
-                'deal_pipeline_id',
-                'deal_pipeline_name', 
-                'id', 
-                'name', 
-                'nickname', 
-                'order', 
-                'created_at',
-                'updated_at',
-                'objective',
-                'description'
-            ]]
-            df_stages = pd.concat([df_stages, df_stages_upd], ignore_index=True)
+        columns = [
+            'deal_pipeline_id',
+            'deal_pipeline_name', 
+            'id', 
+            'name', 
+            'nickname', 
+            'order', 
+            'created_at',
+            'updated_at',
+            'objective',
+            'description'
+        ]
+        if backend == 'arrow':
+            list_stages = self._map_concurrently(
+                lambda pipeline: self.pipeline_stages(pipeline_id=pipeline, backend='arrow').select(columns),
+                pipelines_ids,
+                max_workers=max_workers
+            )
+            return arrow_backend.encode_low_cardinality(arrow_backend.concat_tables(list_stages))
+        list_stages = self._map_concurrently(
+            lambda pipeline: self.pipeline_stages(pipeline_id=pipeline)[columns],
+            pipelines_ids,
+            max_workers=max_workers
+        )
+        if len(list_stages) == 0:
+            return pd.DataFrame()
+        df_stages = pd.concat(list_stages, ignore_index=True)
         return df_stages
 
     def sources(self):
         'Returns dataframe with all sources from account.'
-        url = self.url + '/deal_sources'
-        page = 1
-        params = {
-            'token': self.token,
-            'page': page,
-            'limit': 200
-        }
-        response = requests.get(url=url, params=params)
-        response_json = response.json()
-        sources_list = response_json['deal_sources']
-        while response_json['has_more'] is True:
-            page += 1
-            params.update({'page': page})
-            response = requests.get(url=url, params=params)
-            response_json = response.json()
-            sources_list.extend(response_json['deal_sources'])
-        df_sources = pd.json_normalize(sources_list)
-        df_sources.columns = [col_name.replace('.', '_') for col_name in df_sources.columns]
-        for column in df_sources.columns:
-            if column == 'created_at' or column == 'updated_at':
-                df_sources[column] = pd.to_datetime(df_sources[column])
-            else:
-                df_sources[column] = df_sources[column].astype(str)
-        return df_sources
+        return self.entity('sources')
     
     def products(self):
         'Returns dataframe of products from the account (Max.: 200 - 1st page).'
-        url = self.url + '/products'
-        params = {
-            'token': self.token,
-            'limit': 200
-        }
-        response = requests.get(url=url, params=params)
-        response_json = response.json()
-        products_list  = response_json['products']
-        df_products = pd.json_normalize(products_list)
-        df_products.columns = [col_name.replace('.', '_') for col_name in df_products.columns]
-        for column in df_products.columns:
-            if column == 'updated_at' or column == 'created_at':
-                df_products[column] = pd.to_datetime(df_products[column])
-            elif column == 'base_price':
-                df_products[column] = df_products[column].astype(float)
-            elif column == 'visible':
-                df_products[column] = df_products[column].astype(bool)
-            else:
-                df_products[column] = df_products[column].astype(str)
-        return df_products
-
+        return self.entity('products')
 
     def teams(self):
         'Returns dataframe of teams from the account.'
-        url = self.url + '/teams'
-        params = {'token': self.token}
-        response = requests.get(url=url, params=params)
-        response_json = response.json()
-        teams_list = response_json['teams']
-        normal_teams_list = []
-        for team in teams_list:
-            user_ids = []
-            usernames = []
-            for user in team['team_users']:
-                user_ids.append(user['id'])
-                usernames.append(user['name'])
-            normal_item = {
-                'id': team['id'],
-                'name': team['name'],
-                'created_at': team['created_at'],
-                'updated_at': team['updated_at'],
-                'user_ids': ', '.join(user_ids),
-                'usernames': ', '.join(usernames)
-            }
-            normal_teams_list.append(normal_item)
-        df_teams = pd.json_normalize(normal_teams_list)
-        for column in df_teams.columns:
-            if column == 'created_at' or column == 'updated_at':
-                df_teams[column] = pd.to_datetime(df_teams[column])
-            else:
-                df_teams[column] = df_teams[column].astype(str)
-        return df_teams
+        return self.entity('teams')
 
     def users(self):
         'Returns dataframe of users from the account.'
-        url = self.url + '/users'
-        params = {'token': self.token}
-        response = requests.get(url=url, params=params)
-        response_json = response.json()
-        users_list = response_json['users']
-        df_users = pd.json_normalize(users_list)
-        df_users.columns = [col_name.replace('.', '_') for col_name in df_users.columns]
-        for column in df_users.columns:
-            if column == 'created_at' or column == 'updated_at' or column == 'last_login':
-                df_users[column] = pd.to_datetime(df_users[column])
-            elif column == 'active' or column == 'hidden':
-                df_users[column] = df_users[column].astype(bool)
-            else:
-                df_users[column] = df_users[column].astype(str)
-        return df_users
+        return self.entity('users')
 
     def deal_lost_reasons(self):
         'Returns dataframe of lost reasons for account.'
-        url = self.url + '/deal_lost_reasons'
-        page = 1
+        return self.entity('deal_lost_reasons')
+
+    def campaigns(self):
+        'Returns dataframe of campaigns from account.'
+        return self.entity('campaigns')
+
+    def _deals_window_params(self, params, start, end):
+        'Returns deals request params filtered by creation between start and end dates (both inclusive).'
+        return {
+            **params,
+            'created_at_period': 'true',
+            'start_date': start.isoformat(),
+            'end_date': end.isoformat()
+        }
+
+    def _split_window(self, start, end):
+        'Splits a date window in two non overlapping halves.'
+        middle = start + (end - start) // 2
+        return (start, middle), (middle + datetime.timedelta(days=1), end)
+
+    def _day_limit_message(self, params, day):
+        'Error message of a day whose deals reach the API limit (a window that cannot be split further).'
+        return (
+            f'Deals of pipeline {params.get("deal_pipeline_id")} created on {day} reach the API limit of '
+            f'{self.MAX_DEALS} deals, they cannot be extracted completely by created_at windows.'
+        )
+
+    def _plan_deal_windows(self, params, start, end):
+        'Returns created_at date windows covering [start, end] with less than MAX_DEALS deals each.'
+        window_params = self._deals_window_params(params, start, end)
+        response = self._get('/deals', {**window_params, 'page': 1, 'limit': 1})
+        if response.status_code != 200:
+            raise ValueError(f'API response: {response.text}')
+        total = response.json().get('total')
+        if total == 0:
+            return []
+        if total is not None and total >= self.MAX_DEALS and start == end:
+            raise ValueError(self._day_limit_message(params, start))
+        if total is None or total < self.MAX_DEALS:
+            return [(start, end)]
+        first_half, second_half = self._split_window(start, end)
+        return self._plan_deal_windows(params, *first_half) + self._plan_deal_windows(params, *second_half)
+
+    def _fetch_deal_window(self, params, window):
+        '''
+        Returns the deals created in a date window, narrowing it again if it still hits the API limit.
+        Raises ValueError when a single day reaches the limit, instead of returning a truncated list.
+        '''
+        start, end = window
+        window_params = self._deals_window_params(params, start, end)
+        list_deals = [deal for page in self._paginate('/deals', 'deals', window_params) for deal in page]
+        if len(list_deals) >= self.MAX_DEALS:
+            if start < end:
+                first_half, second_half = self._split_window(start, end)
+                return self._fetch_deal_window(params, first_half) + self._fetch_deal_window(params, second_half)
+            raise ValueError(self._day_limit_message(params, start))
+        return list_deals
+
+    def sharded_deals(self, pipeline_id, max_workers: int = None):
+        '''
+        Returns the list of all deals from a pipeline, beyond the API limit of 10.000 deals.
+        The pipeline is split in created_at date windows under the limit, which are fetched
+        by up to max_workers threads, and deals are deduplicated by id. Raises ValueError if the
+        deals created on a single day reach the limit.
+        '''
         params = {
-            'token': self.token,
-            'page': page,
+            'deal_pipeline_id': pipeline_id,
             'limit': 200
         }
-        response = requests.get(url=url, params=params)
-        response_json = response.json()
-        list_lost_reasons = response_json['deal_lost_reasons']
-        while response_json['has_more'] is True:
-            page += 1
-            params.update({'page': page})
-            response = requests.get(url=url, params=params)
-            response_json = response.json()
-            list_lost_reasons.extend(response_json['deal_lost_reasons'])
-        df_deal_lost_reasons = pd.json_normalize(list_lost_reasons)
-        df_deal_lost_reasons.columns = [col_name.replace('.', '_') for col_name in df_deal_lost_reasons.columns]
-        for column in df_deal_lost_reasons.columns:
-            if column == 'created_at' or column == 'updated_at':
-                df_deal_lost_reasons[column] = pd.to_datetime(df_deal_lost_reasons[column])
-            else:
-                df_deal_lost_reasons[column] = df_deal_lost_reasons[column].astype(str)
-        return df_deal_lost_reasons
+        response = self._get('/deals', {**params, 'order': 'created_at', 'direction': 'asc', 'page': 1, 'limit': 1})
+        if response.status_code != 200:
+            raise ValueError(f'API response: {response.text}')
+        first_deal = response.json()['deals']
+        if len(first_deal) == 0:
+            return []
+        start = pd.Timestamp(first_deal[0]['created_at']).date()
+        end = datetime.date.today() + datetime.timedelta(days=1)  # Margin for account timezone
+        windows = self._plan_deal_windows(params, start, end)
+        list_windows = self._map_concurrently(
+            lambda window: self._fetch_deal_window(params, window),
+            windows,
+            max_workers=max_workers
+        )
+        dict_deals = {}
+        for list_deals in list_windows:
+            for deal in list_deals:
+                dict_deals[deal['id']] = deal
+        return list(dict_deals.values())
 
-    def campaigns(self):
-        'Returns dataframe of campaigns from account.'
-        url = self.url + '/campaigns'
-        page = 1
+    def pipeline_deal_pages(self, pipeline_id):
+        'Yields the raw deals (RD CRM json) from a pipeline one page at a time (until 10.000 deals).'
         params = {
-            'token': self.token,
-            'page': page,
+            'deal_pipeline_id': pipeline_id,
             'limit': 200
         }
-        response = requests.get(url=url, params=params)
-        response_json = response.json()
-        list_campaigns = response_json['campaigns']
-        while response_json['has_more'] is True:
-            page += 1
-            params.update({'page': page})
-            response = requests.get(url=url, params=params)
-            response_json = response.json()
-            list_campaigns.extend(response_json['campaigns'])
-        df_campaign = pd.json_normalize(list_campaigns)
-        df_campaign.columns = [col_name.replace('.', '_') for col_name in df_campaign.columns]
-        for column in df_campaign.columns:
-            if column == 'created_at' or column == 'updated_at':
-                df_campaign[column] = pd.to_datetime(df_campaign[column])
-            else:
-                df_campaign[column] = df_campaign[column].astype(str)
-        return df_campaign
+        yield from self._paginate('/deals', 'deals', params)
 
-    def pipeline_deals(self, pipeline_id, dict_custom_fields, output: str = 'df'):
-        'Returns dataframe of deals from pipeline (until 10.000 deals).'
+    def pipeline_deals(self, pipeline_id, dict_custom_fields, output: str = 'df', updated_since=None, sharded: bool = False):
+        '''
+        Returns dataframe of deals from pipeline (until 10.000 deals, unless sharded).
+        updated_since: Only returns deals updated after that timestamp (deals are requested by
+        most recently updated and pagination stops at the first older deal).
+        sharded: Extracts deals by created_at date windows to get all deals from large pipelines.
+        '''
         valid_out = ['both', 'df', 'list']
         if valid_out.count(output) != 1:
             raise ValueError(f'Invalid output value called! Please call one of the options: {valid_out}')
+        if sharded is True and updated_since is not None:
+            raise ValueError('sharded and updated_since can not be used together.')
         # Data extraction
-        url = self.url + '/deals'
-        page = 1
+        endpoint = '/deals'
         params = {
-            'token': self.token,
-            'page': page,
             'deal_pipeline_id': pipeline_id,
             'limit': 200
         }
-        response = requests.get(url=url, params=params)
-        response_json = response.json()
-        list_deals = response_json['deals']
-        while response_json['has_more'] is True:
-            try:
-                page += 1
-                params.update({'page': page})
-                response = requests.get(url=url, params=params)
-                response_json = response.json()
-                list_deals.extend(response_json['deals'])
-            except KeyError:
-                break
+        with metrics.stage('extract', 'deals', detail=pipeline_id):
+            if sharded is True:
+                list_deals = self.sharded_deals(pipeline_id=pipeline_id)
+            elif updated_since is None:
+                list_deals = [deal for page in self._paginate(endpoint, 'deals', params) for deal in page]
+            else:
+                updated_since = pd.Timestamp(updated_since)
+                if updated_since.tzinfo is None:
+                    updated_since = updated_since.tz_localize('UTC')
+                params.update({'order': 'updated_at', 'direction': 'desc'})
+                list_deals = []
+                for page in self._paginate(endpoint, 'deals', params):
+                    changed = [deal for deal in page if pd.Timestamp(deal['updated_at']) > updated_since]
+                    list_deals.extend(changed)
+                    if len(changed) < len(page):
+                        break
         if output == 'list':
             return list_deals
         else:
-            normal_deals_list =[]  # Personalized treatment to normalize json into dataframe
-            for deal in list_deals:
-                custom_fields = {}  # Extracting custom fields values
-                for c_field in deal['deal_custom_fields']:
-                    custom_fields.update({
-                        dict_custom_fields[c_field['custom_field_id']]: c_field['value']
-                    })
-                prod_list = []  # List for products field
-                for prod in deal['deal_products']:
-                    prod_list.append(prod['name'])
-                contact = {}  # Building 1st contact values
-                if len(deal['contacts']) > 0:
-                    contact.update({'name': deal['contacts'][0]['name']})
-                    if len(deal['contacts'][0]['emails']) > 0:
-                        contact.update({'email': deal['contacts'][0]['emails'][0]['email']})
-                    if len(deal['contacts'][0]['phones']) > 0:
-                        contact.update({'phone': deal['contacts'][0]['phones'][0]['phone']})
-                normal_deal = {
-                    'id': deal['id'],
-                    'name': deal['name'],
-                    'organization': deal.get('organization', {}).get('name'),
-                    'win': deal['win'],
-                    'stage': deal['deal_stage']['name'],
-                    'user': deal['user']['name'],
-                    'created_at': deal['created_at'],
-                    'updated_at': deal['updated_at'],
-                    'closed_at': deal['closed_at'],
-                    'amount_montly': deal['amount_montly'],
-                    'amount_unique': deal['amount_unique'],
-                    'amount_total': deal['amount_total'],
-                    'source': deal.get('deal_source', {}).get('name'),
-                    'campaign': deal.get('campaign', {}).get('name'),
-                    'lost_reason': deal.get('deal_lost_reason', {}).get('name'),
-                    'products': ', '.join(prod_list),
-                    'contact_name': contact.get('name', {}),
-                    'phone': contact.get('phone', {}),
-                    'email': contact.get('email', {})
-                }
-                normal_deal.update(custom_fields)
-                normal_deals_list.append(normal_deal)
-            df_pipeline_deals = pd.json_normalize(normal_deals_list)
-            for column in df_pipeline_deals:
-                if column == 'created_at' or column == 'updated_at' or column == 'closed_at':
-                    df_pipeline_deals[column] = pd.to_datetime(df_pipeline_deals[column])
-                elif column == 'amount_montly' or column == 'amount_unique' or column == 'amount_total':
-                    df_pipeline_deals[column] = df_pipeline_deals[column].astype(float)
-                elif df_pipeline_deals[column].notna().any() == np.False_ and list(df_pipeline_deals.columns).index(column) > 18:
-                    df_pipeline_deals.drop(columns=column, inplace=True)  # Drop custom fields with all null values
+            self.refresh_custom_fields(list_deals, dict_custom_fields)
+            pool = normalize_pool()
+            with metrics.stage('normalize', 'deals', detail=pipeline_id):
+                if pool is not None and len(list_deals) > pool.batch_size:
+                    # Batches normalized by the worker processes (see workers.normalize_pool)
+                    list_dfs = pool.map_batches(normalize_deals, list_deals, dict_custom_fields=dict_custom_fields, drop_empty=False)
+                    df_pipeline_deals = drop_empty_custom_fields(pd.concat(list_dfs, ignore_index=True))
+                else:
+                    df_pipeline_deals = normalize_deals(list_deals, dict_custom_fields)
         if output == 'df':
             return df_pipeline_deals
         elif output == 'both':
             return df_pipeline_deals, list_deals
 
-    def all_pipeline_deals(self, dict_custom_fields, dict_pipelines):
-        'Returns a dictionary of deals dataframes for each deal pipeline from the account.'
+    def all_pipeline_deals(self, dict_custom_fields, dict_pipelines, max_workers: int = None, sharded: bool = False):
+        'Returns a dictionary of deals dataframes for each deal pipeline from the account (up to max_workers pipelines at once).'
+        pipelines_ids = list(dict_pipelines.keys())
+        list_dfs = self._map_concurrently(
+            lambda pipeline: self.pipeline_deals(pipeline_id=pipeline, dict_custom_fields=dict_custom_fields, sharded=sharded),
+            pipelines_ids,
+            max_workers=max_workers
+        )
         dict_deals_dfs = {}
-        for id, deal_pipeline in dict_pipelines.items():
-            df_pipeline_deals = self.pipeline_deals(pipeline_id=id, dict_custom_fields=dict_custom_fields)
-            dict_deals_dfs.update({f'deals_{deal_pipeline}': df_pipeline_deals})
+        for id, df_pipeline_deals in zip(pipelines_ids, list_dfs):
+            dict_deals_dfs.update({f'deals_{dict_pipelines[id]}': df_pipeline_deals})
         return dict_deals_dfs
     
     def deals_products(self, pipeline_id, data:list=None):
+        'Returns dataframe of products from deals (from data, or deals with products in the pipeline if data is None).'
         if data is None:
-            url = self.url + '/deals'
-            page = 1
+            endpoint = '/deals'
             params = {
-                'token': self.token,
                 'pipeline_id': pipeline_id,
                 'product_presence': 'true',
-                'page': page,
                 'limit': 200
             }
-            response = requests.get(url, params=params)
-            if response.status_code == 200:
-                response_json = response.json()
-                data = response_json['deals']
-                while response_json['has_more'] == True:
-                    page += 1
-                    params.update({'page': page})
-                    try:
-                        response = requests.get(url, params=params)
-                        response_json = response.json()
-                        data.extend(response_json['deals'])
-                    except KeyError:
-                        break
-            else:
-                raise ValueError(f'API response: {response.text}')
-        normal_data = []
-        for deal in data:
-            if len(deal['deal_products']) > 0:
-                for prod in deal['deal_products']:
-                    item = {
-                        'deal_id': deal['id'],
-                        'product_id': prod['product_id'],
-                        'name': prod['name'],
-                        'description': prod['description'],
-                        'base_price': prod['base_price'],
-                        'created_at': prod['created_at'],
-                        'updated_at': prod['updated_at'],
-                        'price': prod['price'],
-                        'amount': prod['amount'],
-                        'recurrence': prod['recurrence'],
-                        'discount': prod['discount'],
-                        'discount_type': prod['discount_type'],
-                        'total': prod['total']
-                    }
-                    normal_data.append(item)  
-        df_deals_prods = pd.DataFrame(normal_data)
-        return  df_deals_prods
\ No newline at end of file
+            with metrics.stage('extract', 'deals_products', detail=pipeline_id):
+                data = [deal for page in self._paginate(endpoint, 'deals', params) for deal in page]
+        pool = normalize_pool()
+        with metrics.stage('normalize', 'deals_products', detail=pipeline_id):
+            if pool is not None and len(data) > pool.batch_size:
+                list_dfs = [df for df in pool.map_batches(normalize_deals_products, data) if df.shape[0] > 0]
+                return pd.concat(list_dfs, ignore_index=True) if len(list_dfs) > 0 else pd.DataFrame()
+            return normalize_deals_products(data)
\ No newline at end of file
@@ -0,0 +1,99 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+import threading
+import time
+import uuid
+
+
+class Job:
+    'State of a job executed in background, with the progress of each table.'
+    def __init__(self, kind: str, key: tuple):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.key = key
+        self.status = 'queued'
+        self.tables = {}
+        self.result = None
+        self.error = None
+        self.errors = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._lock = threading.Lock()
+
+    def progress(self, table_id, status):
+        'Progress callback: records the status of a table (e.g. loading, loaded, failed).'
+        with self._lock:
+            self.tables[table_id] = status
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'job_id': self.id,
+                'kind': self.kind,
+                'status': self.status,
+                'tables': dict(self.tables),
+                'error': self.error,
+                'errors': self.errors,
+                'created_at': self.created_at,
+                'started_at': self.started_at,
+                'finished_at': self.finished_at
+            }
+
+class JobRunner:
+    '''
+    Runs jobs on a bounded pool of background threads.
+    Jobs are identified by a key (e.g. job kind, account and dataset): submitting a key that is
+    already queued or running returns the existing job instead of running it twice.
+    Finished jobs are kept for status queries, up to max_history jobs.
+    '''
+    def __init__(self, max_workers: int = 2, max_history: int = 500):
+        self.max_history = max_history
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self._jobs = OrderedDict()
+        self._active = {}
+        self._lock = threading.Lock()
+
+    def submit(self, kind: str, key: tuple, func, **kwargs):
+        '''
+        Schedules func(progress=job.progress, **kwargs) and returns (job, created).
+        created is False when an active job with the same key was returned instead.
+        '''
+        with self._lock:
+            job = self._active.get(key)
+            if job is not None:
+                return job, False
+            job = Job(kind=kind, key=key)
+            self._jobs[job.id] = job
+            self._active[key] = job
+        self._executor.submit(self._run, job, func, kwargs)
+        return job, True
+
+    def _run(self, job, func, kwargs):
+        job.status = 'running'
+        job.started_at = time.time()
+        try:
+            job.result = func(progress=job.progress, **kwargs)
+            job.status = 'succeeded'
+        except Exception as error:
+            job.error = f'{type(error).__name__}: {error}'
+            job.result = getattr(error, 'result', None)  # Partial results (e.g. timings of a batch)
+            if isinstance(getattr(error, 'errors', None), dict):
+                job.errors = {table_id: str(table_error) for table_id, table_error in error.errors.items()}
+            job.status = 'failed'
+        finally:
+            job.finished_at = time.time()
+            with self._lock:
+                self._active.pop(job.key, None)
+                self._prune()
+
+    def _prune(self):
+        'Forgets the oldest finished jobs beyond max_history (caller holds the lock).'
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished_at is not None]
+        for job_id in finished[:max(0, len(self._jobs) - self.max_history)]:
+            del self._jobs[job_id]
+
+    def get(self, job_id):
+        'Returns a job by id, or None if it is unknown.'
+        with self._lock:
+            return self._jobs.get(job_id)
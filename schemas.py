@@ -0,0 +1,61 @@
+from rd import account_key
+from entities import ENTITIES
+from lazy import LazyModule
+import threading
+
+bigquery = LazyModule('google.cloud.bigquery')
+
+# BigQuery types of the typed columns of each table built by RDClient (any other column,
+# including deals custom fields, is loaded as STRING); reference tables come from their entity specs
+TIMESTAMPS = {'created_at': 'TIMESTAMP', 'updated_at': 'TIMESTAMP'}
+TABLE_TYPES = {
+    **{spec.table: spec.bq_types() for spec in ENTITIES.values() if spec.table is not None},
+    'deals': {
+        **TIMESTAMPS,
+        'closed_at': 'TIMESTAMP',
+        'win': 'BOOLEAN',
+        'amount_montly': 'FLOAT',
+        'amount_unique': 'FLOAT',
+        'amount_total': 'FLOAT'
+    },
+    'deals_products': {
+        **TIMESTAMPS,
+        'base_price': 'FLOAT',
+        'price': 'FLOAT',
+        'amount': 'FLOAT',
+        'discount': 'FLOAT',
+        'total': 'FLOAT'
+    },
+    'deals_contacts': {}
+}
+
+class SchemaCache:
+    'Thread-safe cache of explicit BigQuery schemas, per account, table entity and columns.'
+    def __init__(self):
+        self._schemas = {}
+        self._lock = threading.Lock()
+
+    def get(self, account, entity, columns):
+        'Returns the schema of a table entity (e.g. "users", "deals") with the given columns.'
+        if entity not in TABLE_TYPES:
+            raise ValueError(f'Invalid table entity! Please call one of the options: {list(TABLE_TYPES)}')
+        key = (account, entity, tuple(columns))
+        with self._lock:
+            schema = self._schemas.get(key)
+        if schema is None:
+            types = TABLE_TYPES[entity]
+            schema = [bigquery.SchemaField(column, types.get(column, 'STRING')) for column in columns]
+            with self._lock:
+                self._schemas[key] = schema
+        return schema
+
+    def invalidate(self, account=None):
+        'Removes the cached schemas of an account (or all of them).'
+        with self._lock:
+            if account is None:
+                self._schemas.clear()
+            else:
+                self._schemas = {key: schema for key, schema in self._schemas.items() if key[0] != account}
+
+# Process-wide schemas cache
+schema_cache = SchemaCache()
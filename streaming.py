@@ -0,0 +1,143 @@
+import os
+import tempfile
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from rd import normalize_deals, value_to_str
+
+# Arrow types of the deals table columns built by rd.normalize_deals (custom fields are strings)
+DEALS_BASE_SCHEMA = pa.schema([
+    ('id', pa.string()),
+    ('name', pa.string()),
+    ('organization', pa.string()),
+    ('win', pa.bool_()),
+    ('stage', pa.string()),
+    ('user', pa.string()),
+    ('created_at', pa.timestamp('us', tz='UTC')),
+    ('updated_at', pa.timestamp('us', tz='UTC')),
+    ('closed_at', pa.timestamp('us', tz='UTC')),
+    ('amount_montly', pa.float64()),
+    ('amount_unique', pa.float64()),
+    ('amount_total', pa.float64()),
+    ('source', pa.string()),
+    ('campaign', pa.string()),
+    ('lost_reason', pa.string()),
+    ('products', pa.string()),
+    ('contact_name', pa.string()),
+    ('phone', pa.string()),
+    ('email', pa.string())
+])
+
+def deals_arrow_schema(dict_custom_fields):
+    'Returns the arrow schema of a deals table with every custom field from the account.'
+    fields = list(DEALS_BASE_SCHEMA)
+    names = set(DEALS_BASE_SCHEMA.names)
+    for custom_field in dict_custom_fields.values():
+        if custom_field not in names:
+            fields.append(pa.field(custom_field, pa.string()))
+            names.add(custom_field)
+    return pa.schema(fields)
+
+def deals_record_batch(df_deals, schema):
+    'Converts a normalized deals dataframe in a record batch with the given schema (missing columns are null).'
+    arrays = []
+    for field in schema:
+        if field.name not in df_deals.columns:
+            arrays.append(pa.nulls(df_deals.shape[0], type=field.type))
+            continue
+        column = df_deals[field.name]
+        if pa.types.is_timestamp(field.type):
+            column = pd.to_datetime(column, utc=True)
+        elif pa.types.is_string(field.type):
+            column = column.map(value_to_str)
+        arrays.append(pa.Array.from_pandas(column, type=field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+class DealsParquetWriter:
+    '''
+    Normalizes deals pages as they arrive and appends them to a local parquet file, so
+    memory is bounded by a page instead of the whole pipeline.
+    Custom fields added to dict_custom_fields while writing (see RDClient.refresh_custom_fields)
+    start a new part file with the wider schema; parts are joined in the file when it is closed.
+    Custom fields without any value are dropped from the file when it is closed.
+    '''
+    def __init__(self, dict_custom_fields, path: str = None):
+        self.dict_custom_fields = dict_custom_fields
+        self.schema = deals_arrow_schema(dict_custom_fields)
+        if path is None:
+            file_descriptor, path = tempfile.mkstemp(suffix='.parquet')
+            os.close(file_descriptor)
+        self.path = path
+        self.num_rows = 0
+        self._filled_columns = set(DEALS_BASE_SCHEMA.names)
+        self._custom_fields = len(dict_custom_fields)
+        self._parts = [self.path]  # Files written, one per schema
+        self._writer = pq.ParquetWriter(self.path, self.schema)
+
+    def _widen(self):
+        'Starts a new part file when custom fields were added to dict_custom_fields, so their columns are not dropped.'
+        if len(self.dict_custom_fields) == self._custom_fields:
+            return
+        self._custom_fields = len(self.dict_custom_fields)
+        schema = deals_arrow_schema(self.dict_custom_fields)
+        if schema.names == self.schema.names:
+            return
+        self._writer.close()
+        self.schema = schema
+        self._parts.append(f'{self.path}.part{len(self._parts)}')
+        self._writer = pq.ParquetWriter(self._parts[-1], self.schema)
+
+    def write_page(self, list_deals):
+        'Normalizes a page of raw deals and writes it in the file.'
+        if len(list_deals) == 0:
+            return
+        self._widen()
+        df_deals = normalize_deals(list_deals, self.dict_custom_fields, drop_empty=False)
+        batch = deals_record_batch(df_deals, self.schema)
+        for name, column in zip(batch.schema.names, batch.columns):
+            if column.null_count < len(column):
+                self._filled_columns.add(name)
+        self._writer.write_batch(batch)
+        self.num_rows += batch.num_rows
+
+    def consume(self, list_deals):
+        'Collector interface (see extraction.scan_pipeline): writes the page.'
+        self.write_page(list_deals)
+
+    def close(self):
+        '''
+        Closes the file, joining its parts and dropping empty custom fields columns (row group by row
+        group), and returns its path.
+        '''
+        if self._writer.is_open is False:
+            return self.path
+        self._writer.close()
+        keep_columns = [name for name in self.schema.names if name in self._filled_columns]
+        if len(self._parts) > 1 or len(keep_columns) < len(self.schema.names):
+            pruned_path = self.path + '.pruned'
+            pruned_schema = pa.schema([self.schema.field(name) for name in keep_columns])
+            with pq.ParquetWriter(pruned_path, pruned_schema) as writer:
+                for part in self._parts:
+                    with pq.ParquetFile(part) as parquet_file:
+                        columns = [name for name in keep_columns if name in parquet_file.schema_arrow.names]
+                        for row_group in range(parquet_file.num_row_groups):
+                            table = parquet_file.read_row_group(row_group, columns=columns)
+                            # Columns of custom fields added after the part was written are null
+                            arrays = [
+                                table.column(field.name) if field.name in columns else pa.nulls(table.num_rows, type=field.type)
+                                for field in pruned_schema
+                            ]
+                            writer.write_table(pa.Table.from_arrays(arrays, schema=pruned_schema))
+            for part in self._parts[1:]:
+                os.remove(part)
+            self._parts = [self.path]
+            os.replace(pruned_path, self.path)
+        return self.path
+
+    def discard(self):
+        'Closes and removes the file (and its parts).'
+        if self._writer.is_open is True:
+            self._writer.close()
+        for part in self._parts:
+            if os.path.exists(part):
+                os.remove(part)
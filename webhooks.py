@@ -0,0 +1,287 @@
+from jobs import BigQuerySink, table_schema
+from rd import RDClient, normalize_deals, deal_row, value_to_str
+from lazy import LazyModule
+import metrics
+import threading
+import queue
+import time
+import os
+
+pd = LazyModule('pandas')
+
+# RD CRM webhook events upserted in the deals tables (other events are ignored)
+DEAL_EVENTS = ('crm_deal_created', 'crm_deal_updated')
+
+def check_deal(deal, dict_custom_fields: dict = None):
+    '''
+    Raises ValueError if a raw deal can't be normalized (see rd.deal_row and normalize_deals): missing
+    or invalid keys, dates or amounts and, with dict_custom_fields, custom fields unknown in the account.
+    '''
+    if deal.get('id') is None or deal.get('updated_at') is None:
+        raise ValueError('Invalid deal! It must have id and updated_at.')
+    try:
+        deal_row(deal)
+        fields = []
+        for c_field in deal['deal_custom_fields']:
+            value_to_str(c_field['value'])
+            fields.append(c_field['custom_field_id'])
+        for key in ('created_at', 'updated_at', 'closed_at'):
+            if deal[key] is not None:
+                pd.Timestamp(deal[key])
+        for key in ('amount_montly', 'amount_unique', 'amount_total'):
+            if deal[key] is not None:
+                float(deal[key])
+    except (KeyError, IndexError, TypeError, AttributeError, ValueError) as error:
+        raise ValueError(f'Invalid deal {deal["id"]}! {type(error).__name__}: {error}')
+    unknown = [field for field in fields if dict_custom_fields is not None and field not in dict_custom_fields]
+    if len(unknown) > 0:
+        raise ValueError(f'Invalid deal {deal["id"]}! Unknown custom fields {sorted(unknown)}.')
+
+def deal_from_event(event):
+    '''
+    Returns the raw deal (RD CRM json, as in /deals) of a webhook event {"event_name": ..., "document": deal},
+    or None for events that are not deal creations or updates. Raises ValueError for malformed events
+    and for deals that can't be normalized (see check_deal).
+    '''
+    if not isinstance(event, dict):
+        raise ValueError('Invalid event! Expected a json object.')
+    if event.get('event_name') not in DEAL_EVENTS:
+        return None
+    deal = event.get('document')
+    if not isinstance(deal, dict):
+        raise ValueError('Invalid deal event! The document must be a deal.')
+    check_deal(deal)
+    return deal
+
+def latest_deals(list_deals):
+    'Keeps the last version of each deal of a list (max updated_at, the later event wins ties), in order of first appearance.'
+    latest = {}
+    for deal in list_deals:
+        current = latest.get(deal['id'])
+        if current is None or pd.Timestamp(deal['updated_at']) >= pd.Timestamp(current['updated_at']):
+            latest[deal['id']] = deal
+    return list(latest.values())
+
+class _Flush:
+    'Queue marker asking the flusher thread to flush the buffered events now (and stop, when stop is True).'
+    def __init__(self, stop: bool = False):
+        self.stop = stop
+        self.done = threading.Event()
+
+class DealsWebhookBuffer:
+    '''
+    Buffers the deals of RD CRM webhook events in a bounded queue and upserts them in micro-batches
+    in the deals_<pipeline> tables of a dataset, from a background thread. A batch is flushed when
+    batch_size events are buffered or window seconds after its first event.
+    Deals are normalized as in RDClient.pipeline_deals and merged by id (see jobs.Sink.merge), keeping
+    only the last version of each deal of a batch. Custom fields and the pipeline of each stage come
+    from the cached reference entities of rd_client, so events cost no RD requests besides cache refreshes.
+    max_queue: Events buffered at most; put returns False when the queue is full (backpressure).
+    max_retries: Failed upserts of a batch are retried with exponential backoff, then dropped and counted as failed.
+    '''
+    def __init__(
+            self,
+            rd_client: RDClient,
+            sink,
+            BQ_PROJECT_ID: str,
+            BQ_DATASET: str,
+            batch_size: int = 500,
+            window: float = 5.0,
+            max_queue: int = 10000,
+            max_retries: int = 3
+        ):
+        self.rd_client = rd_client
+        self.sink = sink
+        self.BQ_PROJECT_ID = BQ_PROJECT_ID
+        self.BQ_DATASET = BQ_DATASET
+        self.batch_size = batch_size
+        self.window = window
+        self.max_retries = max_retries
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._tables = set()  # Tables known to exist (merged instead of created)
+        self._stage_pipelines = None  # {stage id: pipeline id}
+        self._thread = threading.Thread(target=self._run, name='webhook-flush', daemon=True)
+        self._thread.start()
+
+    def put(self, deal):
+        'Buffers the raw deal of an event; returns False (the event is rejected) when the queue is full.'
+        try:
+            self._queue.put_nowait(deal)
+        except queue.Full:
+            metrics.WEBHOOK_EVENTS.inc(status='rejected')
+            return False
+        metrics.WEBHOOK_EVENTS.inc(status='accepted')
+        metrics.WEBHOOK_QUEUE.set(self._queue.qsize())
+        return True
+
+    def flush(self, timeout: float = None):
+        'Flushes the events buffered so far and waits for their upserts (returns False on timeout).'
+        marker = _Flush()
+        self._queue.put(marker, timeout=timeout)
+        return marker.done.wait(timeout)
+
+    def close(self, timeout: float = None):
+        'Flushes the buffered events and stops the flusher thread.'
+        if not self._thread.is_alive():
+            return
+        marker = _Flush(stop=True)
+        self._queue.put(marker, timeout=timeout)
+        marker.done.wait(timeout)
+
+    def _run(self):
+        batch = []
+        deadline = None
+        while True:
+            try:
+                item = self._queue.get(timeout=None if deadline is None else max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                item = None  # Window of the batch elapsed
+            if isinstance(item, _Flush):
+                self._flush(batch)
+                batch, deadline = [], None
+                item.done.set()
+                if item.stop is True:
+                    return
+                continue
+            if item is not None:
+                batch.append(item)
+                deadline = deadline or time.monotonic() + self.window
+            if len(batch) >= self.batch_size or (deadline is not None and time.monotonic() >= deadline):
+                self._flush(batch)
+                batch, deadline = [], None
+
+    def pipeline_id(self, deal, refresh: bool = False):
+        'Returns the pipeline id of a raw deal (from its stage), or None if it is unknown.'
+        pipeline = deal.get('deal_pipeline') or (deal.get('deal_stage') or {}).get('deal_pipeline') or {}
+        if pipeline.get('id') is not None:
+            return pipeline['id']
+        if self._stage_pipelines is None or refresh is True:
+            if refresh is True:
+                self.rd_client.invalidate_cache('pipelines')
+                self.rd_client.invalidate_cache('pipeline_stages')
+            df_stages = self.rd_client.general_stages(dict_pipelines=self.rd_client.pipelines(output='dict'))
+            self._stage_pipelines = dict(zip(df_stages['id'], df_stages['deal_pipeline_id'])) if len(df_stages) > 0 else {}
+        return self._stage_pipelines.get((deal.get('deal_stage') or {}).get('id'))
+
+    def _flush(self, list_deals):
+        '''
+        Upserts a batch in a webhook_flush run: deals skipped or dropped are counted in its log, with
+        an entry of errors for each, and a failed batch is logged by the run (status failed) while the
+        flusher thread keeps running.
+        '''
+        metrics.WEBHOOK_QUEUE.set(self._queue.qsize())
+        if len(list_deals) == 0:
+            return
+        try:
+            with metrics.run('webhook_flush', events=len(list_deals), invalid_deals=0, ignored_deals=0, failed_deals=0, errors=[]) as stats:
+                try:
+                    self._upsert_batch(list_deals, stats)
+                except Exception:
+                    stats.fields['failed_deals'] = len(list_deals)  # Deals of the batch dropped
+                    raise
+        except Exception:
+            metrics.WEBHOOK_EVENTS.inc(len(list_deals), status='failed')
+
+    def _upsert_batch(self, list_deals, stats):
+        errors = stats.fields['errors']
+        list_deals = latest_deals(list_deals)
+        # Custom fields created after the reference entities were cached are refetched
+        dict_custom_fields = self.rd_client.refresh_custom_fields(list_deals, self.rd_client.custom_fields(output='dict'), strict=False)
+        dict_pipelines = self.rd_client.pipelines(output='dict')
+        dict_batches = {}
+        refreshed = False
+        for deal in list_deals:
+            # Deals that can't be normalized are skipped, so they don't fail the rest of the batch
+            try:
+                check_deal(deal, dict_custom_fields)
+            except ValueError as error:
+                errors.append({'deal_id': deal.get('id'), 'status': 'invalid', 'error': str(error)})
+                metrics.WEBHOOK_EVENTS.inc(status='invalid')
+                stats.fields['invalid_deals'] += 1
+                continue
+            pipeline_id = self.pipeline_id(deal)
+            if pipeline_id not in dict_pipelines and refreshed is False:
+                # Pipelines or stages created after the reference entities were cached
+                refreshed = True
+                pipeline_id = self.pipeline_id(deal, refresh=True)
+                dict_pipelines = self.rd_client.pipelines(output='dict')
+            if pipeline_id not in dict_pipelines:
+                stage_id = (deal.get('deal_stage') or {}).get('id')
+                errors.append({'deal_id': deal['id'], 'status': 'ignored', 'error': f'Unknown pipeline of stage {stage_id}.'})
+                metrics.WEBHOOK_EVENTS.inc(status='ignored')
+                stats.fields['ignored_deals'] += 1
+                continue
+            dict_batches.setdefault(pipeline_id, []).append(deal)
+        for pipeline_id, deals in dict_batches.items():
+            table_id = f'{self.BQ_PROJECT_ID}.{self.BQ_DATASET}.deals_{dict_pipelines[pipeline_id]}'
+            error = self._upsert(table_id, deals, dict_custom_fields, pipeline_id)
+            if error is None:
+                metrics.WEBHOOK_EVENTS.inc(len(deals), status='flushed')
+            else:
+                errors.append({'table_id': table_id, 'deals': len(deals), 'status': 'failed', 'error': error})
+                metrics.WEBHOOK_EVENTS.inc(len(deals), status='failed')
+                stats.fields['failed_deals'] += len(deals)
+
+    def _upsert(self, table_id, list_deals, dict_custom_fields, pipeline_id):
+        '''
+        Merges the deals of a pipeline in its table (appended if the table does not exist yet); returns
+        None if it succeeded or the error once retries run out (the deals are dropped).
+        '''
+        try:
+            with metrics.stage('normalize', 'deals', detail=pipeline_id):
+                df_deals = normalize_deals(list_deals, dict_custom_fields)
+            schema = table_schema(self.rd_client, 'deals', df_deals)
+        except Exception as error:
+            return f'{type(error).__name__}: {error}'
+        for attempt in range(self.max_retries + 1):
+            try:
+                if table_id not in self._tables and self.sink.watermark(table_id) is None:
+                    self.sink.write(table_id=table_id, df=df_deals, write_mode='append', schema=schema)
+                else:
+                    self.sink.merge(table_id=table_id, df=df_deals, schema=schema)
+                self._tables.add(table_id)
+                return None
+            except Exception as error:
+                if attempt == self.max_retries:
+                    return f'{type(error).__name__}: {error}'
+                time.sleep(min(2 ** attempt, 30))
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+def webhook_buffer():
+    '''
+    Returns the process-wide buffer of the /webhook/rd endpoint, for the account of the RD_CRM_TOKEN,
+    BQ_PROJECT_ID and BQ_DATASET environment variables. WEBHOOK_BATCH_SIZE, WEBHOOK_WINDOW (seconds)
+    and WEBHOOK_MAX_QUEUE tune the micro-batches; WEBHOOK_OUTPUT_DIR writes local parquet files
+    (see parquet_sink) instead of BigQuery.
+    '''
+    global _buffer
+    with _buffer_lock:
+        if _buffer is None:
+            from clients import get_rd_client, get_bq_client
+            for name in ('RD_CRM_TOKEN', 'BQ_PROJECT_ID', 'BQ_DATASET'):
+                if os.environ.get(name) is None:
+                    raise ValueError(f'Missing {name}! Please, set it in the environment to receive webhooks.')
+            if os.environ.get('WEBHOOK_OUTPUT_DIR') is not None:
+                from parquet_sink import ParquetSink
+                sink = ParquetSink(os.environ['WEBHOOK_OUTPUT_DIR'])
+            else:
+                sink = BigQuerySink(get_bq_client())
+            _buffer = DealsWebhookBuffer(
+                rd_client=get_rd_client(os.environ['RD_CRM_TOKEN']),
+                sink=sink,
+                BQ_PROJECT_ID=os.environ['BQ_PROJECT_ID'],
+                BQ_DATASET=os.environ['BQ_DATASET'],
+                batch_size=int(os.environ.get('WEBHOOK_BATCH_SIZE', 500)),
+                window=float(os.environ.get('WEBHOOK_WINDOW', 5.0)),
+                max_queue=int(os.environ.get('WEBHOOK_MAX_QUEUE', 10000))
+            )
+        return _buffer
+
+def close_webhook_buffer(timeout: float = 60):
+    'Flushes the events of the process-wide buffer (if created) and stops it, e.g. when the process exits.'
+    with _buffer_lock:
+        buffer = _buffer
+    if buffer is not None:
+        buffer.close(timeout=timeout)
@@ -0,0 +1,75 @@
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import functools
+import threading
+import os
+
+# Deals per task sent to the normalization processes (a RD page has up to 200 deals)
+BATCH_SIZE = 200
+
+class NormalizePool:
+    '''
+    Process pool for the CPU-bound normalization of raw deals (dict building, json normalization
+    and casts), so pipelines scanned by different threads use every core instead of sharing the GIL.
+    Raw batches are sent to the workers and their typed results (dataframes or arrow tables) are
+    pickled back. Processes are spawned (not forked), as the service runs several threads.
+    max_pending: Maximum tasks in flight per scan, bounding the raw pages held in memory.
+    '''
+    def __init__(self, max_workers: int, batch_size: int = BATCH_SIZE, max_pending: int = None):
+        if max_workers < 1:
+            raise ValueError('max_workers must be at least 1.')
+        self.max_workers = max_workers
+        self.batch_size = batch_size
+        self.max_pending = max_pending or 2 * max_workers
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self, broken=None):
+        with self._lock:
+            if self._executor is None or self._executor is broken:
+                # A broken pool (a worker died) is replaced by a new one
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context('spawn'))
+            return self._executor
+
+    def submit(self, func, *args, **kwargs):
+        'Submits func(*args, **kwargs) to a worker process (func must be a module level function).'
+        executor = self._get_executor()
+        try:
+            return executor.submit(func, *args, **kwargs)
+        except BrokenProcessPool:
+            return self._get_executor(broken=executor).submit(func, *args, **kwargs)
+
+    def batches(self, items):
+        'Splits a list in batches of batch_size items.'
+        return [items[start:start + self.batch_size] for start in range(0, len(items), self.batch_size)]
+
+    def map_batches(self, func, items, **kwargs):
+        'Returns [func(batch, **kwargs)] of the batches of a list of items, computed by the workers, in order.'
+        task = functools.partial(func, **kwargs)
+        futures = [self.submit(task, batch) for batch in self.batches(items)]
+        return [future.result() for future in futures]
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True, cancel_futures=True)
+                self._executor = None
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def normalize_pool():
+    '''
+    Returns the process-wide normalization pool, with NORMALIZE_WORKERS processes ("auto": one per
+    core), or None when it is not set or 0 (normalization runs in the calling threads).
+    '''
+    global _pool
+    workers = os.environ.get('NORMALIZE_WORKERS', '0')
+    max_workers = (os.cpu_count() or 1) if workers == 'auto' else int(workers)
+    if max_workers < 1:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = NormalizePool(max_workers=max_workers)
+        return _pool